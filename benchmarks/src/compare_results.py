@@ -0,0 +1,63 @@
+import argparse
+import json
+import statistics
+import sys
+from collections import defaultdict
+
+# Compares two benchmark result files from run_benchmarks, e.g. before and after a change,
+# or last month's run with today's. Only tool and corpus size combinations found in both
+# are compared; the exit status is 1 if any of them got slower by more than the threshold.
+
+
+def median_times(results, stages=False):
+    """{(tool, files): median wall seconds}, plus {(tool, files, stage): median seconds} with stages."""
+    times = defaultdict(list)
+    for run in results['runs']:
+        if run['exit_code'] != 0 or 'wall_seconds' not in run:
+            continue
+        times[run['tool'], run['files']].append(run['wall_seconds'])
+        if stages:
+            for stage, stage_times in run.get('stages', {}).items():
+                times[run['tool'], run['files'], stage].append(stage_times['seconds'])
+    return {key: statistics.median(values) for key, values in times.items()}
+
+
+def describe(results):
+    return f"{results['started']} ({results.get('git_commit', '')[:10] or 'unknown commit'})"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("baseline", help="Results JSON to compare against")
+    parser.add_argument("candidate", help="Results JSON of the run being checked")
+    parser.add_argument("--threshold", type=float, default=10, help="Percent slower that counts as a regression (default: %(default)s)")
+    parser.add_argument("--stages", action="store_true", help="Also compare the time of each stage")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    print(f"Baseline:  {describe(baseline)}")
+    print(f"Candidate: {describe(candidate)}")
+    if baseline.get('machine') != candidate.get('machine'):
+        print("Warning: the runs were on different machines or Python versions.")
+
+    before, after = median_times(baseline, args.stages), median_times(candidate, args.stages)
+    regressions = 0
+    print(f"\n{'Tool':<20} {'Files':>9} {'Stage':<20} {'Baseline s':>11} {'Candidate s':>12} {'Change':>8}")
+    for key in sorted(before.keys() & after.keys(), key=lambda key: (key[0], key[1], key[2:] or ('',))):
+        tool, files, stage = key[0], key[1], key[2] if len(key) > 2 else ''
+        change = (after[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+        flag = ""
+        if not stage and change > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{tool:<20} {files:>9} {stage:<20} {before[key]:>11.3f} {after[key]:>12.3f} {change:>+7.1f}%{flag}")
+    if regressions:
+        print(f"\n{regressions} runs slower by more than {args.threshold:g}%.")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
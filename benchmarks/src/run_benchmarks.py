@@ -0,0 +1,348 @@
+import os
+import sys
+import json
+import math
+import shlex
+import shutil
+import socket
+import statistics
+import subprocess
+import configparser
+import logging
+import platform
+import datetime
+import time
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+import boto3
+from botocore.config import Config as BotoConfig
+
+from synthetic_corpus import CorpusSpec, write_local_corpus, upload_corpus
+
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+# --- Configuration ---
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+CONFIG_FILE = 'config.ini'
+REPO_ROOT = Path(__file__).resolve().parents[2]
+STAGE_RUNNER = Path(__file__).resolve().parent / 'stage_runner.py'
+RESULTS_VERSION = 1
+
+
+class Tool(NamedTuple):
+    script: str # Relative to the repository root
+    stages: Dict[str, str] # Stage name -> dotted path of the function timed for it
+
+
+# Timed in every tool: each S3 API call, and each image decoded by Pillow
+COMMON_STAGES = {
+    's3_requests': 'botocore.client.BaseClient._make_api_call',
+    'image_decode': 'PIL.ImageFile.ImageFile.load',
+}
+
+# Stages can nest (e.g. sorting pulls the listing through), so their times overlap
+TOOLS = {
+    'contact-sheet': Tool('contact-sheet/src/contactsheet.py', {
+        'listing': 's3_listing.list_objects',
+        'exif_header_reads': 'jpeg_exif.read_exif_segment',
+        'image_encode': 'PIL.Image.Image.save',
+        'pdf_draw_image': 'reportlab.pdfgen.canvas.Canvas.drawImage',
+        'pdf_save': 'reportlab.pdfgen.canvas.Canvas.save',
+        'fragment_merge': 'fragments.write_volumes',
+    }),
+    'compare-locations': Tool('compare-locations/src/compare_locations.py', {
+        's3_listing': 'compare_locations.get_s3_files',
+        'local_walk': 'compare_locations.get_local_files',
+        'sort': 'compare_locations.external_sort',
+        'join': 'compare_locations.compare_files',
+        'content_matching': 'compare_locations.match_content',
+        'exif_matching': 'compare_locations.match_exif',
+        'unmatched': 'compare_locations.add_unmatched',
+    }),
+    'renamer': Tool('renamer/src/create_renamer.py', {
+        'plan': 'create_renamer.plan_renames',
+        'walk': 'create_renamer.walk_files',
+        'write_script': 'create_renamer.write_rename_script',
+        'apply': 'create_renamer.apply_renames',
+    }),
+    'duplicates': Tool('duplicates/src/find_duplicates.py', {
+        's3_listing': 'find_duplicates.get_s3_images',
+        'local_walk': 'find_duplicates.get_local_images',
+        'hashing': 'find_duplicates.hash_images',
+        'grouping': 'find_duplicates.group_near_duplicates',
+        'contact_sheet': 'find_duplicates.write_duplicate_sheet',
+    }),
+}
+
+# --- Helper Functions ---
+
+def read_config(filename=CONFIG_FILE):
+    """Reads configuration from the INI file."""
+    config = configparser.ConfigParser()
+    config.optionxform = str # Keep the case of the Section.Key settings passed on to the tools
+    script_dir = Path(__file__).resolve().parent
+    filename = script_dir / filename
+    if not os.path.exists(filename):
+        logging.error(f"Configuration file '{filename}' not found.")
+        raise FileNotFoundError(f"Configuration file '{filename}' not found.")
+    config.read(filename)
+    try:
+        for section in ['Corpus', 'S3', 'Benchmark'] + list(TOOLS):
+            if not config.has_section(section):
+                config.add_section(section) # All settings are optional
+        corpus_config = config['Corpus']
+        s3_config = config['S3']
+        benchmark_config = config['Benchmark']
+        tools = [tool.strip() for tool in benchmark_config.get('Tools', ', '.join(TOOLS)).split(',') if tool.strip()]
+        unknown = [tool for tool in tools if tool not in TOOLS]
+        if unknown:
+            raise ValueError(f"Unknown tools {', '.join(unknown)}; Tools can be {', '.join(TOOLS)}")
+        return {
+            'counts': [int(float(count)) for count in corpus_config.get('Counts', '1000, 10000').split(',') if count.strip()],
+            'spec': CorpusSpec(
+                count=0,
+                width=int(corpus_config.get('ImageWidth', 320)),
+                height=int(corpus_config.get('ImageHeight', 240)),
+                quality=int(corpus_config.get('JpegQuality', 85)),
+                depth=max(1, int(corpus_config.get('FolderDepth', 3))),
+                files_per_folder=max(1, int(corpus_config.get('FilesPerFolder', 100))),
+                exif_fraction=float(corpus_config.get('ExifFraction', 0.9)),
+                thumbnail_fraction=float(corpus_config.get('ThumbnailFraction', 0.5)),
+                s3_only_fraction=float(corpus_config.get('S3OnlyFraction', 0.05)),
+                local_only_fraction=float(corpus_config.get('LocalOnlyFraction', 0.05)),
+                renamed_fraction=float(corpus_config.get('RenamedFraction', 0.05)),
+                seed=int(corpus_config.get('Seed', 1)),
+            ),
+            'corpus_directory': os.path.abspath(os.path.expanduser(corpus_config.get('CorpusDirectory', 'benchmark_corpus'))),
+            'bucket_name': s3_config.get('BucketName', 'photo-management-benchmarks'),
+            'endpoint_url': s3_config.get('EndpointUrl', ''), # Empty starts a moto server for the run
+            'upload_workers': max(1, int(s3_config.get('UploadWorkers', 16))),
+            'tools': tools,
+            'repeats': max(1, int(benchmark_config.get('Repeats', 1))),
+            'results_directory': os.path.abspath(os.path.expanduser(benchmark_config.get('ResultsDirectory', 'benchmark_results'))),
+            'tool_settings': {tool: dict(config[tool]) for tool in TOOLS},
+        }
+    except KeyError as e:
+        logging.error(f"Missing configuration key: {e}")
+        raise KeyError(f"Missing configuration key in '{filename}': {e}")
+    except ValueError as e:
+         logging.error(f"Invalid value in configuration: {e}")
+         raise ValueError(f"Invalid value in configuration file '{filename}': {e}")
+
+def start_moto_server():
+    """Starts an in-process moto S3 server on a free port and returns (server, endpoint URL)."""
+    if ThreadedMotoServer is None:
+        raise RuntimeError("EndpointUrl is empty, so a moto server is needed: pip install 'moto[server]'")
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    logging.getLogger('werkzeug').setLevel(logging.WARNING) # Not a log line per request
+    return server, f"http://127.0.0.1:{port}"
+
+def create_bucket(s3_client, bucket_name: str):
+    region = s3_client.meta.region_name
+    try:
+        if region == 'us-east-1':
+            s3_client.create_bucket(Bucket=bucket_name)
+        else:
+            s3_client.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={'LocationConstraint': region})
+    except (s3_client.exceptions.BucketAlreadyOwnedByYou, s3_client.exceptions.BucketAlreadyExists):
+        pass
+
+def tool_config(tool: str, settings: Dict[str, str], bucket_name: str, prefix: str, local_directory: str) -> configparser.ConfigParser:
+    """The config.ini a tool runs with: the corpus locations, then Section.Key = value settings from the benchmark config."""
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config['S3'] = {'BucketName': bucket_name, 'StartFolder': prefix, 'LocalFolder': local_directory,
+                    'OutputFile': 'contact_sheet.pdf'}
+    config['Layout'] = {}
+    for name, value in settings.items():
+        if '.' in name:
+            section, key = name.split('.', 1)
+            if not config.has_section(section):
+                config.add_section(section)
+            config[section][key] = value
+    return config
+
+def copy_tool_tree(script: str, destination: Path) -> Path:
+    """Copies the tool's source directory and the shared modules, keeping their layout. Returns the copied script."""
+    script_path = REPO_ROOT / script
+    ignore = shutil.ignore_patterns('config.ini', '__pycache__')
+    shutil.copytree(script_path.parent, destination / script_path.parent.relative_to(REPO_ROOT), ignore=ignore)
+    shutil.copytree(REPO_ROOT / 'shared' / 'src', destination / 'shared' / 'src', ignore=ignore)
+    return destination / script
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination) # E.g. across filesystems
+
+def link_tree(source: str, destination: str):
+    """Copies a directory tree as hard links, so a run can move the files without touching the corpus."""
+    shutil.copytree(source, destination, copy_function=link_or_copy)
+
+def run_tool(tool: str, count: int, repeat: int, run_directory: Path, settings: Dict[str, str],
+             bucket_name: str, prefix: str, local_directory: str, environment: Dict[str, str]) -> dict:
+    """Runs one tool once in a fresh interpreter, from a copy of its source tree, and returns its metrics."""
+    run_directory.mkdir(parents=True)
+    script = copy_tool_tree(TOOLS[tool].script, run_directory / 'tree')
+    tool_args = []
+    if tool == 'renamer':
+        source = local_directory
+        if settings.get('Execute', 'false').strip().lower() in ('1', 'yes', 'true', 'on'):
+            source = str(run_directory / 'source') # The files are moved, so work on linked copies
+            link_tree(local_directory, source)
+            tool_args.append('--execute')
+        tool_args += ['--source', source, '--target', str(run_directory / 'renamed'),
+                      '--script', str(run_directory / 'rename_commands.sh'),
+                      '--journal', str(run_directory / 'rename_journal.jsonl')]
+        tool_args += shlex.split(settings.get('Args', ''))
+    else:
+        with open(script.parent / CONFIG_FILE, 'w') as f:
+            tool_config(tool, settings, bucket_name, prefix, local_directory).write(f)
+
+    metrics_file = run_directory / 'metrics.json'
+    command = [sys.executable, str(STAGE_RUNNER), '--script', str(script), '--metrics', str(metrics_file)]
+    for name, path in {**COMMON_STAGES, **TOOLS[tool].stages}.items():
+        command += ['--stage', f"{name}={path}"]
+    command += ['--'] + tool_args
+
+    logging.info(f"Running {tool} on {count} files (repeat {repeat + 1})...")
+    started = time.perf_counter()
+    with open(run_directory / 'output.log', 'w') as log:
+        completed = subprocess.run(command, cwd=run_directory, env=environment, stdout=log, stderr=subprocess.STDOUT)
+    process_seconds = time.perf_counter() - started
+
+    try:
+        with open(metrics_file) as f:
+            metrics = json.load(f)
+    except (OSError, ValueError):
+        metrics = {'exit_code': completed.returncode, 'stages': {}}
+    if completed.returncode:
+        logging.warning(f"{tool} exited with code {completed.returncode}; see {run_directory / 'output.log'}")
+    wall_seconds = metrics.get('wall_seconds', process_seconds)
+    return {
+        'tool': tool,
+        'files': count,
+        'repeat': repeat,
+        'process_seconds': round(process_seconds, 6), # Including interpreter startup and imports
+        'files_per_second': round(count / wall_seconds, 1) if wall_seconds else None,
+        **metrics,
+        'exit_code': completed.returncode,
+        'run_directory': str(run_directory),
+    }
+
+def scaling_curves(runs: List[dict]) -> Dict[str, List[dict]]:
+    """The median wall time of each tool at each corpus size, with the growth exponent from the previous size.
+
+    An exponent of 1 is linear scaling; 2 means doubling the files quadruples the time.
+    """
+    curves = {}
+    for tool in dict.fromkeys(run['tool'] for run in runs):
+        points = []
+        for count in sorted({run['files'] for run in runs if run['tool'] == tool}):
+            times = [run['wall_seconds'] for run in runs
+                     if run['tool'] == tool and run['files'] == count and run['exit_code'] == 0 and 'wall_seconds' in run]
+            if not times:
+                continue
+            wall_seconds = statistics.median(times)
+            point = {'files': count, 'wall_seconds': round(wall_seconds, 6),
+                     'files_per_second': round(count / wall_seconds, 1) if wall_seconds else None, 'exponent': None}
+            if points and points[-1]['wall_seconds'] and wall_seconds and count != points[-1]['files']:
+                point['exponent'] = round(math.log(wall_seconds / points[-1]['wall_seconds'])
+                                          / math.log(count / points[-1]['files']), 3)
+            points.append(point)
+        curves[tool] = points
+    return curves
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def main():
+    try:
+        config = read_config()
+    except (FileNotFoundError, KeyError, ValueError) as e:
+        logging.critical(f"Configuration error: {e}")
+        exit(1)
+
+    BUCKET_NAME = config['bucket_name']
+    started = datetime.datetime.now()
+    results_directory = Path(config['results_directory'])
+    run_root = results_directory / f"runs_{started:%Y%m%d_%H%M%S}"
+
+    environment = dict(os.environ)
+    server = None
+    endpoint_url = config['endpoint_url']
+    if not endpoint_url:
+        try:
+            server, endpoint_url = start_moto_server()
+        except RuntimeError as e:
+            logging.critical(str(e))
+            exit(1)
+        logging.info(f"Started a moto S3 server at {endpoint_url}")
+        for name, value in {'AWS_ACCESS_KEY_ID': 'benchmark', 'AWS_SECRET_ACCESS_KEY': 'benchmark'}.items():
+            environment[name] = value # Never sign requests to the stand-in with real credentials
+        environment.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    environment['AWS_ENDPOINT_URL'] = endpoint_url # The tools' boto3 clients pick the endpoint up from here
+
+    s3 = boto3.client('s3', endpoint_url=endpoint_url, region_name=environment.get('AWS_DEFAULT_REGION'),
+                      aws_access_key_id=environment.get('AWS_ACCESS_KEY_ID'),
+                      aws_secret_access_key=environment.get('AWS_SECRET_ACCESS_KEY'),
+                      config=BotoConfig(max_pool_connections=config['upload_workers']))
+    runs = []
+    try:
+        create_bucket(s3, BUCKET_NAME)
+        for count in config['counts']:
+            spec = config['spec']._replace(count=count)
+            local_directory = write_local_corpus(spec, config['corpus_directory'])
+            prefix = upload_corpus(spec, s3, BUCKET_NAME, config['upload_workers'])
+            for tool in config['tools']:
+                settings = config['tool_settings'][tool]
+                max_files = int(settings.get('MaxFiles', 0))
+                if max_files and count > max_files:
+                    logging.info(f"Skipping {tool} on {count} files (MaxFiles = {max_files}).")
+                    continue
+                for repeat in range(config['repeats']):
+                    run = run_tool(tool, count, repeat, run_root / f"{tool}_{count}_{repeat + 1}", settings,
+                                   BUCKET_NAME, prefix, local_directory, environment)
+                    logging.info(f"{tool} on {count} files: {run.get('wall_seconds', run['process_seconds']):.2f}s")
+                    runs.append(run)
+    finally:
+        if server:
+            server.stop()
+
+    results = {
+        'version': RESULTS_VERSION,
+        'started': started.isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        's3_endpoint': 'moto (in-process)' if server else endpoint_url,
+        'corpus': {**config['spec']._asdict(), 'count': config['counts']},
+        'runs': runs,
+        'scaling': scaling_curves(runs),
+    }
+    results_directory.mkdir(parents=True, exist_ok=True) # Not created yet if every run was skipped
+    results_file = results_directory / f"benchmark_{started:%Y%m%d_%H%M%S}.json"
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent=1)
+
+    for tool, points in results['scaling'].items():
+        for point in points:
+            exponent = f", exponent {point['exponent']:.2f}" if point['exponent'] is not None else ""
+            logging.info(f"{tool}: {point['files']} files in {point['wall_seconds']:.2f}s "
+                         f"({point['files_per_second']:.0f} files/s{exponent})")
+    logging.info(f"Results written to {results_file}")
+
+if __name__ == "__main__":
+    main()
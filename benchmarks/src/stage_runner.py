@@ -0,0 +1,149 @@
+import argparse
+import functools
+import importlib
+import inspect
+import json
+import resource
+import runpy
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+
+# Runs one tool in this process with timers around the functions that make up its stages,
+# then writes the timings to a JSON file. The run_benchmarks script starts this in a fresh
+# interpreter for every run, from a copy of the tool's source tree holding its config.ini.
+#
+# Stages are functions named by dotted path, e.g. 's3_listing.list_objects' or
+# 'PIL.ImageFile.ImageFile.load'. They are wrapped before the tool imports them, so a tool
+# that does 'from s3_listing import list_objects' gets the timed version. Functions defined
+# in the tool's own script can only be wrapped if it has a main() function.
+
+_rss_divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024 # ru_maxrss is bytes on macOS, KiB on Linux
+
+
+class StageTimes:
+    """Time spent in each stage, summed over calls and threads. Safe to update from any thread."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end, seconds):
+        """Records one call that ran from start to end, seconds of which were spent in the stage."""
+        with self._lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'first_start': start, 'last_end': end})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['first_start'] = min(stage['first_start'], start)
+            stage['last_end'] = max(stage['last_end'], end)
+
+    def as_dict(self):
+        """{stage: {calls, seconds, span_seconds, start_offset}}, where span is from the first call to the end of the last."""
+        return {name: {'calls': stage['calls'], 'seconds': round(stage['seconds'], 6),
+                       'span_seconds': round(stage['last_end'] - stage['first_start'], 6),
+                       'start_offset': round(stage['first_start'] - self.started, 6)}
+                for name, stage in sorted(self.stages.items(), key=lambda item: item[1]['first_start'])}
+
+
+def _timed_iteration(name, generator, times, start, seconds):
+    """Passes a generator's items on, counting only the time spent producing them."""
+    try:
+        while True:
+            resumed = time.perf_counter()
+            try:
+                item = next(generator)
+            finally:
+                seconds += time.perf_counter() - resumed
+            yield item
+    except StopIteration:
+        return
+    finally:
+        generator.close()
+        times.add(name, start, time.perf_counter(), seconds)
+
+
+def timed(name, function, times):
+    """Wraps function so each call is added to times. A generator's time is counted as it is consumed."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        end = time.perf_counter()
+        if inspect.isgenerator(result):
+            return _timed_iteration(name, result, times, start, end - start)
+        times.add(name, start, end, end - start)
+        return result
+    return wrapper
+
+
+def resolve(path):
+    """Returns (owner, attribute) for a dotted path to a module-level function or a method of a class."""
+    parts = path.split('.')
+    for split in range(len(parts) - 1, 0, -1):
+        try:
+            owner = importlib.import_module('.'.join(parts[:split]))
+        except ImportError:
+            continue
+        for attribute in parts[split:-1]:
+            owner = getattr(owner, attribute)
+        return owner, parts[-1]
+    raise ImportError(f"Can't find the module of stage function {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a tool with stage timers and write the timings as JSON.")
+    parser.add_argument("--script", required=True, help="The tool's script")
+    parser.add_argument("--metrics", required=True, help="JSON file the timings are written to")
+    parser.add_argument("--stage", action="append", default=[], metavar="NAME=PATH", help="A stage and the function timed for it")
+    parser.add_argument("tool_args", nargs=argparse.REMAINDER, help="Arguments for the tool, after --")
+    args = parser.parse_args()
+
+    script = Path(args.script).resolve()
+    # Where the tool finds its own modules and the shared ones
+    sys.path[:0] = [str(script.parent), str(script.parents[2] / 'shared' / 'src')]
+    sys.argv = [str(script)] + (args.tool_args[1:] if args.tool_args[:1] == ['--'] else args.tool_args)
+
+    times = StageTimes()
+    missing = []
+    for stage in args.stage:
+        name, path = stage.split('=', 1)
+        try:
+            owner, attribute = resolve(path)
+            setattr(owner, attribute, timed(name, getattr(owner, attribute), times))
+        except (ImportError, AttributeError) as e:
+            missing.append(f"{name}: {e}") # E.g. an optional module that isn't installed
+
+    exit_code = 0
+    started = time.perf_counter()
+    try:
+        tool = importlib.import_module(script.stem) # Already imported if some of its functions are stages
+        if hasattr(tool, 'main'):
+            tool.main()
+        else:
+            runpy.run_path(str(script), run_name='__main__') # Its stages can only be in the modules it imports
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception:
+        traceback.print_exc()
+        exit_code = 1
+    wall_seconds = time.perf_counter() - started
+
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(args.metrics, 'w') as f:
+        json.dump({
+            'exit_code': exit_code,
+            'wall_seconds': round(wall_seconds, 6),
+            'cpu_seconds': round(own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime, 6),
+            'max_rss_mb': round(own.ru_maxrss / _rss_divisor, 1),
+            'children_max_rss_mb': round(children.ru_maxrss / _rss_divisor, 1), # E.g. worker processes
+            'stages': times.as_dict(),
+            'missing_stages': missing,
+        }, f, indent=1)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
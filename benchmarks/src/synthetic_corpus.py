@@ -0,0 +1,182 @@
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterator, NamedTuple, Optional
+
+import piexif
+from PIL import Image, ImageDraw
+
+# A reproducible corpus of synthetic JPEGs for the benchmarks, written to a local directory
+# and uploaded to S3 (or a local stand-in such as moto). Everything is derived from the spec
+# and its seed, so the same spec always gives byte-identical files, and a corpus already on
+# disk or in the bucket is reused rather than generated again.
+
+TEMPLATE_COUNT = 16 # Distinct images; files with EXIF data also differ by it
+FOLDER_FANOUT = 8 # Sub-folders per folder above the leaf folders
+MARKER_NAME = "corpus.json"
+BASE_DATE = datetime.datetime(2020, 1, 1)
+
+
+class CorpusSpec(NamedTuple):
+    count: int
+    width: int = 320
+    height: int = 240
+    quality: int = 85
+    depth: int = 3 # Folder levels, including the leaf folders
+    files_per_folder: int = 100
+    exif_fraction: float = 0.9 # Files with a DateTimeOriginal (and camera make and model)
+    thumbnail_fraction: float = 0.5 # Files with EXIF data that also embed a thumbnail
+    s3_only_fraction: float = 0.05 # Files only uploaded to S3
+    local_only_fraction: float = 0.05 # Files only written locally
+    renamed_fraction: float = 0.05 # Files with a different name locally, for content and EXIF matching
+    seed: int = 1
+
+    def digest(self) -> str:
+        """A short hash of the spec, naming the corpus directory and S3 prefix."""
+        return hashlib.sha256(json.dumps(self._asdict(), sort_keys=True).encode()).hexdigest()[:12]
+
+
+class CorpusFile(NamedTuple):
+    number: int
+    folder: str # Relative, with '/' separators
+    s3_name: Optional[str] # None if the file is local only
+    local_name: Optional[str] # None if the file is in S3 only
+
+
+def folder_for(number: int, spec: CorpusSpec) -> str:
+    """Spreads the leaf folders evenly over a tree depth levels deep."""
+    folder = number // spec.files_per_folder
+    parents = []
+    for level in range(spec.depth - 1):
+        parents.append(f"d{level}_{(folder // FOLDER_FANOUT ** level) % FOLDER_FANOUT}")
+    return "/".join(parents + [f"f{folder:06d}"])
+
+
+def corpus_files(spec: CorpusSpec) -> Iterator[CorpusFile]:
+    """Yields where each file of the corpus goes, in a fixed order."""
+    rng = random.Random(spec.seed)
+    for number in range(spec.count):
+        name = f"IMG_{number:07d}.jpg"
+        draw = rng.random()
+        s3_name, local_name = name, name
+        if draw < spec.s3_only_fraction:
+            local_name = None
+        elif draw < spec.s3_only_fraction + spec.local_only_fraction:
+            s3_name = None
+        elif draw < spec.s3_only_fraction + spec.local_only_fraction + spec.renamed_fraction:
+            local_name = f"renamed_{number:07d}.jpg"
+        yield CorpusFile(number, folder_for(number, spec), s3_name, local_name)
+
+
+def _template(number: int, spec: CorpusSpec) -> bytes:
+    """One of the distinct images: a gradient with a few random shapes."""
+    rng = random.Random(spec.seed * 1000 + number)
+    img = Image.linear_gradient('L').resize((spec.width, spec.height)).convert('RGB')
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(spec.width), rng.randrange(spec.height)
+        size = rng.randint(spec.width // 16 + 1, spec.width // 3 + 1)
+        draw.ellipse([x, y, x + size, y + size], fill=tuple(rng.randrange(256) for _ in range(3)))
+    stream = io.BytesIO()
+    img.save(stream, 'JPEG', quality=spec.quality)
+    return stream.getvalue()
+
+
+class CorpusImages:
+    """Builds the bytes of each file of a corpus: a template image with the file's own EXIF data."""
+
+    def __init__(self, spec: CorpusSpec):
+        self.spec = spec
+        self.templates = [_template(number, spec) for number in range(TEMPLATE_COUNT)]
+        thumbnail = Image.open(io.BytesIO(self.templates[0]))
+        thumbnail.thumbnail((160, 120))
+        stream = io.BytesIO()
+        thumbnail.save(stream, 'JPEG', quality=75)
+        self.thumbnail = stream.getvalue()
+
+    def image_bytes(self, number: int) -> bytes:
+        rng = random.Random(self.spec.seed * 7919 + number)
+        template = self.templates[number % TEMPLATE_COUNT]
+        if rng.random() >= self.spec.exif_fraction:
+            return template
+        taken = (BASE_DATE + datetime.timedelta(seconds=number * 37)).strftime("%Y:%m:%d %H:%M:%S").encode()
+        exif = {
+            '0th': {piexif.ImageIFD.Make: b"Synthetic", piexif.ImageIFD.Model: f"Camera {number % 3}".encode(),
+                    piexif.ImageIFD.DateTime: taken},
+            'Exif': {piexif.ExifIFD.DateTimeOriginal: taken, piexif.ExifIFD.SubSecTimeOriginal: f"{number % 100:02d}".encode(),
+                     piexif.ExifIFD.PixelXDimension: self.spec.width, piexif.ExifIFD.PixelYDimension: self.spec.height},
+        }
+        if rng.random() < self.spec.thumbnail_fraction:
+            exif['1st'] = {piexif.ImageIFD.JPEGInterchangeFormat: 0, piexif.ImageIFD.JPEGInterchangeFormatLength: 0}
+            exif['thumbnail'] = self.thumbnail
+        stream = io.BytesIO()
+        piexif.insert(piexif.dump(exif), template, stream)
+        return stream.getvalue()
+
+
+def write_local_corpus(spec: CorpusSpec, directory: str) -> str:
+    """Writes the local side of the corpus under directory/<digest>/local, unless it is already there.
+
+    Returns the path of the local folder.
+    """
+    corpus_directory = os.path.join(directory, spec.digest())
+    local_directory = os.path.join(corpus_directory, "local")
+    marker = os.path.join(corpus_directory, MARKER_NAME)
+    if os.path.exists(marker):
+        logging.info(f"Reusing local corpus of {spec.count} files in {local_directory}")
+        return local_directory
+    logging.info(f"Writing local corpus of {spec.count} files to {local_directory}...")
+    images = CorpusImages(spec)
+    for file in corpus_files(spec):
+        if file.local_name:
+            folder = os.path.join(local_directory, *file.folder.split("/"))
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, file.local_name), "wb") as f:
+                f.write(images.image_bytes(file.number))
+    with open(marker, "w") as f:
+        json.dump(spec._asdict(), f, indent=1) # Written last, so an interrupted corpus is written again
+    return local_directory
+
+
+def upload_corpus(spec: CorpusSpec, s3_client, bucket_name: str, workers: int = 16) -> str:
+    """Uploads the S3 side of the corpus under the prefix <digest>/, unless it is already there.
+
+    Returns the prefix.
+    """
+    prefix = f"{spec.digest()}/"
+    marker_key = f"_corpus/{spec.digest()}/{MARKER_NAME}" # Outside the prefix, so the tools don't see it
+    try:
+        s3_client.head_object(Bucket=bucket_name, Key=marker_key)
+        logging.info(f"Reusing S3 corpus of {spec.count} files in s3://{bucket_name}/{prefix}")
+        return prefix
+    except s3_client.exceptions.ClientError:
+        pass
+    logging.info(f"Uploading S3 corpus of {spec.count} files to s3://{bucket_name}/{prefix}...")
+    images = CorpusImages(spec)
+
+    def upload(file):
+        s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}{file.folder}/{file.s3_name}", Body=images.image_bytes(file.number))
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload') as executor:
+        pending = set()
+        for file in corpus_files(spec):
+            if not file.s3_name:
+                continue
+            if len(pending) >= 4 * workers: # Keeps memory bounded for large corpora
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    future.result()
+                    done += 1
+                    if done % 10000 == 0:
+                        logging.info(f"Uploaded {done} files.")
+            pending.add(executor.submit(upload, file))
+        for future in pending:
+            future.result()
+    s3_client.put_object(Bucket=bucket_name, Key=marker_key, Body=json.dumps(spec._asdict()).encode())
+    return prefix
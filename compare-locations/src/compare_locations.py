@@ -1,12 +1,27 @@
 import os
 import io
+import sys
 import boto3
+from botocore.config import Config as BotoConfig
 import exifread
 import configparser
 import logging
 from pathlib import Path
 import re # For sanitizing filename
-from typing import List, Dict, Tuple
+import itertools
+import shutil
+import tempfile
+from collections import defaultdict
+from typing import List, Tuple, Optional, Iterable, Iterator, Set
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'shared' / 'src'))
+from content_match import find_content_matches, MIB
+from scan_index import ScanIndex
+from parallel_walk import walk_files
+from s3_listing import list_objects, read_inventory
+from exif_match import find_exif_matches, is_exif_candidate
+from sorted_diff import DirectoryTable, RecordSpool, Record, external_sort, merge_join, DEFAULT_SORT_BUFFER_RECORDS
+from instrumentation import metrics, instrument_s3_client, read_instrumentation_config, start_run
 
 # exif_getter.py
 
@@ -31,10 +46,27 @@ def read_config(filename=CONFIG_FILE):
     config.read(filename)
     try:
         s3_config = config['S3']
+        if not config.has_section('Matching'):
+            config.add_section('Matching') # All matching settings are optional
+        matching_config = config['Matching']
         return {
             'bucket_name': s3_config['BucketName'],
             'start_folder': s3_config['StartFolder'],
-            'local_folder': s3_config['LocalFolder']
+            'local_folder': s3_config['LocalFolder'],
+            'inventory_manifest': os.path.expanduser(s3_config.get('InventoryManifest', '')), # Empty lists the bucket
+            'match_content': matching_config.getboolean('MatchContent', False),
+            'hash_workers': max(1, int(matching_config.get('HashWorkers', os.cpu_count() or 4))),
+            'multipart_part_sizes': [int(float(size) * MIB) for size in matching_config.get('MultipartPartSizesMB', '8').split(',') if size.strip()],
+            'match_exif': matching_config.getboolean('MatchExif', False),
+            'exif_workers': max(1, int(matching_config.get('ExifWorkers', 16))),
+            'exif_range_bytes': max(1024, int(matching_config.get('ExifRangeBytes', 65536))),
+            'walk_workers': max(1, int(matching_config.get('WalkWorkers', 8))),
+            'list_workers': max(1, int(matching_config.get('ListWorkers', 1))),
+            'scan_index_file': os.path.expanduser(matching_config.get('ScanIndexFile', '')), # Empty disables the index
+            'trust_directory_mtimes': matching_config.getboolean('TrustDirectoryMtimes', False),
+            'sort_buffer_records': max(1000, int(matching_config.get('SortBufferRecords', DEFAULT_SORT_BUFFER_RECORDS))),
+            'spill_directory': os.path.expanduser(matching_config.get('SpillDirectory', '')), # Empty uses the system temp directory
+            'instrumentation': read_instrumentation_config(config, 'compare_metrics.json'),
         }
     except KeyError as e:
         logging.error(f"Missing configuration key: {e}")
@@ -57,53 +89,126 @@ def sanitize_filename(name):
 
 
 
-def get_s3_files(bucket_name: str, prefix: str) -> Dict[str, str]:
-    s3 = boto3.client('s3')
-    files = {}
-    paginator = s3.get_paginator('list_objects_v2')
-    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-        for obj in page.get('Contents', []):
-            path,name=obj['Key'].rsplit('/',1)
-            files[name] = obj['Key'] #Fragile as duplicate filenames will get overwritten - but so long as I've got it once risk is minimal?
-    return files
+def get_s3_files(bucket_name: str, prefix: str, directories: DirectoryTable, list_workers: int = 1,
+                 inventory_manifest: str = '') -> Iterator[Record]:
+    """Yields a (name, directory, size, ETag) record for every object, adding its key prefix to directories.
 
-def get_local_files(directory: str) -> Dict[str, str]:
-    files = {}
-    for root, _, filenames in os.walk(directory):
-        for filename in filenames:
-            file_path = os.path.join(root, filename)
-            files[filename] = file_path
-    return files
+    Sub-prefixes are listed on list_workers threads. With an inventory_manifest, keys are
+    read from a downloaded S3 Inventory report instead of listing the bucket.
+    """
+    if inventory_manifest:
+        listing = read_inventory(inventory_manifest, prefix)
+    else:
+        s3 = instrument_s3_client(boto3.client('s3', config=BotoConfig(max_pool_connections=list_workers)))
+        listing = list_objects(s3, bucket_name, prefix, list_workers)
+    for obj in listing:
+        metrics.count('s3_objects')
+        metrics.advance()
+        name = obj['Key'].rsplit('/', 1)[-1]
+        yield name, directories.add(obj['Key'], name), obj['Size'], obj.get('ETag', '')
 
+def get_local_files(directory: str, directories: DirectoryTable, index: Optional[ScanIndex] = None,
+                    workers: int = 8) -> Iterator[Record]:
+    """Yields a (name, directory, size, '') record for every file, adding its directory to directories.
 
-def compare_files(s3_files: Dict[str, str], local_files: Dict[str, str], bucket_name: str) -> Tuple[List[str], List[str], List[str]]:
-    s3_only = {}
-    local_only = {}
-    common_names = {}
+    Directories are listed in parallel on workers threads, which matters on network mounts.
+    Paths are absolute, with or without a scan index, so the report and matching see the same form.
+    """
+    directory = os.path.abspath(directory)
+    walk = index.scan(directory, workers) if index else ((entry.path, entry.size) for entry in walk_files(directory, workers))
+    for file_path, size in walk:
+        metrics.count('local_files')
+        metrics.advance()
+        name = os.path.basename(file_path)
+        yield name, directories.add(file_path, name), size, ''
 
-    s3_names = set(s3_files.keys())
-    local_names = set(local_files.keys())
-    
-    # Files with commmon names regardles of path
-    common_name_keys = s3_names.intersection(local_names)
-    for key in common_name_keys:
-        common_names[key] = s3_files[key] + " <--> " + local_files[key]
-        
-    local_only_keys = local_names.difference(s3_names)
-    for key in local_only_keys:
-        local_only[key] = local_files[key] + " not matched in S3"
-        
-    s3_only_keys = s3_names.difference(local_names)
-    for key in s3_only_keys:
-        s3_only[key] = s3_files[key] + " not matched locally"
-    
-    return common_names, s3_only, local_only
 
-def list_results(heading:str, dct:Dict[str,str], of):
-    print("\n\n\n"+heading, file=of)
-    keys = dct.keys()
-    for key in keys:
-        print(f"{key}:\t{dct[key]}", file=of)
+class ReportSection:
+    """The lines of one report section, spooled to disk until the section is complete and its length known."""
+
+    def __init__(self, spill_directory: Optional[str] = None):
+        self._file = tempfile.TemporaryFile('w+', encoding='utf-8', dir=spill_directory)
+        self.count = 0
+
+    def add(self, name: str, text: str):
+        print(f"{name}:\t{text}", file=self._file)
+        self.count += 1
+
+    def write(self, heading: str, of):
+        """Writes the heading, with the number of lines, then the lines, and discards the spool."""
+        print(f"\n\n\n{heading} ({self.count}):", file=of)
+        self._file.seek(0)
+        shutil.copyfileobj(self._file, of)
+        self._file.close()
+
+
+def join_paths(records: Iterable[Record], directories: DirectoryTable) -> str:
+    return ", ".join(directories.join(number, name) for name, number, _, _ in records)
+
+def compare_files(s3_records: Iterable[Record], local_records: Iterable[Record], s3_directories: DirectoryTable,
+                  local_directories: DirectoryTable, common_names: ReportSection, s3_only: RecordSpool, local_only: RecordSpool):
+    """Joins the two sides, each sorted by file name.
+
+    Names found on both sides are written to common_names, with every path that has the
+    name. The records of the other files go to s3_only and local_only, in name order.
+    """
+    for name, s3_group, local_group in merge_join(s3_records, local_records):
+        if s3_group and local_group:
+            # Files with commmon names regardles of path
+            common_names.add(name, join_paths(s3_group, s3_directories) + " <--> " + join_paths(local_group, local_directories))
+        elif s3_group:
+            s3_only.extend(s3_group)
+        else:
+            local_only.extend(local_group)
+
+def unmatched(records: Iterable[Record], directories: DirectoryTable, matched: Set[str]) -> Iterator[Tuple[str, Record]]:
+    """Yields (path, record) for each record whose path hasn't been matched yet."""
+    for record in records:
+        path = directories.join(record[1], record[0])
+        if path not in matched:
+            yield path, record
+
+def match_content(s3_only: RecordSpool, local_only: RecordSpool, s3_directories: DirectoryTable, local_directories: DirectoryTable,
+                  matched_keys: Set[str], matched_paths: Set[str], part_sizes: List[int], workers: int,
+                  index: Optional[ScanIndex] = None) -> List[Tuple[str, str]]:
+    """Finds files with identical content but different names, by comparing S3 ETags with local hashes.
+
+    Returns (s3_key, local_path) pairs for files not already in matched_keys and matched_paths.
+    """
+    s3_objects = ({'Key': key, 'Size': size, 'ETag': etag}
+                  for key, (_, _, size, etag) in unmatched(s3_only, s3_directories, matched_keys))
+    local_candidates = ((path, size) for path, (_, _, size, _) in unmatched(local_only, local_directories, matched_paths))
+    return find_content_matches(s3_objects, local_candidates, part_sizes, workers, index)
+
+def match_exif(s3_only: RecordSpool, local_only: RecordSpool, s3_directories: DirectoryTable, local_directories: DirectoryTable,
+               matched_keys: Set[str], matched_paths: Set[str], bucket_name: str, workers: int, range_bytes: int,
+               index: Optional[ScanIndex] = None) -> List[Tuple[str, str]]:
+    """Finds files with identical EXIF data but different names, reading only the JPEG headers.
+
+    Only non-empty files with a JPEG extension are read. Returns (s3_key, local_path) pairs for files not already in matched_keys and matched_paths.
+    """
+    # boto3 clients are thread-safe; size the connection pool to match the workers
+    s3 = instrument_s3_client(boto3.client('s3', config=BotoConfig(max_pool_connections=workers)))
+    s3_keys = (key for key, (_, _, size, _) in unmatched(s3_only, s3_directories, matched_keys)
+               if is_exif_candidate(key, size))
+    local_paths = (path for path, (_, _, size, _) in unmatched(local_only, local_directories, matched_paths)
+                   if is_exif_candidate(path, size))
+    return find_exif_matches(s3, bucket_name, s3_keys, local_paths, workers, range_bytes, index)
+
+def add_matches(section: ReportSection, matches: List[Tuple[str, str]], matched_keys: Set[str], matched_paths: Set[str]):
+    """Writes one line per matched S3 object to section, and records the matched keys and paths."""
+    paths_by_key = defaultdict(list)
+    for s3_key, local_path in matches:
+        paths_by_key[s3_key].append(local_path)
+        matched_paths.add(local_path)
+    for s3_key in sorted(paths_by_key):
+        section.add(s3_key.rsplit('/', 1)[-1], s3_key + " <--> " + ", ".join(paths_by_key[s3_key]))
+        matched_keys.add(s3_key)
+
+def add_unmatched(section: ReportSection, records: Iterable[Record], directories: DirectoryTable, matched: Set[str], suffix: str):
+    """Writes one line per file name to section, listing the paths with that name that weren't matched."""
+    for name, group in itertools.groupby(unmatched(records, directories, matched), key=lambda item: item[1][0]):
+        section.add(name, ", ".join(path for path, _ in group) + suffix)
 
 def main():
     try:
@@ -114,19 +219,73 @@ def main():
         
     
 
+    # Stage timers, progress line and metrics file; written out however the run ends
+    start_run(config['instrumentation'], 'compare-locations')
+
     BUCKET_NAME = config['bucket_name']
     START_FOLDER = config['start_folder']
     LOCAL_FOLDER = config['local_folder']
+    MATCH_CONTENT = config['match_content']
+    MATCH_EXIF = config['match_exif']
 
-    s3_files = get_s3_files(BUCKET_NAME, START_FOLDER)
-    local_files = get_local_files(LOCAL_FOLDER)
+    SCAN_INDEX_FILE = config['scan_index_file']
+    SORT_BUFFER_RECORDS = config['sort_buffer_records']
 
-    common_names, s3_only, local_only = compare_files(s3_files, local_files, BUCKET_NAME)
-    
-    with open("Compare "+sanitize_filename(START_FOLDER)+".txt", "w") as f:
-        list_results(f"Files with common names ({len(common_names)}):", common_names, f)
-        list_results(f"Files in S3 but not in local ({len(s3_only)}):", s3_only, f)
-        list_results(f"Files in local but not in S3 ({len(local_only)}):", local_only, f)
+    # Remembers sizes, hashes and EXIF data of unchanged local files between runs
+    index = ScanIndex(SCAN_INDEX_FILE, config['trust_directory_mtimes']) if SCAN_INDEX_FILE else None
+
+    with tempfile.TemporaryDirectory(prefix='compare-', dir=config['spill_directory'] or None) as spill_directory:
+        # Both sides are sorted by file name, spilling to disk if they're large, then joined
+        # The listings only run as the join consumes them, so the compare_names stage includes them and the sorts
+        s3_directories, local_directories = DirectoryTable(), DirectoryTable()
+        s3_records = external_sort(metrics.iterate('list_s3', get_s3_files(BUCKET_NAME, START_FOLDER, s3_directories, config['list_workers'],
+                                                                           config['inventory_manifest'])), SORT_BUFFER_RECORDS, spill_directory)
+        local_records = external_sort(metrics.iterate('walk_local', get_local_files(LOCAL_FOLDER, local_directories, index, config['walk_workers'])),
+                                      SORT_BUFFER_RECORDS, spill_directory)
+        common_names = ReportSection(spill_directory)
+        s3_only, local_only = RecordSpool(spill_directory), RecordSpool(spill_directory)
+        metrics.start_progress("Listing S3 objects and local files")
+        with metrics.stage('compare_names'):
+            compare_files(s3_records, local_records, s3_directories, local_directories, common_names, s3_only, local_only)
+        logging.info(f"{common_names.count} common names; {s3_only.count} S3 objects and {local_only.count} local files "
+                     f"with names found on one side only.")
+
+        matched_keys, matched_paths = set(), set()
+        if MATCH_CONTENT:
+            # Files that were renamed: same content, different names. Needs no S3 downloads.
+            identical_content = ReportSection(spill_directory)
+            with metrics.stage('match_content'):
+                add_matches(identical_content, match_content(s3_only, local_only, s3_directories, local_directories, matched_keys,
+                                                             matched_paths, config['multipart_part_sizes'], config['hash_workers'], index),
+                            matched_keys, matched_paths)
+
+        if MATCH_EXIF:
+            # Files with different names whose EXIF data is identical (e.g. edited copies)
+            identical_exif = ReportSection(spill_directory)
+            with metrics.stage('match_exif'):
+                add_matches(identical_exif, match_exif(s3_only, local_only, s3_directories, local_directories, matched_keys,
+                                                       matched_paths, BUCKET_NAME, config['exif_workers'], config['exif_range_bytes'], index),
+                            matched_keys, matched_paths)
+
+        if index:
+            index.log_stats()
+            index.close()
+
+        with metrics.stage('report'):
+            s3_unmatched, local_unmatched = ReportSection(spill_directory), ReportSection(spill_directory)
+            add_unmatched(s3_unmatched, s3_only, s3_directories, matched_keys, " not matched locally")
+            add_unmatched(local_unmatched, local_only, local_directories, matched_paths, " not matched in S3")
+            s3_only.close()
+            local_only.close()
+
+            with open("Compare "+sanitize_filename(START_FOLDER)+".txt", "w") as f:
+                common_names.write("Files with common names", f)
+                if MATCH_CONTENT:
+                    identical_content.write("Files with identical content but different names", f)
+                if MATCH_EXIF:
+                    identical_exif.write("Files with identical EXIF data but different names", f)
+                s3_unmatched.write("Files in S3 but not in local", f)
+                local_unmatched.write("Files in local but not in S3", f)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
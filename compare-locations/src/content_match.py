@@ -0,0 +1,162 @@
+import hashlib
+import logging
+import math
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from instrumentation import metrics
+
+# Content matching against S3 without downloading anything: S3 already lists an ETag for
+# every object. For a single-part upload the ETag is the MD5 of the object; for a multipart
+# upload it is the MD5 of the parts' binary MD5s followed by "-<number of parts>". Local
+# files are hashed the same way and compared with the listed ETags.
+# Objects encrypted with SSE-KMS or SSE-C have ETags that aren't MD5s, so they never match.
+
+MIB = 1024 * 1024
+READ_CHUNK_BYTES = MIB
+MAX_INFERRED_PART_SIZES = 8 # Per object; most uploaders use a whole number of MiB per part
+
+SINGLE_PART = 0 # Stands for "plain MD5" wherever a part size is expected
+
+
+def parse_etag(etag: str) -> Tuple[str, int]:
+    """Splits an S3 ETag into (hex digest, part count). The part count is 0 for a single-part upload."""
+    etag = etag.strip('"').lower()
+    digest, _, parts = etag.partition('-')
+    return digest, int(parts) if parts.isdigit() else 0
+
+
+def candidate_part_sizes(object_size: int, part_count: int, configured: List[int]) -> List[int]:
+    """Part sizes that would split object_size bytes into exactly part_count parts.
+
+    Configured sizes come first, followed by whole numbers of MiB inferred from the size
+    and part count, smallest first.
+    """
+    def fits(part_size):
+        return part_size > 0 and math.ceil(object_size / part_size) == part_count
+
+    sizes = [part_size for part_size in configured if fits(part_size)]
+    part_size = math.ceil(object_size / part_count / MIB) * MIB
+    while fits(part_size) and len(sizes) < len(configured) + MAX_INFERRED_PART_SIZES:
+        if part_size not in sizes:
+            sizes.append(part_size)
+        part_size += MIB
+    return sizes
+
+
+class MultipartHasher:
+    """Computes the multipart-upload ETag of a stream for one part size."""
+
+    def __init__(self, part_size: int):
+        self.part_size = part_size
+        self.part_digests = []
+        self._part = hashlib.md5()
+        self._part_filled = 0
+
+    def update(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.part_size - self._part_filled)
+            self._part.update(view[:take])
+            self._part_filled += take
+            view = view[take:]
+            if self._part_filled == self.part_size:
+                self.part_digests.append(self._part.digest())
+                self._part = hashlib.md5()
+                self._part_filled = 0
+
+    def etag(self) -> str:
+        digests = self.part_digests + ([self._part.digest()] if self._part_filled else [])
+        return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def local_etags(path: str, part_sizes: Iterable[int]) -> Optional[Dict[int, str]]:
+    """Reads a file once and returns {part size: ETag} for each requested part size.
+
+    SINGLE_PART gives the plain MD5. Returns None if the file can't be read. hashlib
+    releases the GIL while hashing each chunk, so this runs in parallel on threads.
+    """
+    hashers = {}
+    for part_size in part_sizes:
+        hashers[part_size] = hashlib.md5() if part_size == SINGLE_PART else MultipartHasher(part_size)
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(READ_CHUNK_BYTES)
+                if not chunk:
+                    break
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+    except OSError as e:
+        logging.warning(f"Failed to read {path} for hashing: {e}")
+        return None
+    return {part_size: hasher.hexdigest() if part_size == SINGLE_PART else hasher.etag()
+            for part_size, hasher in hashers.items()}
+
+
+def find_content_matches(s3_objects: Iterable[Dict], local_files: Iterable[Tuple[str, int]],
+                         configured_part_sizes: List[int], workers: int, index=None) -> List[Tuple[str, str]]:
+    """Matches local files to S3 objects with the same content, using only the listed ETags.
+
+    s3_objects are list_objects_v2 entries (Key, Size, ETag); local_files are (path, size).
+    Only local files with the same size as some S3 object are read, each exactly once.
+    With a ScanIndex, ETags of unchanged files are taken from the index instead.
+
+    Returns (s3_key, local_path) pairs, in the order of local_files.
+    """
+    # size -> part size needed to check that size (SINGLE_PART for plain MD5) -> ETag -> keys
+    wanted = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+    for obj in s3_objects:
+        if not obj.get('ETag') or not obj['Size']:
+            continue
+        digest, part_count = parse_etag(obj['ETag'])
+        if part_count == 0:
+            wanted[obj['Size']][SINGLE_PART][digest].append(obj['Key'])
+        else:
+            etag = f"{digest}-{part_count}"
+            part_sizes = candidate_part_sizes(obj['Size'], part_count, configured_part_sizes)
+            if not part_sizes:
+                logging.debug(f"No part size gives {part_count} parts for {obj['Key']}")
+            for part_size in part_sizes:
+                wanted[obj['Size']][part_size][etag].append(obj['Key'])
+
+    candidates = [(path, size) for path, size in local_files if size in wanted]
+    indexed_etags = {}
+    if index:
+        for path, size in candidates:
+            etags = index.get_etags(path, wanted[size].keys())
+            if etags:
+                indexed_etags[path] = etags
+    to_hash = [(path, size) for path, size in candidates if path not in indexed_etags]
+    hashed_bytes = sum(size for _, size in to_hash)
+    logging.info(f"Hashing {len(to_hash)} local files ({hashed_bytes / 1e6:.1f} MB) "
+                 f"with the same size as an S3 object, using {workers} threads"
+                 f"{f' ({len(indexed_etags)} more from the scan index)' if index else ''}...")
+
+    def hash_candidate(candidate):
+        path, size = candidate
+        if path in indexed_etags:
+            return indexed_etags[path]
+        return local_etags(path, wanted[size].keys())
+
+    matches = []
+    metrics.start_progress("Hashing local files", len(candidates))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hash') as executor:
+        for (path, size), etags in zip(candidates, executor.map(hash_candidate, candidates)):
+            metrics.advance()
+            if not etags:
+                continue
+            if path not in indexed_etags:
+                metrics.count('files_hashed')
+                metrics.count('bytes_hashed', size)
+                if index:
+                    index.put_etags(path, etags) # Back on the main thread, which owns the index
+            matched_keys: Set[str] = set()
+            for part_size, etag in etags.items():
+                for key in wanted[size][part_size].get(etag, []):
+                    if key not in matched_keys:
+                        matched_keys.add(key)
+                        matches.append((key, path))
+    logging.info(f"Found {len(matches)} content matches.")
+    return matches
@@ -0,0 +1,142 @@
+import io
+import logging
+import os
+import struct
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import exifread
+
+from jpeg_exif import read_exif_segment, DEFAULT_HEADER_BYTES
+from instrumentation import metrics
+
+# Matching by EXIF data: only the APP1 segment at the start of each JPEG is read (ranged
+# GETs from S3, a bounded read locally), and files are matched through a dict keyed by
+# a fingerprint of the tags below, rather than by comparing every pair of files.
+
+# Tags that identify a shot; DateTimeOriginal is required, the others are used when present
+FINGERPRINT_TAGS = (
+    'EXIF DateTimeOriginal',
+    'EXIF SubSecTimeOriginal',
+    'Image Make',
+    'Image Model',
+    'EXIF BodySerialNumber',
+    'EXIF ExifImageWidth',
+    'EXIF ExifImageLength',
+)
+
+# Only JPEGs carry an APP1 segment where it is looked for; compared in lower case
+JPEG_EXTENSIONS = {'.jpg', '.jpeg', '.jpe', '.jif', '.jfif', '.jfi'}
+
+# Bytes transferred from S3, updated from the worker threads
+transfer_stats = defaultdict(int)
+transfer_stats_lock = threading.Lock()
+
+
+def is_exif_candidate(name: str, size: int) -> bool:
+    """True for a non-empty file with a JPEG extension; other files (videos, RAW, sidecars,
+    folder markers) aren't worth a header read."""
+    return size > 0 and os.path.splitext(name)[1].lower() in JPEG_EXTENSIONS
+
+
+def exif_fingerprint(payload: Optional[bytes]) -> str:
+    """Returns a fingerprint of an EXIF APP1 payload, or '' if it has no DateTimeOriginal."""
+    if not payload:
+        return ''
+    # exifread wants a JPEG, so wrap the payload in a minimal one: SOI then the APP1 segment
+    segment = b'\xff\xd8\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+    try:
+        tags = exifread.process_file(io.BytesIO(segment), details=False) # Skips maker notes and thumbnails
+    except Exception as e:
+        logging.debug(f"Failed to parse EXIF data: {e}")
+        return ''
+    if 'EXIF DateTimeOriginal' not in tags:
+        return ''
+    return '|'.join(str(tags[tag]).strip() if tag in tags else '' for tag in FINGERPRINT_TAGS)
+
+
+def s3_exif_fingerprint(s3_client, bucket_name: str, object_key: str, initial_bytes: int) -> str:
+    """Fingerprints an S3 object from ranged GETs of its first bytes, retrying larger if APP1 is cut off."""
+    def read_prefix(length):
+        response = s3_client.get_object(Bucket=bucket_name, Key=object_key, Range=f"bytes=0-{length - 1}")
+        data = response['Body'].read()
+        with transfer_stats_lock:
+            transfer_stats['requests'] += 1
+            transfer_stats['bytes_downloaded'] += len(data)
+        return data
+
+    try:
+        payload, _ = read_exif_segment(read_prefix, initial_bytes)
+    except Exception as e:
+        logging.warning(f"Failed to read EXIF data of s3://{bucket_name}/{object_key}: {e}")
+        return ''
+    return exif_fingerprint(payload)
+
+
+def local_exif_fingerprint(path: str, initial_bytes: int) -> Optional[str]:
+    """Fingerprints a local file from a bounded read of its header. Returns None if it can't be read."""
+    try:
+        with open(path, 'rb') as f:
+            def read_prefix(length):
+                f.seek(0)
+                return f.read(length)
+            payload, _ = read_exif_segment(read_prefix, initial_bytes)
+    except OSError as e:
+        logging.warning(f"Failed to read EXIF data of {path}: {e}")
+        return None
+    return exif_fingerprint(payload)
+
+
+def find_exif_matches(s3_client, bucket_name: str, s3_keys: Iterable[str], local_paths: Iterable[str],
+                      workers: int, initial_bytes: int = DEFAULT_HEADER_BYTES, index=None) -> List[Tuple[str, str]]:
+    """Matches S3 objects and local files with the same EXIF fingerprint.
+
+    Local headers are read first (or taken from a ScanIndex), and S3 objects are only read
+    if some local file has a fingerprint. Reads run on a pool of workers threads.
+
+    Returns (s3_key, local_path) pairs.
+    """
+    local_paths = list(local_paths)
+    local_fingerprints: Dict[str, str] = {}
+    to_read = []
+    for path in local_paths:
+        fingerprint = index.get_exif_fingerprint(path) if index else None
+        if fingerprint is None:
+            to_read.append(path)
+        else:
+            local_fingerprints[path] = fingerprint
+
+    s3_keys = list(s3_keys)
+    logging.info(f"Reading EXIF headers of {len(to_read)} local files"
+                 f"{f' ({len(local_fingerprints)} more from the scan index)' if index else ''}...")
+    metrics.start_progress("Reading local EXIF headers", len(to_read))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='exif') as executor:
+        for path, fingerprint in zip(to_read, executor.map(lambda path: local_exif_fingerprint(path, initial_bytes), to_read)):
+            metrics.advance()
+            if fingerprint is None:
+                continue
+            local_fingerprints[path] = fingerprint
+            if index:
+                index.put_exif_fingerprint(path, fingerprint) # Back on the main thread, which owns the index
+
+        paths_by_fingerprint = defaultdict(list)
+        for path in local_paths:
+            if local_fingerprints.get(path):
+                paths_by_fingerprint[local_fingerprints[path]].append(path)
+        if not paths_by_fingerprint:
+            logging.info("No local files have EXIF data to match, so S3 objects are not read.")
+            return []
+
+        logging.info(f"Reading EXIF headers of {len(s3_keys)} S3 objects with ranged GETs using {workers} threads...")
+        matches = []
+        metrics.start_progress("Reading S3 EXIF headers", len(s3_keys))
+        fingerprints = executor.map(lambda key: s3_exif_fingerprint(s3_client, bucket_name, key, initial_bytes), s3_keys)
+        for key, fingerprint in zip(s3_keys, fingerprints):
+            metrics.advance()
+            for path in paths_by_fingerprint.get(fingerprint, []) if fingerprint else []:
+                matches.append((key, path))
+    logging.info(f"Found {len(matches)} EXIF matches. Read {transfer_stats['bytes_downloaded'] / 1e6:.1f} MB "
+                 f"from S3 in {transfer_stats['requests']} ranged GETs.")
+    return matches
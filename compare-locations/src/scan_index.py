@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import sqlite3
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from parallel_walk import walk_directories, list_directory, DirectoryListing, DEFAULT_WORKERS
+
+# A persistent index of a local tree, so repeated comparisons over slow (NAS) mounts don't
+# re-read files that haven't changed. Rows are keyed by path and only trusted while the
+# file's size and modification time are the same as when it was indexed; anything computed
+# from a file's content (hashes, EXIF fingerprints) is dropped as soon as either changes.
+
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER, run INTEGER);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, directory TEXT, name TEXT, size INTEGER, mtime_ns INTEGER,
+    etags TEXT, exif_fingerprint TEXT, run INTEGER);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+"""
+
+
+class ScanIndex:
+    """SQLite index of the files under local folders, with hashes and EXIF fingerprints.
+
+    scan() walks a folder, reusing what is known about unchanged files and pruning rows for
+    files that have gone. Not thread-safe: use it from the main thread only.
+    """
+
+    def __init__(self, path: str, trust_directory_mtimes: bool = False):
+        self.path = path
+        self.trust_directory_mtimes = trust_directory_mtimes
+        self.files_unchanged = 0 # Files whose rows were still valid
+        self.files_not_statted = 0 # Files listed from the index without touching the disk
+        self.content_hits = 0 # Hashes or fingerprints served from the index
+        self.content_misses = 0
+        self._db = sqlite3.connect(path)
+        self._db.executescript(_SCHEMA)
+        version = self._get_meta('schema_version')
+        if version is not None and int(version) != SCHEMA_VERSION:
+            logging.info(f"Scan index {path} is from a different version; rebuilding it.")
+            self._db.executescript("DROP TABLE files; DROP TABLE directories; DELETE FROM meta;")
+            self._db.executescript(_SCHEMA)
+        self._set_meta('schema_version', SCHEMA_VERSION)
+        self.run = int(self._get_meta('last_run') or 0) + 1
+        self._db.commit()
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def scan(self, directory: str, workers: int = DEFAULT_WORKERS) -> Iterator[Tuple[str, int]]:
+        """Walks directory, yielding (path, size) for every file, and updates the index.
+
+        Directories are listed on workers threads with parallel_walk. With
+        trust_directory_mtimes, a directory whose modification time hasn't changed is
+        listed from the index without reading it or stat-ing its files. Adding, removing or
+        renaming a file changes its directory's mtime, but rewriting a file in place does not,
+        so this is only safe for trees where files aren't edited in place (photo archives).
+
+        Rows for files and directories that were not seen are deleted once the walk completes.
+        Paths are stored as they are walked, so directory should be absolute for the rows to
+        be found again from another working directory.
+        """
+        root = directory
+        list_function = list_directory
+        if self.trust_directory_mtimes:
+            # Snapshot of the directory rows, so the walker threads never touch the database
+            known_mtimes = {}
+            children = defaultdict(list)
+            for path, parent, mtime_ns in self._db.execute("SELECT path, parent, mtime_ns FROM directories"):
+                known_mtimes[path] = mtime_ns
+                children[parent].append(path)
+
+            def list_function(path):
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except OSError as e:
+                    logging.warning(f"Failed to stat directory {path}: {e}")
+                    return None
+                if known_mtimes.get(path) == mtime_ns:
+                    return DirectoryListing(path, mtime_ns, None, sorted(children[path]))
+                return list_directory(path)
+
+        for listing in walk_directories(root, workers, list_function):
+            if listing.files is None: # Unchanged since the last run
+                files = self._db.execute("SELECT path, size FROM files WHERE directory = ?", (listing.path,)).fetchall()
+                self._db.execute("UPDATE files SET run = ? WHERE directory = ?", (self.run, listing.path))
+                self.files_unchanged += len(files)
+                self.files_not_statted += len(files)
+                yield from files
+            else:
+                yield from self._update_directory(listing)
+            self._db.execute("INSERT OR REPLACE INTO directories (path, parent, mtime_ns, run) VALUES (?, ?, ?, ?)",
+                             (listing.path, os.path.dirname(listing.path) if listing.path != root else None,
+                              listing.mtime_ns, self.run))
+        self._prune(root)
+        self._set_meta('last_run', self.run)
+        self._db.commit()
+
+    def _update_directory(self, listing: DirectoryListing) -> Iterator[Tuple[str, int]]:
+        """Updates the rows of the files in a fresh directory listing."""
+        known = {name: (size, mtime_ns) for name, size, mtime_ns in self._db.execute(
+            "SELECT name, size, mtime_ns FROM files WHERE directory = ?", (listing.path,))}
+        for entry in listing.files:
+            if known.get(entry.name) == (entry.size, entry.mtime_ns):
+                self.files_unchanged += 1
+                self._db.execute("UPDATE files SET run = ? WHERE path = ?", (self.run, entry.path))
+            else: # New or changed: forget anything computed from the old content
+                self._db.execute(
+                    "INSERT OR REPLACE INTO files (path, directory, name, size, mtime_ns, etags, exif_fingerprint, run) "
+                    "VALUES (?, ?, ?, ?, ?, NULL, NULL, ?)",
+                    (entry.path, listing.path, entry.name, entry.size, entry.mtime_ns, self.run))
+            yield entry.path, entry.size
+
+    def _prune(self, root: str):
+        """Deletes rows under root that weren't seen in this run."""
+        # Everything under root/ sorts between root + os.sep and root + the next character
+        below = root.rstrip(os.sep) + os.sep
+        above = root.rstrip(os.sep) + chr(ord(os.sep) + 1)
+        removed = self._db.execute(
+            "DELETE FROM files WHERE run != ? AND path >= ? AND path < ?", (self.run, below, above)).rowcount
+        self._db.execute("DELETE FROM directories WHERE run != ? AND (path = ? OR (path >= ? AND path < ?))",
+                         (self.run, root, below, above))
+        if removed:
+            logging.info(f"Pruned {removed} deleted files from the scan index.")
+
+    def get_etags(self, path: str, part_sizes: Iterable[int]) -> Optional[Dict[int, str]]:
+        """Returns the indexed {part size: ETag} for path if all of part_sizes are known."""
+        row = self._db.execute("SELECT etags FROM files WHERE path = ?", (path,)).fetchone()
+        known = {int(part_size): etag for part_size, etag in json.loads(row[0]).items()} if row and row[0] else {}
+        if all(part_size in known for part_size in part_sizes):
+            self.content_hits += 1
+            return known
+        self.content_misses += 1
+        return None
+
+    def put_etags(self, path: str, etags: Dict[int, str]):
+        """Adds ETags (see content_match.local_etags) to the row for path."""
+        row = self._db.execute("SELECT etags FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return # Not indexed by scan(), e.g. failed to stat
+        known = json.loads(row[0]) if row[0] else {}
+        known.update({str(part_size): etag for part_size, etag in etags.items()})
+        self._db.execute("UPDATE files SET etags = ? WHERE path = ?", (json.dumps(known), path))
+
+    def get_exif_fingerprint(self, path: str) -> Optional[str]:
+        """Returns the indexed EXIF fingerprint for path; '' means the file has no usable EXIF data."""
+        row = self._db.execute("SELECT exif_fingerprint FROM files WHERE path = ?", (path,)).fetchone()
+        if row and row[0] is not None:
+            self.content_hits += 1
+            return row[0]
+        self.content_misses += 1
+        return None
+
+    def put_exif_fingerprint(self, path: str, fingerprint: str):
+        self._db.execute("UPDATE files SET exif_fingerprint = ? WHERE path = ?", (fingerprint, path))
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def log_stats(self):
+        logging.info(f"Scan index {self.path}: {self.files_unchanged} unchanged files served from the index "
+                     f"({self.files_not_statted} without a stat), {self.content_hits} hashes/fingerprints reused, "
+                     f"{self.content_misses} computed.")
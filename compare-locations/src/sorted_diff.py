@@ -0,0 +1,148 @@
+import heapq
+import itertools
+import logging
+import os
+import pickle
+import tempfile
+from operator import itemgetter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Comparing two very large listings in bounded memory. Each side is sorted by file name
+# with an external sort (sorted runs spilled to disk, then merged), and the two sorted
+# streams are joined group by group, like a sort-merge join in a database. Files are
+# held as compact records (name, directory number, size, ETag), with each directory
+# path stored only once.
+
+DEFAULT_SORT_BUFFER_RECORDS = 500000 # Records sorted in memory before a run is spilled
+SPOOL_CHUNK_RECORDS = 10000 # Records pickled together when writing to disk
+MAX_MERGE_RUNS = 64 # Runs merged at once; more are merged in several passes
+
+Record = Tuple[str, int, int, str] # (name, directory number, size, ETag or '')
+
+
+class DirectoryTable:
+    """Stores each directory (or S3 key prefix) once, so file records only hold its number."""
+
+    def __init__(self):
+        self._numbers: Dict[str, int] = {}
+        self._directories: List[str] = []
+
+    def add(self, path: str, name: str) -> int:
+        """Returns the number of the directory part of path, which ends with name."""
+        directory = path[:len(path) - len(name)] # Keeps the trailing separator, so join() is exact
+        number = self._numbers.get(directory)
+        if number is None:
+            number = self._numbers[directory] = len(self._directories)
+            self._directories.append(directory)
+        return number
+
+    def join(self, number: int, name: str) -> str:
+        return self._directories[number] + name
+
+    def __len__(self):
+        return len(self._directories)
+
+
+class RecordSpool:
+    """Records appended to a temporary file in pickled chunks, then read back in the same order."""
+
+    def __init__(self, directory: Optional[str] = None):
+        fd, self.path = tempfile.mkstemp(prefix='spool-', suffix='.pickle', dir=directory)
+        self._file = os.fdopen(fd, 'wb')
+        self._chunk: List[Any] = []
+        self.count = 0
+
+    def append(self, record):
+        self._chunk.append(record)
+        self.count += 1
+        if len(self._chunk) >= SPOOL_CHUNK_RECORDS:
+            self._flush()
+
+    def extend(self, records: Iterable):
+        for record in records:
+            self.append(record)
+
+    def _flush(self):
+        if self._chunk:
+            pickle.dump(self._chunk, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+            self._chunk = []
+
+    def __iter__(self) -> Iterator:
+        self._flush()
+        self._file.flush()
+        with open(self.path, 'rb') as f: # A separate handle, so the spool can be read more than once
+            while True:
+                try:
+                    chunk = pickle.load(f)
+                except EOFError:
+                    return
+                yield from chunk
+
+    def close(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def external_sort(records: Iterable, buffer_records: int = DEFAULT_SORT_BUFFER_RECORDS,
+                  spill_directory: Optional[str] = None) -> Iterator:
+    """Yields records in sorted order, holding at most buffer_records of them in memory.
+
+    If there are more, sorted runs are spilled to spill_directory and merged with
+    heapq.merge, in several passes if there are more than MAX_MERGE_RUNS runs.
+    """
+    runs: List[RecordSpool] = []
+    try:
+        buffer = []
+        for record in records:
+            buffer.append(record)
+            if len(buffer) >= buffer_records:
+                buffer.sort()
+                runs.append(RecordSpool(spill_directory))
+                runs[-1].extend(buffer)
+                buffer = []
+        buffer.sort()
+        if not runs:
+            yield from buffer
+            return
+        if buffer:
+            runs.append(RecordSpool(spill_directory))
+            runs[-1].extend(buffer)
+            buffer = []
+        logging.info(f"Sorted {sum(run.count for run in runs)} records in {len(runs)} runs spilled to disk.")
+        while len(runs) > MAX_MERGE_RUNS:
+            merging, runs = runs[:MAX_MERGE_RUNS], runs[MAX_MERGE_RUNS:]
+            merged = RecordSpool(spill_directory)
+            merged.extend(heapq.merge(*merging))
+            for run in merging:
+                run.close()
+            runs.append(merged)
+        yield from heapq.merge(*runs)
+    finally:
+        for run in runs:
+            run.close()
+
+
+def merge_join(left: Iterable[Record], right: Iterable[Record]) -> Iterator[Tuple[str, List[Record], List[Record]]]:
+    """Joins two streams of records sorted by name.
+
+    Yields (name, left records, right records) for every name in either stream, in name
+    order. Files with the same name on one side are kept together as a group.
+    """
+    left_groups = itertools.groupby(left, key=itemgetter(0))
+    right_groups = itertools.groupby(right, key=itemgetter(0))
+    left_group = next(left_groups, None)
+    right_group = next(right_groups, None)
+    while left_group is not None or right_group is not None:
+        if right_group is None or (left_group is not None and left_group[0] < right_group[0]):
+            yield left_group[0], list(left_group[1]), []
+            left_group = next(left_groups, None)
+        elif left_group is None or right_group[0] < left_group[0]:
+            yield right_group[0], [], list(right_group[1])
+            right_group = next(right_groups, None)
+        else:
+            yield left_group[0], list(left_group[1]), list(right_group[1])
+            left_group = next(left_groups, None)
+            right_group = next(right_groups, None)
@@ -1,4 +1,6 @@
 import boto3
+from botocore.config import Config as BotoConfig
+import hashlib
 import io
 from pathlib import Path
 import os
@@ -11,7 +13,23 @@ from reportlab.lib.utils import ImageReader
 import logging
 import re # For sanitizing filename
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+import itertools
 import math
+import multiprocessing
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'shared' / 'src'))
+from jpeg_exif import read_exif_segment, exif_thumbnail
+from thumbnail_cache import ThumbnailCache, log_cache_stats
+import fragments
+from sprite_pages import SpritePageCanvas, PAGE_IMAGE_FORMATS
+from s3_listing import list_objects, read_inventory
+from ordered_map import map_in_order
+from instrumentation import metrics, instrument_s3_client, read_instrumentation_config, start_run
 
 # --- Configuration ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,6 +37,10 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 CONFIG_FILE = 'config.ini'
 VALID_JPEG_EXTENSIONS = {'.jpg', '.jpeg', '.jpe', '.jif', '.jfif', '.jfi', '.JPG', '.JPEG', '.JPE'}
 
+# Bytes transferred from S3, updated from the download threads
+transfer_stats = defaultdict(int)
+transfer_stats_lock = threading.Lock()
+
 # --- Helper Functions ---
 
 def read_config(filename=CONFIG_FILE):
@@ -33,15 +55,40 @@ def read_config(filename=CONFIG_FILE):
     try:
         s3_config = config['S3']
         layout_config = config['Layout']
+        if not config.has_section('Performance'):
+            config.add_section('Performance') # All performance settings are optional
+        performance_config = config['Performance']
         return {
             'bucket_name': s3_config['BucketName'],
             'start_folder': s3_config['StartFolder'],
             'output_file': s3_config['OutputFile'],
+            'inventory_manifest': os.path.expanduser(s3_config.get('InventoryManifest', '')), # Empty lists the bucket
             'columns': int(layout_config.get('Columns', 4)),
             'rows': int(layout_config.get('Rows', 6)),
             'margin': float(layout_config.get('Margin', 36)), # Points
             'header_font_size': int(layout_config.get('HeaderFontSize', 12)),
             'filename_font_size': int(layout_config.get('FilenameFontSize', 8)),
+            'download_workers': max(1, int(performance_config.get('DownloadWorkers', 8))),
+            'prefetch_window': max(1, int(performance_config.get('PrefetchWindow', 32))),
+            'use_embedded_thumbnails': performance_config.getboolean('UseEmbeddedThumbnails', False),
+            'thumbnail_dpi': max(72.0, float(performance_config.get('ThumbnailDPI', 72))), # Never draw a thumbnail scaled up
+            'thumbnail_range_bytes': max(1024, int(performance_config.get('ThumbnailRangeBytes', 65536))),
+            'image_dpi': max(0.0, float(performance_config.get('ImageDPI', 150))), # 0 embeds the original images
+            'jpeg_quality': min(95, max(1, int(performance_config.get('JpegQuality', 80)))),
+            'thumbnail_cache_directory': os.path.expanduser(performance_config.get('ThumbnailCacheDirectory', '')), # Empty disables the cache
+            'thumbnail_cache_max_bytes': int(float(performance_config.get('ThumbnailCacheMaxMB', 1024)) * 1024 * 1024),
+            'stream_listing': performance_config.getboolean('StreamListing', False),
+            'list_workers': max(1, int(performance_config.get('ListWorkers', 1))),
+            'fragment_directory': os.path.expanduser(performance_config.get('FragmentDirectory', '')), # Empty renders in one go
+            'render_workers': max(1, int(performance_config.get('RenderWorkers', 1))),
+            'stream_output': performance_config.getboolean('StreamOutput', False),
+            'pages_per_fragment': max(1, int(performance_config.get('PagesPerFragment', 50))),
+            'max_volume_pages': max(0, int(performance_config.get('MaxVolumePages', 0))), # 0 is no limit
+            'max_volume_bytes': int(max(0.0, float(performance_config.get('MaxVolumeMB', 0))) * 1024 * 1024),
+            'sprite_dpi': max(0.0, float(performance_config.get('SpriteDPI', 0))), # 0 draws every image separately
+            'sprite_page_directory': os.path.expanduser(performance_config.get('SpritePageDirectory', '')),
+            'sprite_page_format': performance_config.get('SpritePageFormat', 'jpeg').strip().lower(),
+            'instrumentation': read_instrumentation_config(config, 'contact_sheet_metrics.json'),
         }
     except KeyError as e:
         logging.error(f"Missing configuration key: {e}")
@@ -62,21 +109,34 @@ def sanitize_filename(name):
     # name = name.replace(' ', '_')
     return name if name else "default"
 
+def page_image_name(folder_path):
+    """Names a folder's standalone page images.
 
+    Different folders can sanitize to the same name (a/b/ and a_b/), so a short hash of
+    the folder path keeps them apart. It stays the same across runs, unlike a folder index.
+    """
+    digest = hashlib.sha256(folder_path.encode('utf-8')).hexdigest()[:8]
+    return f"{sanitize_filename(folder_path)}_{digest}"
 
-def list_s3_objects_recursive(s3_client, bucket_name, prefix):
-    """Recursively lists objects in an S3 prefix."""
-    objects = []
-    paginator = s3_client.get_paginator('list_objects_v2')
-    page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
 
+def list_s3_objects_recursive(s3_client, bucket_name, prefix, list_workers=1, inventory_manifest=''):
+    """Recursively lists objects in an S3 prefix.
+
+    Sub-prefixes are listed on list_workers threads, in the same key order. With an
+    inventory_manifest, keys are read from a downloaded S3 Inventory report instead.
+    """
+    objects = []
     try:
-        for page in page_iterator:
-            if "Contents" in page:
-                for obj in page['Contents']:
-                    # Ignore objects that are effectively 'folders' (size 0, end with /)
-                    if obj['Size'] > 0 and not obj['Key'].endswith('/'):
-                         objects.append(obj)
+        if inventory_manifest:
+            listing = read_inventory(inventory_manifest, prefix)
+        else:
+            listing = list_objects(s3_client, bucket_name, prefix, list_workers)
+        for obj in metrics.iterate('listing', listing):
+            metrics.count('objects_listed')
+            metrics.advance()
+            # Ignore objects that are effectively 'folders' (size 0, end with /)
+            if obj['Size'] > 0 and not obj['Key'].endswith('/'):
+                 objects.append(obj)
     except s3_client.exceptions.NoSuchBucket:
         logging.error(f"S3 Bucket '{bucket_name}' not found or access denied.")
         raise
@@ -85,6 +145,93 @@ def list_s3_objects_recursive(s3_client, bucket_name, prefix):
         raise
     return objects
 
+def is_jpeg_key(key):
+    """True if the object key has one of the JPEG file extensions."""
+    _, ext = os.path.splitext(key)
+    return ext.lower() in VALID_JPEG_EXTENSIONS
+
+def folder_for_key(key, start_folder):
+    """Returns the folder an object is grouped under: its parent 'directory' with a trailing slash."""
+    # Group by the immediate parent directory
+    folder = os.path.dirname(key)
+    # Handle root folder case
+    if not folder and start_folder in ('', '/'):
+         folder = '/' # Represent root explicitly if needed
+    elif folder == start_folder.rstrip('/'): # Handle case where start folder itself has images
+         folder = start_folder.rstrip('/')
+    # Ensure consistent trailing slash for comparison, except for root
+    if folder != '/':
+        folder = folder.rstrip('/') + '/'
+    return folder
+
+def list_s3_folder(s3_client, bucket_name, prefix):
+    """Lists one level of an S3 prefix using Delimiter='/'.
+
+    Returns (image_objects, sub_prefixes): the JPEG objects directly under the prefix,
+    and the 'sub-folder' prefixes below it.
+    """
+    image_objects = []
+    sub_prefixes = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    try:
+        for page in metrics.iterate('listing', paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/')):
+            metrics.count('objects_listed', len(page.get('Contents', [])))
+            for obj in page.get('Contents', []):
+                # Ignore objects that are effectively 'folders' (size 0, end with /)
+                if obj['Size'] > 0 and not obj['Key'].endswith('/'):
+                    if is_jpeg_key(obj['Key']):
+                        image_objects.append(obj)
+                    else:
+                        logging.debug(f"Ignoring non-JPEG file by extension: {obj['Key']}")
+            sub_prefixes.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+    except s3_client.exceptions.NoSuchBucket:
+        logging.error(f"S3 Bucket '{bucket_name}' not found or access denied.")
+        raise
+    except Exception as e:
+        logging.error(f"Error listing S3 objects: {e}")
+        raise
+    return image_objects, sub_prefixes
+
+def iter_image_folders(s3_client, bucket_name, start_folder):
+    """Lists S3 folder by folder, yielding (folder, image_objects) in sorted folder order.
+
+    This is the streaming alternative to list_s3_objects_recursive: only one folder's
+    objects are held at a time, and each folder can be drawn as soon as it is listed.
+    A flat listing can't do this, because a folder's own keys are interleaved with its
+    sub-folders' keys in S3's lexicographic order. A depth-first walk with sorted
+    sub-prefixes gives the same order as sorting the folder names.
+    """
+    def walk(prefix):
+        image_objects, sub_prefixes = list_s3_folder(s3_client, bucket_name, prefix)
+        # Everything directly under one prefix has the same parent folder
+        pending = None
+        if image_objects:
+            image_objects.sort(key=lambda obj: obj['Key'])
+            pending = (folder_for_key(image_objects[0]['Key'], start_folder), image_objects)
+        for sub_prefix in sorted(sub_prefixes):
+            # Below the start folder the pending folder is the prefix itself, so it sorts first.
+            # At the top it can be a parent 'directory' that sorts anywhere among them.
+            if pending and pending[0] < sub_prefix:
+                yield pending
+                pending = None
+            yield from walk(sub_prefix)
+        if pending:
+            yield pending
+
+    return walk(start_folder)
+
+def exit_on_listing_error(image_folders):
+    """Passes a streaming listing through, exiting as a full listing does if S3 fails part way.
+
+    The folders are listed lazily while the earlier ones are drawn, so a failed request
+    surfaces wherever the next folder is asked for, not where the listing started.
+    """
+    try:
+        yield from image_folders
+    except Exception as e:
+        logging.critical(f"Could not list S3 objects. Exiting. Error: {e}")
+        exit(1)
+
 def get_image_from_s3(s3_client, bucket_name, object_key):
     """Downloads an image from S3 into a BytesIO object."""
     try:
@@ -95,14 +242,98 @@ def get_image_from_s3(s3_client, bucket_name, object_key):
         logging.warning(f"Failed to download s3://{bucket_name}/{object_key}: {e}")
         return None
 
+def count_transfer(**amounts):
+    """Adds byte counts to transfer_stats (safe to call from the download threads)."""
+    with transfer_stats_lock:
+        for name, amount in amounts.items():
+            transfer_stats[name] += amount
+
+def take_transfer_stats():
+    """Returns and resets transfer_stats, so a render worker can hand its counts back."""
+    with transfer_stats_lock:
+        stats = dict(transfer_stats)
+        transfer_stats.clear()
+    return stats
+
+def get_image_prefix_from_s3(s3_client, bucket_name, object_key, length):
+    """Downloads the first length bytes of an object with a ranged GET.
+
+    Returns (data, object_size).
+    """
+    response = s3_client.get_object(Bucket=bucket_name, Key=object_key, Range=f"bytes=0-{length - 1}")
+    data = response['Body'].read()
+    # ContentRange looks like "bytes 0-65535/31457280"
+    object_size = int(response['ContentRange'].rsplit('/', 1)[1]) if 'ContentRange' in response else len(data)
+    return data, object_size
+
+def thumbnail_covers_cell(width, height, cell_width, cell_height, dpi):
+    """True if an image of width x height pixels, scaled to fit the cell, has at least dpi resolution."""
+    return 72.0 * max(width / cell_width, height / cell_height) >= dpi
+
+def get_thumbnail_or_image_from_s3(s3_client, bucket_name, object_key, cell_width, cell_height, dpi, range_bytes):
+    """Returns the embedded EXIF thumbnail of an S3 image as a BytesIO, read with ranged GETs.
+
+    Falls back to downloading the whole object (get_image_from_s3) if there is no thumbnail
+    or it is too small to fill a cell_width x cell_height cell at dpi.
+    """
+    object_size = 0
+    bytes_read = 0
+    def read_prefix(length):
+        nonlocal object_size, bytes_read
+        data, object_size = get_image_prefix_from_s3(s3_client, bucket_name, object_key, length)
+        bytes_read += len(data)
+        return data
+
+    try:
+        payload, data = read_exif_segment(read_prefix, initial_bytes=range_bytes)
+    except Exception as e:
+        logging.warning(f"Failed to read EXIF header of s3://{bucket_name}/{object_key}: {e}")
+        payload, data = None, b''
+
+    if data and len(data) >= object_size:
+        # Small enough that the ranged read already fetched the whole object
+        count_transfer(object_bytes=object_size, bytes_downloaded=bytes_read)
+        return io.BytesIO(data)
+
+    thumbnail = exif_thumbnail(payload) if payload else None
+    if thumbnail:
+        try:
+            with Image.open(io.BytesIO(thumbnail)) as img: # Only reads the thumbnail's header
+                width, height = img.size
+        except Exception:
+            width = height = 0
+        if width and thumbnail_covers_cell(width, height, cell_width, cell_height, dpi):
+            count_transfer(object_bytes=object_size, bytes_downloaded=bytes_read, thumbnails_used=1)
+            return io.BytesIO(thumbnail)
+        logging.debug(f"Embedded thumbnail of {object_key} is too small ({width}x{height}), downloading full image")
+    else:
+        logging.debug(f"No embedded thumbnail in {object_key}, downloading full image")
+
+    image_stream = get_image_from_s3(s3_client, bucket_name, object_key)
+    full_size = len(image_stream.getvalue()) if image_stream else 0
+    count_transfer(object_bytes=max(object_size, full_size), bytes_downloaded=bytes_read + full_size, full_downloads=1)
+    return image_stream
+
+def fetch_images_in_order(fetch, items, max_workers, prefetch_window):
+    """Runs fetch(item) on a thread pool and yields (item, result) in the order of items.
+
+    At most prefetch_window fetches are in flight or waiting to be consumed. A failed
+    fetch is simply a None result (get_image_from_s3 never raises), which keeps skipping
+    deterministic.
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='s3-fetch')
+    return map_in_order(executor, fetch, items, prefetch_window)
+
 def is_jpeg(image_stream):
-    """Checks if the image data in the stream is a valid JPEG."""
+    """Checks if the image data in the stream is a JPEG.
+
+    Only the header is parsed; the image is decoded once, when it is drawn. (Image.verify()
+    does nothing for JPEGs, so opening the image a second time to verify it only doubled
+    the work.)
+    """
     try:
-        img = Image.open(image_stream)
-        img.verify()  # Verify closes the file, so reopen for format check
-        image_stream.seek(0)
-        img = Image.open(image_stream)
-        is_jpeg_format = img.format in ('JPEG', 'MPO') # MPO is multi-picture JPEG
+        with Image.open(image_stream) as img:
+            is_jpeg_format = img.format in ('JPEG', 'MPO') # MPO is multi-picture JPEG
         image_stream.seek(0) # Reset stream position for later use
         return is_jpeg_format
     except UnidentifiedImageError:
@@ -112,17 +343,8 @@ def is_jpeg(image_stream):
         # logging.warning(f"Error checking image format: {e}")
         return False
 
-def draw_page_header(c, text, page_width, page_height, margin, font_size):
-    """Draws the header text at the top of the page."""
-    c.setFont("Helvetica-Bold", font_size)
-    header_y = page_height - margin / 2
-    c.drawCentredString(page_width / 2, header_y, text)
-
-def draw_image_and_filename(c, img_reader, filename, x, y, cell_width, cell_height, filename_font_size, text_height_allowance):
-    """Draws a scaled image and its filename within a cell."""
-    img_width, img_height = img_reader.getSize()
-    max_img_height = cell_height - text_height_allowance
-
+def fit_to_cell(img_width, img_height, cell_width, max_img_height):
+    """Returns the (width, height) in points an image is drawn at within a cell."""
     # Calculate scaling factor to fit image within cell bounds (minus text space)
     scale_w = cell_width / img_width
     scale_h = max_img_height / img_height
@@ -131,8 +353,127 @@ def draw_image_and_filename(c, img_reader, filename, x, y, cell_width, cell_heig
     if scale >= 1.0: # Don't scale up
         scale = 1.0
 
-    draw_width = img_width * scale
-    draw_height = img_height * scale
+    return img_width * scale, img_height * scale
+
+def downscale_image(image_stream, cell_width, max_img_height, dpi, quality):
+    """Decodes a JPEG at the size it will be drawn at and re-encodes it.
+
+    Uses Pillow's JPEG draft mode, so the decoder scales by 1/2, 1/4 or 1/8 (DCT scaling)
+    and the full-resolution pixels are never materialized. The result is resampled to
+    the image's size in the cell at dpi and saved as a JPEG at quality.
+
+    Returns (jpeg_stream, original_size), or None if the stream isn't a valid JPEG.
+    """
+    with Image.open(image_stream) as img:
+        if img.format not in ('JPEG', 'MPO'): # MPO is multi-picture JPEG
+            return None
+        original_size = img.size
+        draw_width, draw_height = fit_to_cell(*original_size, cell_width, max_img_height)
+        # Never upscale beyond the original pixels
+        target_size = (min(original_size[0], max(1, round(draw_width * dpi / 72.0))),
+                       min(original_size[1], max(1, round(draw_height * dpi / 72.0))))
+        img.draft('RGB', target_size) # Picks the smallest DCT scale still >= target_size
+        resized = img.convert('RGB') if img.mode != 'RGB' else img
+        if resized.size != target_size:
+            resized = resized.resize(target_size, Image.LANCZOS)
+        jpeg_stream = io.BytesIO()
+        resized.save(jpeg_stream, 'JPEG', quality=quality)
+    jpeg_stream.seek(0)
+    return jpeg_stream, original_size
+
+def load_cell_image(fetch, image_object, cell_width, max_img_height, dpi, quality, cache=None, bucket_name=None, cache_target=None):
+    """Downloads an image with fetch(object_key) and gets it ready to draw in a cell.
+
+    Runs on the download threads, so decoding overlaps with the network. Returns
+    (image_stream, image_size), where image_size is the size to lay the image out at
+    (None to use the image's own size), or None if the image should be skipped.
+
+    With a ThumbnailCache, downscaled images are looked up by the object's ETag and
+    cache_target first, so unchanged objects are not downloaded at all.
+    """
+    object_key = image_object['Key']
+    etag = image_object.get('ETag')
+    if cache and etag:
+        cached = cache.get(bucket_name, object_key, etag, cache_target)
+        if cached:
+            jpeg_bytes, original_size = cached
+            metrics.count('images_from_cache')
+            return io.BytesIO(jpeg_bytes), original_size
+
+    with metrics.stage('download'):
+        image_stream = fetch(object_key)
+    if not image_stream:
+        return None # Download failed, already logged in get_image_from_s3
+    if not dpi:
+        with metrics.stage('validate'):
+            valid = is_jpeg(image_stream)
+        if valid:
+            return image_stream, None
+    else:
+        try:
+            with metrics.stage('decode'):
+                cell_image = downscale_image(image_stream, cell_width, max_img_height, dpi, quality)
+            if cell_image:
+                if cache and etag:
+                    jpeg_stream, original_size = cell_image
+                    cache.put(bucket_name, object_key, etag, cache_target, jpeg_stream.getvalue(), original_size)
+                return cell_image
+        except Exception as e:
+            logging.debug(f"Failed to decode {object_key}: {e}")
+    logging.warning(f"Skipping non-JPEG file (verified): {object_key}")
+    metrics.count('images_skipped')
+    return None
+
+def make_cell_image_loader(config, layout, s3_client):
+    """Builds the function the download threads call for each image object.
+
+    Returns (load_image, thumbnail_cache); load_image(image_object) returns what
+    load_cell_image does.
+    """
+    bucket_name = config['bucket_name']
+    image_dpi = config['image_dpi']
+    cell_width = layout['cell_width']
+    max_img_height = layout['cell_height'] - layout['text_height_allowance']
+
+    if config['use_embedded_thumbnails']:
+        fetch_image = partial(get_thumbnail_or_image_from_s3, s3_client, bucket_name,
+                              cell_width=cell_width, cell_height=max_img_height,
+                              dpi=config['thumbnail_dpi'], range_bytes=config['thumbnail_range_bytes'])
+    else:
+        fetch_image = partial(get_image_from_s3, s3_client, bucket_name)
+
+    thumbnail_cache = None
+    cache_target = None
+    if config['thumbnail_cache_directory']:
+        if image_dpi:
+            thumbnail_cache = ThumbnailCache(config['thumbnail_cache_directory'], config['thumbnail_cache_max_bytes'])
+            # Everything besides the object that decides what the downscaled image looks like
+            cache_target = (f"{cell_width:.3f}x{max_img_height:.3f}pt@{image_dpi:g}dpi"
+                            f"/q{config['jpeg_quality']}/{'exif-thumbnail' if config['use_embedded_thumbnails'] else 'full'}")
+        else:
+            logging.warning("ThumbnailCacheDirectory is ignored when ImageDPI is 0 (images are not downscaled).")
+
+    load_image = partial(load_cell_image, fetch_image, cell_width=cell_width, max_img_height=max_img_height,
+                         dpi=image_dpi, quality=config['jpeg_quality'],
+                         cache=thumbnail_cache, bucket_name=bucket_name, cache_target=cache_target)
+    return load_image, thumbnail_cache
+
+def draw_page_header(c, text, page_width, page_height, margin, font_size):
+    """Draws the header text at the top of the page."""
+    c.setFont("Helvetica-Bold", font_size)
+    header_y = page_height - margin / 2
+    c.drawCentredString(page_width / 2, header_y, text)
+
+def draw_image_and_filename(c, img_reader, filename, x, y, cell_width, cell_height, filename_font_size, text_height_allowance, image_size=None):
+    """Draws a scaled image and its filename within a cell.
+
+    image_size is the original (width, height) of a downscaled image, so it is laid
+    out exactly as the original would have been.
+    """
+    img_width, img_height = image_size or img_reader.getSize()
+    max_img_height = cell_height - text_height_allowance
+
+    draw_width, draw_height = fit_to_cell(img_width, img_height, cell_width, max_img_height)
 
     # Center the image horizontally and place it at the top of the image area
     img_x = x + (cell_width - draw_width) / 2
@@ -153,6 +494,208 @@ def draw_image_and_filename(c, img_reader, filename, x, y, cell_width, cell_heig
     text_y = y + (text_height_allowance / 2) - (filename_font_size / 2) # Center text vertically in its allowance
     c.drawCentredString(x + cell_width / 2, text_y, filename)
 
+def page_layout(config):
+    """Works out the page and cell geometry, and how pages are drawn, from the settings."""
+    page_width, page_height = A4
+    margin = config['margin']
+    available_width = page_width - 2 * margin
+    available_height = page_height - 2 * margin - config['header_font_size'] * 1.5 # Extra space below header
+    return {
+        'page_width': page_width,
+        'page_height': page_height,
+        'columns': config['columns'],
+        'rows': config['rows'],
+        'margin': margin,
+        'header_font_size': config['header_font_size'],
+        'filename_font_size': config['filename_font_size'],
+        'cell_width': available_width / config['columns'],
+        'cell_height': available_height / config['rows'],
+        'text_height_allowance': config['filename_font_size'] * 2.0, # Space reserved for filename below image
+        'sprite_dpi': config['sprite_dpi'],
+        'sprite_quality': config['jpeg_quality'],
+        'sprite_page_directory': config['sprite_page_directory'] if config['sprite_dpi'] else '',
+        'sprite_page_format': config['sprite_page_format'],
+    }
+
+def draw_folder(c, layout, header_text, images_in_folder, cell_images, page_image_name=None):
+    """Draws one folder's images onto the canvas, starting on a fresh page.
+
+    cell_images yields (image_object, cell_image) for images_in_folder, in order (see
+    load_cell_image). Leaves the canvas on a fresh page for the next folder. Returns
+    the number of images drawn.
+
+    With layout['sprite_dpi'] set, each page's images are drawn as one composite image
+    (see SpritePageCanvas); page_image_name names the standalone page images.
+    """
+    if layout['sprite_dpi']:
+        c = SpritePageCanvas(c, layout, page_image_name)
+    cols, rows = layout['columns'], layout['rows']
+    margin = layout['margin']
+    cell_width, cell_height = layout['cell_width'], layout['cell_height']
+
+    current_image_index_on_page = 0
+    first_page_for_folder = True # Will be set to False after first page for this folder is drawn
+    image_count_in_folder = 0
+    for image_obj in images_in_folder:
+        image_key = image_obj['Key']
+        # Check if we need a new page (start of folder or page full)
+        if current_image_index_on_page == 0:
+            if not first_page_for_folder: # Avoid extra page break if previous was exactly full
+                c.showPage()
+            draw_page_header(c, header_text, layout['page_width'], layout['page_height'], margin, layout['header_font_size'])
+            first_page_for_folder = False # Header drawn for this folder's first page
+
+        # Download and validate image
+        logging.debug(f"Processing image: {image_key}")
+        with metrics.stage('wait_for_images'): # Time the drawing spends waiting on the download threads
+            _, cell_image = next(cell_images) # Same order as images_in_folder
+        metrics.advance()
+
+        if cell_image:
+            image_stream, image_size = cell_image
+            try:
+                pil_img_reader = ImageReader(image_stream) # Use ReportLab's ImageReader
+                filename = os.path.basename(image_key)
+
+                # Calculate position
+                col = current_image_index_on_page % cols
+                row = rows - 1 - (current_image_index_on_page // cols) # Y counts from bottom
+
+                # Bottom-left corner of the cell
+                cell_x = margin + col * cell_width
+                cell_y = margin + row * cell_height
+
+                # Draw the image and filename
+                with metrics.stage('draw'):
+                    draw_image_and_filename(c, pil_img_reader, filename, cell_x, cell_y, cell_width, cell_height, layout['filename_font_size'], layout['text_height_allowance'], image_size)
+
+                current_image_index_on_page += 1
+                image_count_in_folder += 1
+                metrics.count('images_drawn')
+
+                # Check if page is full *after* drawing
+                if current_image_index_on_page >= cols * rows:
+                    with metrics.stage('draw'):
+                        c.showPage()
+                    current_image_index_on_page = 0 # Reset for next page
+                    # If we are still in the same folder, draw the header again
+                    if image_count_in_folder < len(images_in_folder):
+                         draw_page_header(c, header_text, layout['page_width'], layout['page_height'], margin, layout['header_font_size'])
+
+            except Exception as e:
+                logging.error(f"Error processing or drawing image {image_key}: {e}")
+                # Move to next potential spot if an error occurred during drawing?
+                # Decide if an error should skip a grid slot or just log and continue
+        # else: download failed or not a JPEG, already logged in load_cell_image
+
+    # Finish a part-filled page so the next folder starts on a new one
+    with metrics.stage('draw'):
+        if current_image_index_on_page > 0:
+            c.showPage()
+        if layout['sprite_dpi']:
+            c.flush()
+    metrics.count('folders_drawn')
+    return image_count_in_folder
+
+def changed_folders(image_folders, folder_fragments, bucket_name):
+    """Yields the (folder_path, images_in_folder, fragment) that need drawing.
+
+    Every folder's fragment (None when not rendering to fragments) is recorded in the
+    folder_fragments dict, in document order. Folders whose fragment from the last run
+    can be reused are skipped.
+    """
+    for folder_path, images_in_folder, fragment in image_folders:
+        folder_fragments[folder_path] = fragment
+        if fragment and fragment['reused']:
+            logging.info(f"Unchanged folder: s3://{bucket_name}/{folder_path} ({len(images_in_folder)} images)")
+            metrics.advance(len(images_in_folder))
+            continue
+        yield folder_path, images_in_folder, fragment
+
+class PartCanvas:
+    """Stands in for a reportlab canvas, saving every max_pages pages to a new PDF file.
+
+    reportlab keeps all of a document's pages in memory until it is saved, so this bounds
+    memory for folders of any size. Part files are named part_path_format.format(n).
+    """
+
+    def __init__(self, part_path_format, max_pages):
+        self.part_path_format = part_path_format
+        self.max_pages = max_pages
+        self.part_paths = []
+        self.pages = 0
+        self._canvas = None
+
+    def _current(self):
+        if self._canvas is None: # Parts are only started once something is drawn on them
+            self.part_paths.append(self.part_path_format.format(len(self.part_paths)))
+            self._canvas = canvas.Canvas(self.part_paths[-1] + '.tmp', pagesize=A4)
+        return self._canvas
+
+    def __getattr__(self, name):
+        return getattr(self._current(), name)
+
+    def showPage(self):
+        self._current().showPage()
+        if self._canvas.getPageNumber() > self.max_pages:
+            self._save_part()
+
+    def _save_part(self):
+        with metrics.stage('save'):
+            self._canvas.save()
+        self.pages += self._canvas.getPageNumber() - 1
+        os.replace(self.part_paths[-1] + '.tmp', self.part_paths[-1]) # Never leave a half-written part behind
+        self._canvas = None
+
+    def save(self):
+        if self._canvas is not None:
+            self._save_part()
+
+def render_fragment(fragment_directory, fragment_name, pages_per_part, layout, header_text, images_in_folder, cell_images, page_image_name=None):
+    """Draws one folder into its own PDF part files.
+
+    Returns (images_drawn, part_names, pages).
+    """
+    c = PartCanvas(os.path.join(fragment_directory, fragment_name + '-{:03d}.pdf'), pages_per_part)
+    images_drawn = draw_folder(c, layout, header_text, images_in_folder, cell_images, page_image_name)
+    c.save()
+    return images_drawn, [os.path.basename(path) for path in c.part_paths], c.pages
+
+# State of a render worker process, set up once by init_render_worker
+render_worker = {}
+
+def init_render_worker(config, layout):
+    """Sets up a render worker process with its own S3 client, download pool, cache and metrics."""
+    metrics.reset()
+    s3_client = instrument_s3_client(boto3.client('s3', config=BotoConfig(max_pool_connections=config['download_workers'])))
+    load_image, thumbnail_cache = make_cell_image_loader(config, layout, s3_client)
+    render_worker.update(config=config, layout=layout, load_image=load_image, thumbnail_cache=thumbnail_cache)
+
+def render_fragment_in_worker(fragment_directory, task):
+    """Renders one folder to a fragment in a worker process.
+
+    task is (folder_path, images_in_folder, fragment_name). Returns the number of images
+    drawn and the fragment's parts and pages, along with the transfer and cache counts
+    and the metrics, which the parent adds up.
+    """
+    folder_path, images_in_folder, fragment_name = task
+    config = render_worker['config']
+    cell_images = fetch_images_in_order(render_worker['load_image'], images_in_folder,
+                                        config['download_workers'], config['prefetch_window'])
+    header_text = f"s3://{config['bucket_name']}/{folder_path}"
+    images_drawn, parts, pages = render_fragment(fragment_directory, fragment_name, config['pages_per_fragment'],
+                                                 render_worker['layout'], header_text, images_in_folder, cell_images,
+                                                 page_image_name(folder_path))
+    thumbnail_cache = render_worker['thumbnail_cache']
+    return {
+        'images_drawn': images_drawn,
+        'parts': parts,
+        'pages': pages,
+        'transfer_stats': take_transfer_stats(),
+        'cache_stats': thumbnail_cache.take_stats() if thumbnail_cache else {},
+        'metrics': metrics.snapshot(reset=True),
+    }
+
 
 # --- Main Execution ---
 if __name__ == "__main__":
@@ -164,6 +707,9 @@ if __name__ == "__main__":
         
     
 
+    # Stage timers, progress line and metrics file; written out however the run ends
+    start_run(config['instrumentation'], 'contact-sheet')
+
     BUCKET_NAME = config['bucket_name']
     START_FOLDER = config['start_folder']
     # Generate PDF filename
@@ -172,149 +718,213 @@ if __name__ == "__main__":
     OUTPUT_FILE = pdf_filename
     COLS = config['columns']
     ROWS = config['rows']
-    IMAGES_PER_PAGE = COLS * ROWS
-    MARGIN = config['margin']
-    HEADER_FONT_SIZE = config['header_font_size']
-    FILENAME_FONT_SIZE = config['filename_font_size']
+    DOWNLOAD_WORKERS = config['download_workers']
+    PREFETCH_WINDOW = config['prefetch_window']
+    USE_EMBEDDED_THUMBNAILS = config['use_embedded_thumbnails']
+    IMAGE_DPI = config['image_dpi']
+    STREAM_LISTING = config['stream_listing']
+    LIST_WORKERS = config['list_workers']
+    INVENTORY_MANIFEST = config['inventory_manifest']
+    if STREAM_LISTING and INVENTORY_MANIFEST:
+        logging.warning("StreamListing is ignored when reading keys from an InventoryManifest.")
+        STREAM_LISTING = False
+    FRAGMENT_DIRECTORY = config['fragment_directory']
+    RENDER_WORKERS = config['render_workers']
+    MAX_VOLUME_PAGES = config['max_volume_pages']
+    MAX_VOLUME_BYTES = config['max_volume_bytes']
+    SPLIT_VOLUMES = bool(MAX_VOLUME_PAGES or MAX_VOLUME_BYTES)
+    STREAM_OUTPUT = config['stream_output'] or SPLIT_VOLUMES
+    INDEX_FILE = f"contact_sheet_{pdf_filename_base}_index.txt"
+    SPRITE_DPI = config['sprite_dpi']
+    SPRITE_PAGE_DIRECTORY = config['sprite_page_directory']
+
+    if (FRAGMENT_DIRECTORY or RENDER_WORKERS > 1 or STREAM_OUTPUT) and fragments.PdfReader is None:
+        logging.critical("FragmentDirectory, RenderWorkers, StreamOutput and volumes need the pypdf package to merge fragments (pip install pypdf).")
+        exit(1)
+
+    if config['sprite_page_format'] not in PAGE_IMAGE_FORMATS:
+        logging.critical(f"SpritePageFormat must be one of {', '.join(PAGE_IMAGE_FORMATS)}, not '{config['sprite_page_format']}'.")
+        exit(1)
+    if SPRITE_PAGE_DIRECTORY and not SPRITE_DPI:
+        logging.warning("SpritePageDirectory is ignored when SpriteDPI is 0 (pages are not composited).")
+    elif SPRITE_PAGE_DIRECTORY:
+        os.makedirs(SPRITE_PAGE_DIRECTORY, exist_ok=True)
 
     logging.info(f"Starting contact sheet generation for s3://{BUCKET_NAME}/{START_FOLDER}")
-    logging.info(f"Output will be saved to: {OUTPUT_FILE}")
+    if SPLIT_VOLUMES:
+        logging.info(f"Output will be saved in volumes of at most {MAX_VOLUME_PAGES or 'any number of'} pages"
+                     f"{f' and {MAX_VOLUME_BYTES / 1e6:.0f} MB' if MAX_VOLUME_BYTES else ''}: "
+                     f"contact_sheet_{pdf_filename_base}_vol001.pdf, ... with an index in {INDEX_FILE}")
+    else:
+        logging.info(f"Output will be saved to: {OUTPUT_FILE}")
     logging.info(f"Layout: {COLS} columns x {ROWS} rows per page.")
+    logging.info(f"Downloads: {DOWNLOAD_WORKERS} workers, prefetch window of {PREFETCH_WINDOW} images.")
+    if USE_EMBEDDED_THUMBNAILS:
+        logging.info(f"Using embedded EXIF thumbnails where they are at least {config['thumbnail_dpi']:g} DPI in a cell.")
+    if SPRITE_DPI:
+        logging.info(f"Each page's images are drawn as one {SPRITE_DPI:g} DPI composite image.")
+        if SPRITE_PAGE_DIRECTORY:
+            logging.info(f"Page composites are also saved as {config['sprite_page_format']} files in {SPRITE_PAGE_DIRECTORY}")
+    if IMAGE_DPI:
+        logging.info(f"Images are downscaled to {IMAGE_DPI:g} DPI, JPEG quality {config['jpeg_quality']}, before embedding.")
+
+    # boto3 clients are thread-safe; size the connection pool to match the download and list workers
+    s3 = instrument_s3_client(boto3.client('s3', config=BotoConfig(max_pool_connections=max(DOWNLOAD_WORKERS, LIST_WORKERS))))
+
+    if STREAM_LISTING:
+        # 1+2. List one folder at a time; each folder is drawn as soon as it has been listed
+        logging.info("Listing objects in S3 folder by folder...")
+        image_folders = exit_on_listing_error(iter_image_folders(s3, BUCKET_NAME, START_FOLDER))
+        first_folder = next(image_folders, None)
+        if first_folder is None:
+            logging.warning("No JPEG images found in the specified S3 path.")
+            exit(0)
+        image_folders = itertools.chain([first_folder], image_folders)
+        metrics.start_progress("Drawing images") # The total isn't known until the listing ends
+    else:
+        # 1. List all relevant objects recursively
+        logging.info("Listing objects in S3...")
+        metrics.start_progress("Listing objects")
+        try:
+            all_objects = list_s3_objects_recursive(s3, BUCKET_NAME, START_FOLDER, LIST_WORKERS, INVENTORY_MANIFEST)
+        except Exception as e:
+            logging.critical(f"Could not list S3 objects. Exiting. Error: {e}")
+            exit(1)
+
+        logging.info(f"Found {len(all_objects)} total objects in prefix.")
+
+        # 2. Filter for potential JPEGs by extension and group by folder
+        images_by_folder = defaultdict(list)
+        for obj in all_objects:
+            key = obj['Key']
+            if is_jpeg_key(key):
+                images_by_folder[folder_for_key(key, START_FOLDER)].append(obj)
+            else:
+                logging.debug(f"Ignoring non-JPEG file by extension: {key}")
 
-    s3 = boto3.client('s3')
-
-    # 1. List all relevant objects recursively
-    logging.info("Listing objects in S3...")
-    try:
-        all_objects = list_s3_objects_recursive(s3, BUCKET_NAME, START_FOLDER)
-    except Exception as e:
-        logging.critical(f"Could not list S3 objects. Exiting. Error: {e}")
-        exit(1)
-
-    logging.info(f"Found {len(all_objects)} total objects in prefix.")
-
-    # 2. Filter for potential JPEGs by extension and group by folder
-    images_by_folder = defaultdict(list)
-    for obj in all_objects:
-        key = obj['Key']
-        _, ext = os.path.splitext(key)
-        if ext.lower() in VALID_JPEG_EXTENSIONS:
-            # Group by the immediate parent directory
-            folder = os.path.dirname(key)
-            # Handle root folder case
-            if not folder and START_FOLDER in ('', '/'):
-                 folder = '/' # Represent root explicitly if needed
-            elif folder == START_FOLDER.rstrip('/'): # Handle case where start folder itself has images
-                 folder = START_FOLDER.rstrip('/')
-            # Ensure consistent trailing slash for comparison, except for root
-            if folder != '/':
-                folder = folder.rstrip('/') + '/'
-
-            images_by_folder[folder].append(key)
-        else:
-            logging.debug(f"Ignoring non-JPEG file by extension: {key}")
+        if not images_by_folder:
+            logging.warning("No JPEG images found in the specified S3 path.")
+            exit(0)
 
-    if not images_by_folder:
-        logging.warning("No JPEG images found in the specified S3 path.")
-        exit(0)
+        logging.info(f"Found potential JPEGs in {len(images_by_folder)} folders.")
 
-    logging.info(f"Found potential JPEGs in {len(images_by_folder)} folders.")
+        # Sort folders alphabetically for predictable output
+        sorted_folders = sorted(images_by_folder.keys())
+        for folder_images in images_by_folder.values():
+            folder_images.sort(key=lambda obj: obj['Key']) # Sort images within folder
+        image_folders = [(folder_path, images_by_folder[folder_path]) for folder_path in sorted_folders]
+        metrics.start_progress("Drawing images", sum(len(images) for images in images_by_folder.values()))
 
     # 3. Create PDF
-    c = canvas.Canvas(OUTPUT_FILE, pagesize=A4)
-    page_width, page_height = A4
-
-    available_width = page_width - 2 * MARGIN
-    available_height = page_height - 2 * MARGIN - HEADER_FONT_SIZE * 1.5 # Extra space below header
-
-    cell_width = available_width / COLS
-    cell_height = available_height / ROWS
-    text_height_allowance = FILENAME_FONT_SIZE * 2.0 # Space reserved for filename below image
-
-    # Sort folders alphabetically for predictable output
-    sorted_folders = sorted(images_by_folder.keys())
-
-    current_image_index_on_page = 0
-    first_page_for_folder = True
-
-    for folder_path in sorted_folders:
-        images_in_folder = sorted(images_by_folder[folder_path]) # Sort images within folder
-        logging.info(f"Processing folder: s3://{BUCKET_NAME}/{folder_path} ({len(images_in_folder)} images)")
-
-        # Start a new page for each new folder *unless* it's the very first image overall
-        if not first_page_for_folder:
-            # If previous page wasn't full, force a new page for the new folder
-            if current_image_index_on_page > 0:
-                 c.showPage()
-                 current_image_index_on_page = 0 # Reset for new page
-
-        # Reset page flag for this folder
-        first_page_for_folder = True # Will be set to False after first page for this folder is drawn
-
-        image_count_in_folder = 0
-        for image_key in images_in_folder:
-            # Check if we need a new page (start of folder or page full)
-            if current_image_index_on_page == 0:
-                # Don't add a page break if it's the very first image of the whole process
-                if not (folder_path == sorted_folders[0] and image_count_in_folder == 0):
-                     if not first_page_for_folder: # Avoid extra page break if previous was exactly full
-                         c.showPage()
-                header_text = f"s3://{BUCKET_NAME}/{folder_path}"
-                draw_page_header(c, header_text, page_width, page_height, MARGIN, HEADER_FONT_SIZE)
-                first_page_for_folder = False # Header drawn for this folder's first page
-
-            # Download and validate image
-            logging.debug(f"Processing image: {image_key}")
-            image_stream = get_image_from_s3(s3, BUCKET_NAME, image_key)
-
-            if image_stream and is_jpeg(image_stream):
-                try:
-                    pil_img_reader = ImageReader(image_stream) # Use ReportLab's ImageReader
-                    filename = os.path.basename(image_key)
-
-                    # Calculate position
-                    col = current_image_index_on_page % COLS
-                    row = ROWS - 1 - (current_image_index_on_page // COLS) # Y counts from bottom
-
-                    # Bottom-left corner of the cell
-                    cell_x = MARGIN + col * cell_width
-                    cell_y = MARGIN + row * cell_height
-
-                    # Draw the image and filename
-                    draw_image_and_filename(c, pil_img_reader, filename, cell_x, cell_y, cell_width, cell_height, FILENAME_FONT_SIZE, text_height_allowance)
-
-                    current_image_index_on_page += 1
-                    image_count_in_folder += 1
-
-                    # Check if page is full *after* drawing
-                    if current_image_index_on_page >= IMAGES_PER_PAGE:
-                        c.showPage()
-                        current_image_index_on_page = 0 # Reset for next page
-                        # If we are still in the same folder, draw the header again
-                        if image_count_in_folder < len(images_in_folder):
-                             header_text = f"s3://{BUCKET_NAME}/{folder_path}"
-                             draw_page_header(c, header_text, page_width, page_height, MARGIN, HEADER_FONT_SIZE)
-
-                except Exception as e:
-                    logging.error(f"Error processing or drawing image {image_key}: {e}")
-                    # Move to next potential spot if an error occurred during drawing?
-                    # Decide if an error should skip a grid slot or just log and continue
+    layout = page_layout(config)
+
+    # Rendering in several processes and streaming output always go through fragments;
+    # without a FragmentDirectory they are kept in a temporary directory for this run only
+    fragment_directory = FRAGMENT_DIRECTORY
+    if (RENDER_WORKERS > 1 or STREAM_OUTPUT) and not fragment_directory:
+        temp_directory = tempfile.TemporaryDirectory(prefix='contact_sheet_')
+        fragment_directory = temp_directory.name
+
+    if fragment_directory:
+        # Only folders whose keys, ETags or rendering settings changed are drawn again
+        os.makedirs(fragment_directory, exist_ok=True)
+        previous_manifest = fragments.load_manifest(fragment_directory)
+        render_settings = {
+            'bucket_name': BUCKET_NAME, 'layout': layout, 'image_dpi': IMAGE_DPI, 'jpeg_quality': config['jpeg_quality'],
+            'use_embedded_thumbnails': USE_EMBEDDED_THUMBNAILS, 'thumbnail_dpi': config['thumbnail_dpi'],
+        }
+        # A temporary fragment directory has no manifest to save, so the key lists needn't be kept
+        image_folders = fragments.plan_fragments(image_folders, previous_manifest, render_settings, fragment_directory,
+                                                 record_images=bool(FRAGMENT_DIRECTORY))
+    else:
+        image_folders = ((folder_path, images_in_folder, None) for folder_path, images_in_folder in image_folders)
+
+    folder_fragments = {} # folder_path -> fragment, in document order
+    folders_to_draw = changed_folders(image_folders, folder_fragments, BUCKET_NAME)
+    thumbnail_cache = None
+    worker_cache_stats = defaultdict(int)
+
+    if RENDER_WORKERS > 1:
+        # Each worker process renders whole folders to fragments with its own downloads,
+        # and the results come back in folder order
+        logging.info(f"Rendering folders in {RENDER_WORKERS} worker processes...")
+        # Workers are spawned rather than forked: the parent already has threads running
+        # (progress, streaming listing) that may hold a lock the child would then wait on forever
+        executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=init_render_worker, initargs=(config, layout))
+        tasks = ((folder_path, images_in_folder, fragment['name']) for folder_path, images_in_folder, fragment in folders_to_draw)
+        for (folder_path, images_in_folder, _), result in map_in_order(
+                executor, partial(render_fragment_in_worker, fragment_directory), tasks, 2 * RENDER_WORKERS):
+            logging.info(f"Rendered folder: s3://{BUCKET_NAME}/{folder_path} ({result['images_drawn']} of {len(images_in_folder)} images)")
+            folder_fragments[folder_path].update(parts=result['parts'], pages=result['pages'])
+            if result['images_drawn'] < len(images_in_folder):
+                folder_fragments[folder_path]['signature'] = None # Redraw next time, in case a download failure was transient
+            count_transfer(**result['transfer_stats'])
+            metrics.merge(result['metrics'])
+            metrics.advance(len(images_in_folder))
+            for name, count in result['cache_stats'].items():
+                worker_cache_stats[name] += count
+    else:
+        load_image, thumbnail_cache = make_cell_image_loader(config, layout, s3)
+
+        # Downloads (and decoding) run ahead of the drawing on a thread pool, but results
+        # come back in exactly the order the drawing below consumes them. The tee lets the
+        # downloads read ahead through the folders without the listing being materialized.
+        folders_to_draw, folders_to_fetch = itertools.tee(folders_to_draw)
+        cell_images = fetch_images_in_order(
+            load_image,
+            (obj for _, images_in_folder, _ in folders_to_fetch for obj in images_in_folder),
+            DOWNLOAD_WORKERS, PREFETCH_WINDOW)
+
+        c = None if fragment_directory else canvas.Canvas(OUTPUT_FILE, pagesize=A4)
+        for folder_path, images_in_folder, fragment in folders_to_draw:
+            logging.info(f"Processing folder: s3://{BUCKET_NAME}/{folder_path} ({len(images_in_folder)} images)")
+            header_text = f"s3://{BUCKET_NAME}/{folder_path}"
+            if fragment:
+                images_drawn, fragment['parts'], fragment['pages'] = render_fragment(
+                    fragment_directory, fragment['name'], config['pages_per_fragment'],
+                    layout, header_text, images_in_folder, cell_images, page_image_name(folder_path))
+                if images_drawn < len(images_in_folder):
+                    fragment['signature'] = None # Redraw next time, in case a download failure was transient
             else:
-                if image_stream:
-                     logging.warning(f"Skipping non-JPEG file (verified): {image_key}")
-                # else: download failed, already logged in get_image_from_s3
-
-        # End of folder processing - important: set page index to 0 if we finished mid-page
-        # to force a new page for the *next* folder (unless it was already 0).
-        if current_image_index_on_page > 0:
-             # Don't add showPage here, let the start of the next folder handle it
-             pass # The next folder loop iteration will call showPage if needed
-
+                draw_folder(c, layout, header_text, images_in_folder, cell_images, page_image_name(folder_path))
 
     # 4. Save the PDF
     try:
-        c.save()
-        logging.info(f"Successfully created contact sheet: {OUTPUT_FILE}")
+        with metrics.stage('save'):
+            if fragment_directory:
+                reused_count = sum(1 for fragment in folder_fragments.values() if fragment['reused'])
+                logging.info(f"Merging {len(folder_fragments)} folder fragments ({reused_count} unchanged since the last run)...")
+                if SPLIT_VOLUMES:
+                    index = fragments.write_volumes(folder_fragments, fragment_directory,
+                                                    lambda number: f"contact_sheet_{pdf_filename_base}_vol{number:03d}.pdf",
+                                                    MAX_VOLUME_PAGES, MAX_VOLUME_BYTES)
+                    fragments.write_index(index, INDEX_FILE, BUCKET_NAME)
+                    volume_count = len({volume_file for _, volume_file, _, _ in index})
+                    logging.info(f"Wrote {volume_count} volumes, indexed in {INDEX_FILE}")
+                else:
+                    fragments.write_volumes(folder_fragments, fragment_directory, lambda number: OUTPUT_FILE)
+                if FRAGMENT_DIRECTORY:
+                    manifest = {
+                        'version': fragments.MANIFEST_VERSION,
+                        'folders': {folder_path: {key: fragment[key] for key in ('signature', 'parts', 'pages', 'images')}
+                                    for folder_path, fragment in folder_fragments.items()},
+                    }
+                    fragments.save_manifest(FRAGMENT_DIRECTORY, manifest)
+                    fragments.remove_stale_fragments(FRAGMENT_DIRECTORY, manifest)
+            else:
+                c.save()
+            logging.info(f"Successfully created contact sheet: {INDEX_FILE if SPLIT_VOLUMES else OUTPUT_FILE}")
     except Exception as e:
         logging.error(f"Failed to save PDF file '{OUTPUT_FILE}': {e}")
-        
\ No newline at end of file
+
+    if USE_EMBEDDED_THUMBNAILS:
+        saved_bytes = transfer_stats['object_bytes'] - transfer_stats['bytes_downloaded']
+        logging.info(f"Embedded thumbnails used for {transfer_stats['thumbnails_used']} images, "
+                     f"{transfer_stats['full_downloads']} needed a full download. "
+                     f"Downloaded {transfer_stats['bytes_downloaded'] / 1e6:.1f} MB of {transfer_stats['object_bytes'] / 1e6:.1f} MB "
+                     f"(saved {saved_bytes / 1e6:.1f} MB).")
+    if thumbnail_cache:
+        thumbnail_cache.log_stats()
+    elif worker_cache_stats:
+        log_cache_stats(**worker_cache_stats)
@@ -0,0 +1,251 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import re
+from array import array
+from collections import deque
+
+try:
+    from pypdf import PdfReader
+    from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
+except ImportError:
+    PdfReader = None # Only needed to merge fragments, checked before rendering starts
+
+# Incremental contact sheets: every folder is rendered to its own PDF fragment, and a
+# manifest records which keys and ETags each fragment was drawn from. Every folder starts
+# on a fresh page, so the fragments can simply be concatenated into the final document.
+# A large folder's fragment is split into parts of a bounded number of pages, so neither
+# drawing nor merging ever holds more than one part in memory.
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 2
+# Fragment parts are named <signature>-000.pdf, ...; nothing else in the directory is ever removed
+FRAGMENT_PART_NAME = re.compile(r'[0-9a-f]{64}-\d{3,}\.pdf')
+
+# Page attributes a page may inherit from its parents in the page tree
+_INHERITED_PAGE_KEYS = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+
+
+def folder_signature(render_settings, folder_path, images_in_folder):
+    """Hashes everything that decides how a folder's fragment looks."""
+    content = json.dumps([MANIFEST_VERSION, render_settings, folder_path,
+                          [[obj['Key'], obj.get('ETag')] for obj in images_in_folder]])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def load_manifest(fragment_directory):
+    """Reads the manifest from a previous run, or returns an empty one."""
+    path = os.path.join(fragment_directory, MANIFEST_FILE)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+        logging.info(f"Ignoring manifest {path} from a different version.")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable manifest {path}: {e}")
+    return {'version': MANIFEST_VERSION, 'folders': {}}
+
+
+def save_manifest(fragment_directory, manifest):
+    """Writes the manifest atomically, so an interrupted run leaves the old one intact."""
+    path = os.path.join(fragment_directory, MANIFEST_FILE)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, path)
+
+
+def plan_fragments(image_folders, previous_manifest, render_settings, fragment_directory, record_images=True):
+    """Yields (folder_path, images_in_folder, fragment) for each folder.
+
+    fragment is the folder's new manifest entry; fragment['reused'] is True when the
+    previous run's fragment can be used as it is, so the folder needn't be downloaded
+    or drawn again. The [key, ETag] list of each folder is only recorded in
+    fragment['images'] when record_images is set, since it is kept for the whole run
+    and is only needed when the manifest is saved.
+    """
+    previous_folders = previous_manifest['folders']
+    for folder_path, images_in_folder in image_folders:
+        signature = folder_signature(render_settings, folder_path, images_in_folder)
+        previous = previous_folders.get(folder_path)
+        reused = bool(previous and previous['signature'] == signature
+                      and all(os.path.exists(os.path.join(fragment_directory, part)) for part in previous['parts']))
+        fragment = {
+            'signature': signature,
+            'name': signature, # Parts are written as <name>-000.pdf, <name>-001.pdf, ...
+            'parts': previous['parts'] if reused else [],
+            'pages': previous['pages'] if reused else 0,
+            'reused': reused,
+        }
+        if record_images:
+            fragment['images'] = [[obj['Key'], obj.get('ETag')] for obj in images_in_folder]
+        yield folder_path, images_in_folder, fragment
+
+
+class PdfConcatenator:
+    """Writes the pages of several PDF files into one, streaming them to disk.
+
+    Each object is written as soon as it has been copied, so memory use depends on the
+    largest input file rather than on the size of the output. Only the object offsets
+    and page numbers of the output are kept until close() writes the page tree.
+    """
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.pages = 0
+        self._temp_path = output_file + '.tmp'
+        self._file = open(self._temp_path, 'wb')
+        self._file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        self._offsets = array('q', [0, 0, 0]) # By object number; 1 is the catalog and 2 the page tree, written last
+        self._page_ids = array('q')
+
+    def _new_id(self):
+        self._offsets.append(0)
+        return len(self._offsets) - 1
+
+    def _write(self, object_id, obj):
+        self._offsets[object_id] = self._file.tell()
+        self._file.write(f"{object_id} 0 obj\n".encode('ascii'))
+        obj.write_to_stream(self._file)
+        self._file.write(b'\nendobj\n')
+
+    def append(self, pdf_path):
+        """Copies all pages of pdf_path, and everything they refer to, to the output."""
+        with open(pdf_path, 'rb') as f:
+            reader = PdfReader(f)
+            id_map = {} # (object number, generation) in pdf_path -> object number in the output
+            pending = deque()
+
+            def copy_object(obj):
+                if isinstance(obj, IndirectObject):
+                    source_id = (obj.idnum, obj.generation)
+                    if source_id not in id_map:
+                        id_map[source_id] = self._new_id()
+                        pending.append(obj)
+                    return IndirectObject(id_map[source_id], 0, None)
+                if isinstance(obj, StreamObject):
+                    stream = copy.copy(obj) # Keeps the encoded stream data as it is
+                    for key, value in obj.items():
+                        stream[key] = copy_object(value)
+                    return stream
+                if isinstance(obj, DictionaryObject):
+                    return DictionaryObject({key: copy_object(value) for key, value in obj.items()})
+                if isinstance(obj, ArrayObject):
+                    return ArrayObject(copy_object(value) for value in obj)
+                return obj
+
+            for page in reader.pages:
+                page_id = self._new_id()
+                if page.indirect_reference is not None:
+                    id_map[(page.indirect_reference.idnum, page.indirect_reference.generation)] = page_id
+                page_copy = DictionaryObject({key: copy_object(value) for key, value in page.items() if key != '/Parent'})
+                for key in _INHERITED_PAGE_KEYS:
+                    if key not in page_copy:
+                        inherited = _inherited_page_attribute(page, key)
+                        if inherited is not None:
+                            page_copy[NameObject(key)] = copy_object(inherited)
+                page_copy[NameObject('/Parent')] = IndirectObject(2, 0, None)
+                self._write(page_id, page_copy)
+                self._page_ids.append(page_id)
+                self.pages += 1
+                while pending: # Resources of this page not already copied with an earlier one
+                    obj = pending.popleft()
+                    self._write(id_map[(obj.idnum, obj.generation)], copy_object(obj.get_object()))
+
+    def close(self):
+        """Writes the page tree, catalog and cross-reference table, and moves the file into place."""
+        self._write(2, DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): ArrayObject(IndirectObject(page_id, 0, None) for page_id in self._page_ids),
+            NameObject('/Count'): NumberObject(len(self._page_ids)),
+        }))
+        self._write(1, DictionaryObject({
+            NameObject('/Type'): NameObject('/Catalog'),
+            NameObject('/Pages'): IndirectObject(2, 0, None),
+        }))
+        xref_offset = self._file.tell()
+        self._file.write(f"xref\n0 {len(self._offsets)}\n0000000000 65535 f \n".encode('ascii'))
+        for offset in self._offsets[1:]:
+            self._file.write(f"{offset:010d} 00000 n \n".encode('ascii'))
+        self._file.write(f"trailer\n<< /Size {len(self._offsets)} /Root 1 0 R >>\n"
+                         f"startxref\n{xref_offset}\n%%EOF\n".encode('ascii'))
+        self._file.close()
+        os.replace(self._temp_path, self.output_file)
+
+
+def _inherited_page_attribute(page, key):
+    """Looks up a page attribute on the page's ancestors in the page tree."""
+    node = page.get('/Parent')
+    while node is not None:
+        node = node.get_object()
+        if key in node:
+            return node[key]
+        node = node.get('/Parent')
+    return None
+
+
+def write_volumes(folder_fragments, fragment_directory, volume_file, max_pages=0, max_bytes=0):
+    """Merges folder fragments into one or more volumes, only ever splitting between folders.
+
+    folder_fragments maps folder_path -> fragment, in document order. volume_file(n) names
+    volume n, counting from 1. A new volume is started when the next folder would take the
+    current one over max_pages pages or (going by fragment sizes) max_bytes; 0 means no
+    limit. A folder bigger than the limits gets a volume of its own.
+
+    Returns the index as a list of (folder_path, volume_file, first_page, pages).
+    """
+    index = []
+    concatenator = None
+    volume_number = 0
+    volume_bytes = 0
+    for folder_path, fragment in folder_fragments.items():
+        part_paths = [os.path.join(fragment_directory, part) for part in fragment['parts']]
+        folder_bytes = sum(os.path.getsize(path) for path in part_paths)
+        if concatenator and concatenator.pages and (
+                (max_pages and concatenator.pages + fragment['pages'] > max_pages)
+                or (max_bytes and volume_bytes + folder_bytes > max_bytes)):
+            concatenator.close()
+            concatenator = None
+        if concatenator is None:
+            volume_number += 1
+            concatenator = PdfConcatenator(volume_file(volume_number))
+            volume_bytes = 0
+        first_page = concatenator.pages + 1
+        for path in part_paths:
+            concatenator.append(path)
+        volume_bytes += folder_bytes
+        index.append((folder_path, concatenator.output_file, first_page, concatenator.pages - first_page + 1))
+    if concatenator:
+        concatenator.close()
+    return index
+
+
+def write_index(index, index_file, bucket_name):
+    """Writes a tab-separated index of which volume and page each folder starts on."""
+    temp_path = index_file + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write("Folder\tVolume\tPage\tPages\n")
+        for folder_path, volume_file, first_page, pages in index:
+            f.write(f"s3://{bucket_name}/{folder_path}\t{os.path.basename(volume_file)}\t{first_page}\t{pages}\n")
+    os.replace(temp_path, index_file)
+
+
+def remove_stale_fragments(fragment_directory, manifest):
+    """Deletes fragment part files the manifest no longer refers to.
+
+    Only files named like fragment parts are touched, so other PDFs in the directory
+    (e.g. the contact sheet itself, if it is written there) are left alone.
+    """
+    in_use = {part for entry in manifest['folders'].values() for part in entry['parts']}
+    removed = 0
+    for entry in os.scandir(fragment_directory):
+        if FRAGMENT_PART_NAME.fullmatch(entry.name) and entry.name not in in_use:
+            os.remove(entry.path)
+            removed += 1
+    if removed:
+        logging.info(f"Removed {removed} stale fragments from {fragment_directory}")
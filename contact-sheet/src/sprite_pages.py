@@ -0,0 +1,88 @@
+import io
+import logging
+import os
+
+from PIL import Image
+from reportlab.lib.utils import ImageReader
+
+# Pillow format name and file extension for the standalone page images
+PAGE_IMAGE_FORMATS = {'jpeg': ('JPEG', 'jpg'), 'webp': ('WEBP', 'webp')}
+
+
+class SpritePageCanvas:
+    """Stands in for a canvas, drawing all of a page's images as one composite raster.
+
+    drawImage calls are pasted into a single image covering the grid of cells at
+    layout['sprite_dpi']. Everything else (headers, filenames) is held back until the
+    page is finished and then drawn as vector text on top of the composite, so a page
+    costs the PDF viewer one image decode instead of one per cell.
+
+    If layout['sprite_page_directory'] is set, every composite is also saved there as a
+    standalone JPEG or WebP file named <page_image_name>_001.jpg, _002.jpg, ...
+    """
+
+    def __init__(self, c, layout, page_image_name):
+        self._canvas = c
+        self._grid_x = layout['margin']
+        self._grid_y = layout['margin']
+        self._grid_width = layout['columns'] * layout['cell_width']
+        self._grid_height = layout['rows'] * layout['cell_height']
+        self._scale = layout['sprite_dpi'] / 72.0
+        self._quality = layout['sprite_quality']
+        self._page_directory = layout['sprite_page_directory']
+        self._page_format = layout['sprite_page_format']
+        self._page_image_name = page_image_name
+        self._page_images_saved = 0
+        self._composite = None
+        self._deferred = [] # (method name, args, kwargs) drawn after the composite
+
+    def _to_pixels(self, x, y):
+        """Converts a point on the page to pixel coordinates in the composite (top-left origin)."""
+        return (round((x - self._grid_x) * self._scale),
+                round((self._grid_y + self._grid_height - y) * self._scale))
+
+    def drawImage(self, image, x, y, width, height, **kwargs):
+        """Pastes an ImageReader's image into the page composite at its place in the grid."""
+        pixels = image.getRGBData() # Sets image.mode to L, RGB or CMYK
+        cell_image = Image.frombytes(image.mode, image.getSize(), pixels).convert('RGB')
+        left, top = self._to_pixels(x, y + height)
+        right, bottom = self._to_pixels(x + width, y)
+        size = (max(1, right - left), max(1, bottom - top))
+        if cell_image.size != size:
+            cell_image = cell_image.resize(size, Image.LANCZOS)
+        if self._composite is None:
+            self._composite = Image.new('RGB', self._to_pixels(self._grid_x + self._grid_width, self._grid_y), 'white')
+        self._composite.paste(cell_image, (left, top))
+
+    def __getattr__(self, name):
+        def deferred_call(*args, **kwargs):
+            self._deferred.append((name, args, kwargs))
+        return deferred_call
+
+    def flush(self):
+        """Draws the current page's composite and the held-back text, without ending the page."""
+        if self._composite is not None:
+            jpeg_stream = io.BytesIO()
+            self._composite.save(jpeg_stream, 'JPEG', quality=self._quality)
+            jpeg_stream.seek(0)
+            self._canvas.drawImage(ImageReader(jpeg_stream), self._grid_x, self._grid_y,
+                                   width=self._grid_width, height=self._grid_height)
+            if self._page_directory:
+                self._save_page_image()
+            self._composite = None
+        for name, args, kwargs in self._deferred:
+            getattr(self._canvas, name)(*args, **kwargs)
+        self._deferred = []
+
+    def _save_page_image(self):
+        pil_format, extension = PAGE_IMAGE_FORMATS[self._page_format]
+        self._page_images_saved += 1
+        path = os.path.join(self._page_directory, f"{self._page_image_name}_{self._page_images_saved:03d}.{extension}")
+        try:
+            self._composite.save(path, pil_format, quality=self._quality)
+        except (OSError, KeyError) as e: # KeyError if Pillow was built without WebP support
+            logging.warning(f"Failed to save page image {path}: {e}")
+
+    def showPage(self):
+        self.flush()
+        self._canvas.showPage()
@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+# Each entry is a small header with the original image size followed by the downscaled JPEG
+ENTRY_HEADER = struct.Struct('>II')
+ENTRY_SUFFIX = '.thumb'
+# Temporary files are named <entry>.<pid>.<thread>.tmp while being written. One whose
+# writer is gone, or that is older than this, was left behind by an interrupted write.
+STALE_TEMP_SECONDS = 3600
+# Several processes (render workers, concurrent runs) can share a cache directory, so
+# the directory is re-scanned after this fraction of max_bytes has been written, and
+# whenever the cache looks full, to bring in the entries the others wrote
+RESCAN_FRACTION = 0.1
+
+
+class ThumbnailCache:
+    """On-disk cache of downscaled contact sheet images, with least-recently-used eviction.
+
+    Entries are keyed by bucket, object key, ETag and a description of the thumbnail's
+    target size, so a changed object (new ETag) or a changed layout is simply a miss.
+    File modification times record recency across runs. Safe to use from several threads,
+    and from several processes sharing the directory.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # path -> size in bytes, least recently used first
+        self._total_bytes = 0
+        self._bytes_since_scan = 0
+        self._scanning = False
+        os.makedirs(directory, exist_ok=True)
+        self._rescan(remove_stale_temp_files=True)
+        logging.info(f"Thumbnail cache {self.directory}: {len(self._entries)} entries, "
+                     f"{self._total_bytes / 1e6:.1f} MB of {self.max_bytes / 1e6:.1f} MB")
+
+    def _scan(self, remove_stale_temp_files):
+        """Returns (path, size) for every entry on disk, least recently used first."""
+        found = []
+        now = time.time()
+        for sub_dir in os.scandir(self.directory):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                try:
+                    if entry.name.endswith(ENTRY_SUFFIX):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime, entry.path, stat.st_size))
+                    elif remove_stale_temp_files and entry.name.endswith('.tmp') and is_stale_temp_file(entry, now):
+                        os.remove(entry.path)
+                except OSError:
+                    pass # Evicted or renamed by another process meanwhile
+        return [(path, size) for _, path, size in sorted(found)]
+
+    def _rescan(self, remove_stale_temp_files=False):
+        """Re-indexes the directory, then evicts until the whole cache fits in max_bytes."""
+        found = self._scan(remove_stale_temp_files)
+        with self._lock:
+            self._entries = OrderedDict(found)
+            self._total_bytes = sum(size for _, size in found)
+            self._bytes_since_scan = 0
+            self._scanning = False
+            self._evict()
+
+    def _path(self, bucket_name, object_key, etag, target):
+        digest = hashlib.sha256('\0'.join((bucket_name, object_key, etag, target)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + ENTRY_SUFFIX)
+
+    def get(self, bucket_name, object_key, etag, target):
+        """Returns (jpeg_bytes, original_size) for a cached image, or None."""
+        path = self._path(bucket_name, object_key, etag, target)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path) # Mark as recently used for the next run
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        if len(data) <= ENTRY_HEADER.size:
+            # Truncated, e.g. by a crash before the write reached the disk; drop it so it is written again
+            logging.warning(f"Removing truncated thumbnail cache entry {path}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            with self._lock:
+                self.misses += 1
+                self._total_bytes -= self._entries.pop(path, 0)
+            return None
+        with self._lock:
+            self.hits += 1
+            if path in self._entries:
+                self._entries.move_to_end(path)
+        width, height = ENTRY_HEADER.unpack_from(data)
+        return data[ENTRY_HEADER.size:], (width, height)
+
+    def put(self, bucket_name, object_key, etag, target, jpeg_bytes, original_size):
+        """Stores a downscaled image, evicting the least recently used entries if over size."""
+        path = self._path(bucket_name, object_key, etag, target)
+        data = ENTRY_HEADER.pack(*original_size) + jpeg_bytes
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path) # Readers never see a partial entry
+        except OSError as e:
+            logging.warning(f"Failed to write thumbnail cache entry for {object_key}: {e}")
+            return
+        with self._lock:
+            self._total_bytes += len(data) - self._entries.pop(path, 0)
+            self._entries[path] = len(data)
+            self._bytes_since_scan += len(data)
+            rescan = not self._scanning and (self._total_bytes > self.max_bytes
+                                             or self._bytes_since_scan >= self.max_bytes * RESCAN_FRACTION)
+            if rescan:
+                self._scanning = True
+        if rescan:
+            self._rescan()
+
+    def _evict(self):
+        """Removes least recently used entries until the cache fits in max_bytes. Needs the lock."""
+        while self._total_bytes > self.max_bytes and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def take_stats(self):
+        """Returns and resets the hit/miss/eviction counts, so a render worker can hand them back."""
+        with self._lock:
+            stats = {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+            self.hits = self.misses = self.evictions = 0
+        return stats
+
+    def log_stats(self):
+        log_cache_stats(self.hits, self.misses, self.evictions)
+        logging.info(f"Thumbnail cache holds {len(self._entries)} entries using {self._total_bytes / 1e6:.1f} MB.")
+
+
+def is_stale_temp_file(entry, now):
+    """True for a temporary file whose writer has exited, or that has been there too long."""
+    if now - entry.stat().st_mtime > STALE_TEMP_SECONDS:
+        return True
+    try:
+        pid = int(entry.name.split('.')[-3])
+    except (IndexError, ValueError):
+        return False
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0) # Only checks that the process exists
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass # Exists, but belongs to another user
+    return False
+
+
+def log_cache_stats(hits, misses, evictions):
+    lookups = hits + misses
+    hit_rate = 100.0 * hits / lookups if lookups else 0.0
+    logging.info(f"Thumbnail cache: {hits} hits, {misses} misses ({hit_rate:.0f}% hit rate), {evictions} evictions.")
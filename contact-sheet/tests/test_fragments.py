@@ -0,0 +1,134 @@
+import csv
+import sys
+from pathlib import Path
+
+import pytest
+
+pypdf = pytest.importorskip('pypdf')
+pytest.importorskip('reportlab')
+from PIL import Image
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+import fragments
+
+BUCKET = 'photos'
+
+
+def write_part(path, folder_path, first_page, pages):
+    """Writes a fragment part whose pages say which folder and page they are, with an image shared by all of them."""
+    image = ImageReader(Image.new('RGB', (32, 24), 'red'))
+    c = canvas.Canvas(str(path), pagesize=A4)
+    for page in range(first_page, first_page + pages):
+        c.drawString(72, 720, f"{folder_path} page {page}")
+        c.drawImage(image, 72, 600, width=64, height=48)
+        c.showPage()
+    c.save()
+
+
+@pytest.fixture
+def folder_fragments(tmp_path):
+    """Four folders of 2, 3, 1 and 4 pages; the second is split into two parts."""
+    layout = {'a/': [2], 'b/': [2, 1], 'c/': [1], 'd/': [4]}
+    folder_fragments = {}
+    for number, (folder_path, part_pages) in enumerate(layout.items()):
+        parts = []
+        first_page = 1
+        for part_number, pages in enumerate(part_pages):
+            part = f"{number:064x}-{part_number:03d}.pdf"
+            write_part(tmp_path / part, folder_path, first_page, pages)
+            parts.append(part)
+            first_page += pages
+        folder_fragments[folder_path] = {'parts': parts, 'pages': sum(part_pages)}
+    return folder_fragments
+
+
+def check_xref(pdf_path):
+    """Checks that every cross-reference entry points at its object, which pypdf would otherwise quietly repair."""
+    data = Path(pdf_path).read_bytes()
+    xref_offset = int(data[data.rindex(b'startxref') + len(b'startxref'):].split()[0])
+    lines = data[xref_offset:].split(b'\n')
+    assert lines[0] == b'xref'
+    first, count = map(int, lines[1].split())
+    assert first == 0
+    for object_id, line in enumerate(lines[2:2 + count]):
+        offset, _, kind = line.split()
+        if kind == b'n':
+            assert data[int(offset):].startswith(f"{object_id} 0 obj".encode('ascii'))
+
+
+def page_labels(pdf_path):
+    """Returns the 'folder page n' line of every page, checking on the way that the file parses strictly."""
+    check_xref(pdf_path)
+    reader = pypdf.PdfReader(str(pdf_path), strict=True)
+    return [page.extract_text().strip() for page in reader.pages]
+
+
+def expected_labels(folder_fragments, folder_paths):
+    return [f"{folder_path} page {page}" for folder_path in folder_paths
+            for page in range(1, folder_fragments[folder_path]['pages'] + 1)]
+
+
+def test_concatenation_keeps_page_order(tmp_path, folder_fragments):
+    output_file = tmp_path / 'sheet.pdf'
+
+    index = fragments.write_volumes(folder_fragments, str(tmp_path), lambda number: str(output_file))
+
+    assert page_labels(output_file) == expected_labels(folder_fragments, folder_fragments)
+    assert index == [('a/', str(output_file), 1, 2), ('b/', str(output_file), 3, 3),
+                     ('c/', str(output_file), 6, 1), ('d/', str(output_file), 7, 4)]
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_page_limit_splits_between_folders(tmp_path, folder_fragments):
+    volume_file = lambda number: str(tmp_path / f"sheet_vol{number:03d}.pdf")
+
+    index = fragments.write_volumes(folder_fragments, str(tmp_path), volume_file, max_pages=3)
+
+    # d/ has more pages than the limit, so it gets a volume of its own
+    assert index == [('a/', volume_file(1), 1, 2), ('b/', volume_file(2), 1, 3),
+                     ('c/', volume_file(3), 1, 1), ('d/', volume_file(4), 1, 4)]
+    index = fragments.write_volumes(folder_fragments, str(tmp_path), volume_file, max_pages=4)
+    assert index == [('a/', volume_file(1), 1, 2), ('b/', volume_file(2), 1, 3),
+                     ('c/', volume_file(2), 4, 1), ('d/', volume_file(3), 1, 4)]
+    assert page_labels(volume_file(1)) == expected_labels(folder_fragments, ['a/'])
+    assert page_labels(volume_file(2)) == expected_labels(folder_fragments, ['b/', 'c/'])
+    assert page_labels(volume_file(3)) == expected_labels(folder_fragments, ['d/'])
+
+
+def test_byte_limit_splits_between_folders(tmp_path, folder_fragments):
+    def folder_bytes(folder_path):
+        return sum((tmp_path / part).stat().st_size for part in folder_fragments[folder_path]['parts'])
+    volume_file = lambda number: str(tmp_path / f"sheet_vol{number:03d}.pdf")
+
+    index = fragments.write_volumes(folder_fragments, str(tmp_path), volume_file,
+                                    max_bytes=folder_bytes('a/') + folder_bytes('b/'))
+
+    assert index[:3] == [('a/', volume_file(1), 1, 2), ('b/', volume_file(1), 3, 3), ('c/', volume_file(2), 1, 1)]
+    for volume in sorted({volume for _, volume, _, _ in index}):
+        folder_paths = [folder_path for folder_path, v, _, _ in index if v == volume]
+        assert page_labels(volume) == expected_labels(folder_fragments, folder_paths)
+
+
+def test_index_lists_each_folder_volume_and_page(tmp_path, folder_fragments):
+    volume_file = lambda number: str(tmp_path / f"sheet_vol{number:03d}.pdf")
+    index = fragments.write_volumes(folder_fragments, str(tmp_path), volume_file, max_pages=4)
+    index_file = tmp_path / 'index.tsv'
+
+    fragments.write_index(index, str(index_file), BUCKET)
+
+    with open(index_file, newline='', encoding='utf-8') as f:
+        rows = list(csv.reader(f, delimiter='\t'))
+    assert rows == [
+        ['Folder', 'Volume', 'Page', 'Pages'],
+        ['s3://photos/a/', 'sheet_vol001.pdf', '1', '2'],
+        ['s3://photos/b/', 'sheet_vol002.pdf', '1', '3'],
+        ['s3://photos/c/', 'sheet_vol002.pdf', '4', '1'],
+        ['s3://photos/d/', 'sheet_vol003.pdf', '1', '4'],
+    ]
+    # Every row points at the pages of its folder
+    for folder_path, volume, first_page, pages in rows[1:]:
+        labels = page_labels(tmp_path / volume)[int(first_page) - 1:int(first_page) - 1 + int(pages)]
+        assert labels == expected_labels(folder_fragments, [folder_path[len('s3://photos/'):]])
@@ -0,0 +1,121 @@
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, List, NamedTuple, Optional
+
+from PIL import Image, ImageOps
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+from ordered_map import map_in_order
+
+# A PDF contact sheet of near-duplicate groups: each group starts on a new row under a
+# heading, with a cell per image captioned with its file name, where it is and its size,
+# so the copies can be compared side by side. Images are decoded straight down to the
+# cell size with Pillow's draft mode.
+
+DPI = 150 # Resolution of the images drawn in the cells
+JPEG_QUALITY = 80
+GUTTER = 4 # Points between images
+
+
+class SheetImage(NamedTuple):
+    location: str # 's3://bucket' or 'local'
+    path: str # S3 key or local path
+    width: int
+    height: int
+
+
+def fit_to_cell(img_width, img_height, cell_width, max_img_height):
+    """Returns the (width, height) in points an image is drawn at within a cell, never scaled up."""
+    scale = min(1.0, cell_width / img_width, max_img_height / img_height)
+    return img_width * scale, img_height * scale
+
+
+def cell_jpeg(image_stream, cell_width, max_img_height) -> Optional[io.BytesIO]:
+    """Decodes an image at the size it is drawn at, re-encoded as a small JPEG, or None if it can't be decoded."""
+    try:
+        with Image.open(image_stream) as img:
+            # Draft to the larger side both ways, so it is big enough whichever way the image is rotated
+            longest = max(1, round(max(cell_width, max_img_height) * DPI / 72.0))
+            img.draft('RGB', (longest, longest)) # Picks the smallest DCT scale still >= that
+            img = ImageOps.exif_transpose(img.convert('RGB'))
+            draw_width, draw_height = fit_to_cell(*img.size, cell_width, max_img_height)
+            target_size = (max(1, round(draw_width * DPI / 72.0)), max(1, round(draw_height * DPI / 72.0)))
+            if img.size != target_size:
+                img = img.resize(target_size, Image.LANCZOS)
+            jpeg_stream = io.BytesIO()
+            img.save(jpeg_stream, 'JPEG', quality=JPEG_QUALITY)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logging.warning(f"Failed to decode image for the contact sheet: {e}")
+        return None
+    jpeg_stream.seek(0)
+    return jpeg_stream
+
+
+def write_duplicate_sheet(output_file: str, groups: List[List[SheetImage]], open_image: Callable[[SheetImage], Optional[BinaryIO]],
+                          layout: dict, workers: int = 8):
+    """Draws the groups onto an A4 PDF.
+
+    open_image(image) returns a stream of the image's bytes, or None; it is called on
+    workers threads, a few groups ahead of the drawing. layout has 'columns', 'rows',
+    'margin', 'header_font_size' and 'filename_font_size', as in the contact sheet.
+    """
+    page_width, page_height = A4
+    margin = layout['margin']
+    columns = layout['columns']
+    heading_height = layout['header_font_size'] * 1.8
+    caption_height = layout['filename_font_size'] * 3.0 # Two lines below each image
+    cell_width = (page_width - 2 * margin) / columns
+    cell_height = (page_height - 2 * margin) / layout['rows']
+    max_img_height = cell_height - caption_height
+    max_img_width = cell_width - GUTTER
+
+    def load(image):
+        image_stream = open_image(image)
+        return cell_jpeg(image_stream, max_img_width, max_img_height) if image_stream else None
+
+    c = canvas.Canvas(output_file, pagesize=A4)
+    c.setTitle("Near-duplicate images")
+    y = page_height - margin # Top of the space left on the page
+    all_images = (image for group in groups for image in group)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sheet-fetch') as executor:
+        cell_images = (result for _, result in map_in_order(executor, load, all_images, 4 * workers))
+        for group_number, group in enumerate(groups, 1):
+            def draw_heading(text):
+                nonlocal y
+                c.setFont("Helvetica-Bold", layout['header_font_size'])
+                c.drawString(margin, y - layout['header_font_size'], text)
+                y -= heading_height
+
+            # Keep a heading with at least its first row of images
+            if y - heading_height - cell_height < margin:
+                c.showPage()
+                y = page_height - margin
+            draw_heading(f"Group {group_number} ({len(group)} images)")
+            for position, image in enumerate(group):
+                column = position % columns
+                if position and column == 0:
+                    y -= cell_height
+                    if y - cell_height < margin:
+                        c.showPage()
+                        y = page_height - margin
+                        draw_heading(f"Group {group_number} (continued)")
+                x = margin + column * cell_width
+                jpeg_stream = next(cell_images)
+                if jpeg_stream:
+                    draw_width, draw_height = fit_to_cell(image.width, image.height, max_img_width, max_img_height)
+                    c.drawImage(ImageReader(jpeg_stream), x + (cell_width - draw_width) / 2, y - draw_height,
+                                width=draw_width, height=draw_height)
+                else:
+                    c.setFont("Helvetica", layout['filename_font_size'])
+                    c.drawCentredString(x + cell_width / 2, y - max_img_height / 2, "Could not load image")
+                c.setFont("Helvetica", layout['filename_font_size'])
+                caption_y = y - max_img_height - layout['filename_font_size'] * 1.2
+                c.drawCentredString(x + cell_width / 2, caption_y, os.path.basename(image.path)[:40])
+                c.drawCentredString(x + cell_width / 2, caption_y - layout['filename_font_size'] * 1.2,
+                                    f"{'Local' if image.location == 'local' else 'S3'}, {image.width}x{image.height}")
+            y -= cell_height
+    c.save()
@@ -0,0 +1,253 @@
+import os
+import io
+import sys
+import boto3
+from botocore.config import Config as BotoConfig
+import configparser
+import logging
+from pathlib import Path
+import re # For sanitizing filename
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'shared' / 'src'))
+from parallel_walk import walk_files
+from s3_listing import list_objects, read_inventory
+from perceptual_hash import ImageHashes, image_hashes
+from hamming_index import group_near_duplicates
+from hash_index import HashIndex
+from duplicate_sheet import SheetImage, write_duplicate_sheet
+from instrumentation import metrics, instrument_s3_client, read_instrumentation_config, start_run
+
+# --- Configuration ---
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+CONFIG_FILE = 'config.ini'
+VALID_JPEG_EXTENSIONS = {'.jpg', '.jpeg', '.jpe', '.jif', '.jfif', '.jfi'} # Compared in lower case
+HASH_ALGORITHMS = ('phash', 'dhash')
+
+# --- Helper Functions ---
+
+def read_config(filename=CONFIG_FILE):
+    """Reads configuration from the INI file."""
+    config = configparser.ConfigParser()
+    script_dir = Path(__file__).resolve().parent
+    filename = script_dir / filename
+    if not os.path.exists(filename):
+        logging.error(f"Configuration file '{filename}' not found.")
+        raise FileNotFoundError(f"Configuration file '{filename}' not found.")
+    config.read(filename)
+    try:
+        s3_config = config['S3']
+        for section in ('Matching', 'Layout'):
+            if not config.has_section(section):
+                config.add_section(section) # All matching and layout settings are optional
+        matching_config = config['Matching']
+        layout_config = config['Layout']
+        hash_algorithm = matching_config.get('HashAlgorithm', 'phash').strip().lower()
+        if hash_algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f"HashAlgorithm must be one of {', '.join(HASH_ALGORITHMS)}, not '{hash_algorithm}'")
+        return {
+            'bucket_name': s3_config.get('BucketName', ''), # Empty only looks for duplicates locally
+            'start_folder': s3_config.get('StartFolder', ''),
+            'local_folder': os.path.expanduser(s3_config.get('LocalFolder', '')), # Empty only looks in S3
+            'inventory_manifest': os.path.expanduser(s3_config.get('InventoryManifest', '')), # Empty lists the bucket
+            'hash_algorithm': hash_algorithm,
+            'max_distance': min(32, max(0, int(matching_config.get('MaxDistance', 6)))),
+            'hash_workers': max(1, int(matching_config.get('HashWorkers', 8))),
+            'list_workers': max(1, int(matching_config.get('ListWorkers', 1))),
+            'walk_workers': max(1, int(matching_config.get('WalkWorkers', 8))),
+            'hash_index_file': os.path.expanduser(matching_config.get('HashIndexFile', '')), # Empty disables the index
+            'contact_sheet': matching_config.getboolean('ContactSheet', False),
+            'columns': int(layout_config.get('Columns', 4)),
+            'rows': int(layout_config.get('Rows', 6)),
+            'margin': float(layout_config.get('Margin', 36)), # Points
+            'header_font_size': int(layout_config.get('HeaderFontSize', 12)),
+            'filename_font_size': int(layout_config.get('FilenameFontSize', 8)),
+            'instrumentation': read_instrumentation_config(config, 'duplicates_metrics.json'),
+        }
+    except KeyError as e:
+        logging.error(f"Missing configuration key: {e}")
+        raise KeyError(f"Missing configuration key in '{filename}': {e}")
+    except ValueError as e:
+         logging.error(f"Invalid value in configuration: {e}")
+         raise ValueError(f"Invalid value in configuration file '{filename}': {e}")
+
+def sanitize_filename(name):
+    """Removes or replaces characters invalid for filenames."""
+    # Remove leading/trailing whitespace and slashes
+    name = name.strip().strip('/')
+    # Replace slashes with underscores
+    name = name.replace('/', '_')
+    # Remove other potentially problematic characters (adjust regex as needed)
+    name = re.sub(r'[\\:*?"<>|]+', '', name)
+    return name if name else "default"
+
+def is_jpeg_name(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in VALID_JPEG_EXTENSIONS
+
+
+class ImageFile(NamedTuple):
+    """An image to hash: an S3 object (location 's3://bucket') or a local file (location 'local')."""
+    location: str
+    path: str # S3 key or local path
+    version: str # ETag, or mtime in nanoseconds, so changed images are hashed again
+    size: int
+
+
+def get_s3_images(s3_client, bucket_name: str, prefix: str, list_workers: int = 1, inventory_manifest: str = '') -> Iterator[ImageFile]:
+    """Yields the JPEG objects under prefix, listed on list_workers threads or read from an S3 Inventory report."""
+    if inventory_manifest:
+        listing = read_inventory(inventory_manifest, prefix)
+    else:
+        listing = list_objects(s3_client, bucket_name, prefix, list_workers)
+    for obj in listing:
+        if is_jpeg_name(obj['Key']):
+            yield ImageFile(f"s3://{bucket_name}", obj['Key'], obj.get('ETag', ''), obj['Size'])
+
+def get_local_images(directory: str, walk_workers: int = 8) -> Iterator[ImageFile]:
+    """Yields the JPEG files below directory, listing directories on walk_workers threads."""
+    for entry in walk_files(directory, walk_workers):
+        if is_jpeg_name(entry.name):
+            yield ImageFile('local', entry.path, str(entry.mtime_ns), entry.size)
+
+def open_image(s3_client, image) -> Optional[io.BytesIO]:
+    """Reads a whole ImageFile or SheetImage into memory (S3 objects need downloading anyway). Returns None on failure."""
+    try:
+        if image.location == 'local':
+            with open(image.path, 'rb') as f:
+                return io.BytesIO(f.read())
+        response = s3_client.get_object(Bucket=image.location[len('s3://'):], Key=image.path)
+        return io.BytesIO(response['Body'].read())
+    except Exception as e:
+        logging.warning(f"Failed to read {describe(image)}: {e}")
+        return None
+
+def hash_image(s3_client, image: ImageFile) -> Tuple[bool, Optional[ImageHashes]]:
+    """Downloads or reads an image and returns (whether it could be read, its perceptual hashes or None).
+
+    Runs on the hash threads.
+    """
+    with metrics.stage('read'):
+        image_stream = open_image(s3_client, image)
+    if image_stream is None:
+        return False, None
+    with metrics.stage('hash'):
+        hashes = image_hashes(image_stream)
+    if hashes is None:
+        logging.warning(f"Skipping image that can't be decoded: {describe(image)}")
+    return True, hashes
+
+def hash_images(images: Iterator[ImageFile], s3_client, workers: int,
+                index: Optional[HashIndex] = None) -> List[Tuple[ImageFile, ImageHashes]]:
+    """Returns (image, hashes) for every image that decodes, hashing on workers threads.
+
+    With a HashIndex, unchanged images are taken from the index and only new or changed
+    ones are read. The index is only touched from this (the main) thread.
+    """
+    hashed = []
+    to_hash = []
+    for image in metrics.iterate('listing', images):
+        metrics.count('images_listed')
+        known = index.get(*image) if index else None
+        if known:
+            hashed.append((image, known))
+        elif known is None:
+            to_hash.append(image)
+        # False: known not to decode, and unchanged since
+    logging.info(f"Hashing {len(to_hash)} images ({len(hashed)} taken from the hash index).")
+    metrics.start_progress("Hashing images", len(to_hash))
+    metrics.count('images_hashed', len(to_hash))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hash') as executor:
+        results = executor.map(lambda image: hash_image(s3_client, image), to_hash)
+        for done, (image, (read, hashes)) in enumerate(zip(to_hash, results), 1):
+            metrics.advance()
+            if index and read: # A failed read is tried again next time
+                index.put(*image, hashes)
+                if done % 1000 == 0:
+                    index.commit() # Keep the work done so far if the run is interrupted
+            if hashes:
+                hashed.append((image, hashes))
+            if done % 1000 == 0:
+                logging.info(f"Hashed {done} of {len(to_hash)} images.")
+    return hashed
+
+def describe(image: ImageFile) -> str:
+    return f"{image.location}/{image.path}" if image.location != 'local' else image.path
+
+def describe_with_size(image: ImageFile, hashes: ImageHashes) -> str:
+    return f"{describe(image)} [{hashes.width}x{hashes.height}]"
+
+def write_report(of, heading: str, groups: List[list], first_number: int = 1):
+    """Writes a report section with one line per group: the S3 images <--> the local images."""
+    print(f"\n\n\n{heading} ({len(groups)}):", file=of)
+    for number, group in enumerate(groups, first_number):
+        s3_side = [describe_with_size(image, hashes) for image, hashes in group if image.location != 'local']
+        local_side = [describe_with_size(image, hashes) for image, hashes in group if image.location == 'local']
+        print(f"Group {number} ({len(group)}):\t" + " <--> ".join(", ".join(side) for side in (s3_side, local_side) if side), file=of)
+
+def main():
+    try:
+        config = read_config()
+    except (FileNotFoundError, KeyError, ValueError) as e:
+        logging.critical(f"Configuration error: {e}")
+        exit(1)
+
+    # Stage timers, progress line and metrics file; written out however the run ends
+    start_run(config['instrumentation'], 'duplicates')
+
+    BUCKET_NAME = config['bucket_name']
+    START_FOLDER = config['start_folder']
+    LOCAL_FOLDER = config['local_folder']
+    HASH_WORKERS = config['hash_workers']
+
+    # boto3 clients are thread-safe; size the connection pool to match the workers
+    s3 = instrument_s3_client(boto3.client('s3', config=BotoConfig(max_pool_connections=max(HASH_WORKERS, config['list_workers']))))
+    # Remembers the hashes of unchanged images between runs
+    index = HashIndex(config['hash_index_file']) if config['hash_index_file'] else None
+
+    hashed = []
+    if BUCKET_NAME:
+        hashed += hash_images(get_s3_images(s3, BUCKET_NAME, START_FOLDER, config['list_workers'], config['inventory_manifest']),
+                              s3, HASH_WORKERS, index)
+        if index:
+            index.prune(f"s3://{BUCKET_NAME}", START_FOLDER)
+    if LOCAL_FOLDER:
+        local_root = os.path.abspath(LOCAL_FOLDER)
+        hashed += hash_images(get_local_images(local_root, config['walk_workers']), s3, HASH_WORKERS, index)
+        if index:
+            index.prune('local', local_root.rstrip(os.sep) + os.sep)
+    if index:
+        index.log_stats()
+        index.close()
+
+    # Groups of images linked by chains of hashes within MaxDistance bits
+    hash_values = [getattr(hashes, config['hash_algorithm']) for _, hashes in hashed]
+    with metrics.stage('group'):
+        groups = [[hashed[number] for number in members] for members in group_near_duplicates(hash_values, config['max_distance'])]
+    groups.sort(key=lambda group: (-len(group), describe(group[0][0])))
+    logging.info(f"{len(groups)} groups of near-duplicates among {len(hashed)} images.")
+
+    in_both, s3_only, local_only = [], [], []
+    for group in groups:
+        has_local = any(image.location == 'local' for image, _ in group)
+        has_s3 = any(image.location != 'local' for image, _ in group)
+        (in_both if has_local and has_s3 else local_only if has_local else s3_only).append(group)
+    groups = in_both + s3_only + local_only # Numbered in this order in the report and the contact sheet
+
+    name = sanitize_filename(START_FOLDER if BUCKET_NAME else os.path.basename(LOCAL_FOLDER.rstrip(os.sep)))
+    with open("Duplicates "+name+".txt", "w") as f:
+        print(f"Near-duplicates: {config['hash_algorithm']} within {config['max_distance']} bits", file=f)
+        write_report(f, "Groups in both S3 and local", in_both)
+        write_report(f, "Groups in S3 only", s3_only, len(in_both) + 1)
+        write_report(f, "Groups in local only", local_only, len(in_both) + len(s3_only) + 1)
+
+    if config['contact_sheet'] and groups:
+        sheet_groups = [[SheetImage(image.location, image.path, hashes.width, hashes.height) for image, hashes in group]
+                        for group in groups]
+        with metrics.stage('contact_sheet'):
+            write_duplicate_sheet("Duplicates "+name+".pdf", sheet_groups, lambda image: open_image(s3, image), config, HASH_WORKERS)
+        logging.info(f"Contact sheet of {len(groups)} groups written to Duplicates {name}.pdf")
+
+if __name__ == "__main__":
+    main()
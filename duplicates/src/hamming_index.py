@@ -0,0 +1,115 @@
+import itertools
+import math
+from collections import defaultdict
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+from perceptual_hash import HASH_BITS, hamming_distance
+
+# Finding all pairs of hashes within a Hamming distance without comparing every pair, using
+# multi-index hashing (Norouzi et al.). Each hash is split into m chunks, each indexed in its
+# own table. If two hashes differ in at most r bits, then by the pigeonhole principle some
+# chunk differs in at most r // m bits, so every match is found by probing each table with
+# the values within r // m bits of the query's chunk. Candidates are then checked in full.
+
+
+def best_chunk_count(count: int, max_distance: int, bits: int = HASH_BITS) -> int:
+    """Picks the number of chunks that minimises the estimated work of finding all pairs.
+
+    Fewer, wider chunks need more probes per bucket (every value within the chunk radius);
+    more, narrower chunks put more unrelated hashes in each bucket. The estimate is the
+    number of probes plus the number of candidate pairs, assuming evenly spread hashes.
+    More than max_distance + 1 chunks never helps: every match already agrees exactly on
+    some chunk.
+    """
+    def cost(chunk_count):
+        width = bits // chunk_count
+        probes = sum(math.comb(width, radius) for radius in range(max_distance // chunk_count + 1))
+        buckets = min(count, 2 ** width)
+        return chunk_count * (buckets * probes + count * count * probes / 2 ** width / 2)
+
+    return min(range(1, min(max_distance + 1, bits) + 1), key=cost)
+
+
+class MultiIndexHash:
+    """An index of hashes that finds those within max_distance bits of a query."""
+
+    def __init__(self, hashes: Sequence[int], max_distance: int, bits: int = HASH_BITS):
+        self.hashes = hashes
+        self.max_distance = max_distance
+        self.chunk_count = best_chunk_count(len(hashes), max_distance, bits)
+        widths = [bits // self.chunk_count + (i < bits % self.chunk_count) for i in range(self.chunk_count)]
+        self.chunks = [] # (shift, width) of each chunk
+        shift = bits
+        for width in widths:
+            shift -= width
+            self.chunks.append((shift, width))
+        self.chunk_radius = max_distance // self.chunk_count
+        self.tables: List[Dict[int, List[int]]] = [defaultdict(list) for _ in self.chunks]
+        for number, value in enumerate(hashes):
+            for table, (shift, width) in zip(self.tables, self.chunks):
+                table[(value >> shift) & ((1 << width) - 1)].append(number)
+        # Bit masks within max chunk_radius bits, for probing each table
+        self._probe_masks = {width: [sum(1 << bit for bit in flipped)
+                                     for radius in range(self.chunk_radius + 1)
+                                     for flipped in itertools.combinations(range(width), radius)]
+                             for width in set(widths)}
+
+    def query(self, value: int) -> Iterator[Tuple[int, int]]:
+        """Yields (number, distance) for each indexed hash within max_distance of value."""
+        seen = set()
+        for table, (shift, width) in zip(self.tables, self.chunks):
+            chunk = (value >> shift) & ((1 << width) - 1)
+            for mask in self._probe_masks[width]:
+                for number in table.get(chunk ^ mask, ()):
+                    if number in seen:
+                        continue
+                    seen.add(number)
+                    distance = hamming_distance(value, self.hashes[number])
+                    if distance <= self.max_distance:
+                        yield number, distance
+
+    def pairs(self) -> Iterator[Tuple[int, int, int]]:
+        """Yields (i, j, distance) for every pair of indexed hashes within max_distance, with i < j.
+
+        Joins each table's buckets with the buckets within chunk_radius bits of them, rather
+        than querying hash by hash, so most of the work is a dict lookup per bucket and mask.
+        """
+        found = set() # A pair may agree closely on more than one chunk
+        hashes = self.hashes
+        for table, (_, width) in zip(self.tables, self.chunks):
+            masks = self._probe_masks[width]
+            for chunk, members in table.items():
+                candidates = itertools.combinations(members, 2) if len(members) > 1 else iter(())
+                # Each pair of buckets once, from the one with the smaller chunk value
+                near = [table[chunk ^ mask] for mask in masks[1:] if chunk ^ mask > chunk and chunk ^ mask in table]
+                for i, j in itertools.chain(candidates, *(itertools.product(members, others) for others in near)):
+                    distance = hamming_distance(hashes[i], hashes[j])
+                    if distance <= self.max_distance:
+                        pair = (i, j) if i < j else (j, i)
+                        if pair not in found:
+                            found.add(pair)
+                            yield (*pair, distance)
+
+
+def group_near_duplicates(hashes: Sequence[int], max_distance: int) -> List[List[int]]:
+    """Groups the numbers of hashes that are linked by chains of pairs within max_distance.
+
+    Returns groups of two or more, each sorted, in order of their first member.
+    """
+    parent = list(range(len(hashes)))
+
+    def find(number):
+        while parent[number] != number:
+            parent[number] = parent[parent[number]] # Path halving
+            number = parent[number]
+        return number
+
+    for i, j, _ in MultiIndexHash(hashes, max_distance).pairs():
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    groups = defaultdict(list)
+    for number in range(len(hashes)):
+        groups[find(number)].append(number)
+    return [members for _, members in sorted(groups.items()) if len(members) > 1]
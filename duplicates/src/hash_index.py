@@ -0,0 +1,90 @@
+import logging
+import sqlite3
+from typing import Optional
+
+from perceptual_hash import ImageHashes
+
+# A persistent index of perceptual hashes, so repeated runs only download and decode new or
+# changed images. Rows are keyed by location ('s3://bucket' or 'local') and path (S3 key or
+# local path), and only trusted while the image's version (ETag for S3, mtime for local
+# files) and size are the same as when it was hashed.
+
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS images (
+    location TEXT, path TEXT, version TEXT, size INTEGER,
+    width INTEGER, height INTEGER, dhash TEXT, phash TEXT, run INTEGER,
+    PRIMARY KEY (location, path));
+"""
+
+
+class HashIndex:
+    """SQLite index of the perceptual hashes of images in S3 and local folders.
+
+    Images that couldn't be decoded are remembered too (with NULL hashes), so they aren't
+    downloaded again until they change. Not thread-safe: use it from the main thread only.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0 # Hashes served from the index
+        self.misses = 0
+        self._db = sqlite3.connect(path)
+        self._db.executescript(_SCHEMA)
+        version = self._get_meta('schema_version')
+        if version is not None and int(version) != SCHEMA_VERSION:
+            logging.info(f"Hash index {path} is from a different version; rebuilding it.")
+            self._db.executescript("DROP TABLE images; DELETE FROM meta;")
+            self._db.executescript(_SCHEMA)
+        self._set_meta('schema_version', SCHEMA_VERSION)
+        self.run = int(self._get_meta('last_run') or 0) + 1
+        self._db.commit()
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def get(self, location: str, path: str, version: str, size: int):
+        """Returns the indexed ImageHashes if the image hasn't changed, False if it is known not to
+        decode, or None if it has to be hashed. Marks the row as seen in this run."""
+        row = self._db.execute("SELECT version, size, width, height, dhash, phash FROM images WHERE location = ? AND path = ?",
+                               (location, path)).fetchone()
+        if row is None or row[0] != version or row[1] != size:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._db.execute("UPDATE images SET run = ? WHERE location = ? AND path = ?", (self.run, location, path))
+        if row[4] is None:
+            return False
+        return ImageHashes(int(row[4], 16), int(row[5], 16), row[2], row[3])
+
+    def put(self, location: str, path: str, version: str, size: int, hashes: Optional[ImageHashes]):
+        """Records the hashes of an image, or None if it couldn't be decoded."""
+        # Hex text, since SQLite integers are signed 64-bit
+        values = (hashes.width, hashes.height, f"{hashes.dhash:016x}", f"{hashes.phash:016x}") if hashes else (None,) * 4
+        self._db.execute("INSERT OR REPLACE INTO images (location, path, version, size, width, height, dhash, phash, run) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (location, path, version, size, *values, self.run))
+
+    def prune(self, location: str, prefix: str = ''):
+        """Deletes rows of location under prefix that weren't seen in this run."""
+        # Everything starting with prefix sorts between prefix and prefix + U+10FFFF
+        removed = self._db.execute("DELETE FROM images WHERE location = ? AND run != ? AND path >= ? AND path < ?",
+                                   (location, self.run, prefix, prefix + '\U0010ffff')).rowcount
+        if removed:
+            logging.info(f"Pruned {removed} deleted images of {location} from the hash index.")
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._set_meta('last_run', self.run)
+        self._db.commit()
+        self._db.close()
+
+    def log_stats(self):
+        logging.info(f"Hash index {self.path}: {self.hits} images served from the index, {self.misses} hashed.")
@@ -0,0 +1,73 @@
+import math
+from typing import NamedTuple, Optional
+
+from PIL import Image, ImageOps
+
+# Perceptual hashes of images: 64-bit fingerprints that stay (nearly) the same when a photo
+# is resized, recompressed or lightly edited, so copies can be found by Hamming distance.
+# Both hashes only need a tiny grayscale image, so JPEGs are decoded with Pillow's draft
+# mode (DCT scaling by 1/2, 1/4 or 1/8), and the full-resolution pixels are never decoded.
+
+HASH_BITS = 64
+DECODE_SIZE = 64 # Smallest size the draft decode may go down to; the hashes resample from it
+_PHASH_SIZE = 32 # pHash takes the DCT of a 32x32 image...
+_PHASH_LOW = 8 # ...and keeps its 8x8 lowest frequencies
+_ORIENTATION_TAG = 0x0112
+_ROTATED_ORIENTATIONS = {5, 6, 7, 8} # Orientations that swap width and height
+
+# Rows of the DCT-II matrix for the lowest frequencies, as a 1-D basis for 32 samples
+_DCT_BASIS = [[math.cos(math.pi * (2 * n + 1) * k / (2 * _PHASH_SIZE)) for n in range(_PHASH_SIZE)]
+              for k in range(_PHASH_LOW)]
+
+
+class ImageHashes(NamedTuple):
+    dhash: int
+    phash: int
+    width: int # Of the original image
+    height: int
+
+
+def dhash(gray: Image.Image) -> int:
+    """Difference hash: whether each pixel is brighter than its right neighbour, on a 9x8 image."""
+    pixels = list(gray.resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            value = (value << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return value
+
+
+def phash(gray: Image.Image) -> int:
+    """DCT hash: whether each of the 8x8 lowest frequencies of a 32x32 image is above their median."""
+    pixels = list(gray.resize((_PHASH_SIZE, _PHASH_SIZE), Image.LANCZOS).getdata())
+    rows = [pixels[i:i + _PHASH_SIZE] for i in range(0, len(pixels), _PHASH_SIZE)]
+    # Separable 2-D DCT, computing only the low frequencies: rows first, then columns
+    row_dct = [[sum(b * p for b, p in zip(basis, row)) for basis in _DCT_BASIS] for row in rows]
+    low = [sum(_DCT_BASIS[v][n] * row_dct[n][u] for n in range(_PHASH_SIZE))
+           for v in range(_PHASH_LOW) for u in range(_PHASH_LOW)]
+    median = sorted(low[1:])[len(low) // 2 - 1] # Ignore the DC term, which is just the brightness
+    value = 0
+    for coefficient in low:
+        value = (value << 1) | (coefficient > median)
+    return value
+
+
+def image_hashes(image_stream) -> Optional[ImageHashes]:
+    """Decodes an image at reduced size and returns its hashes, or None if it can't be decoded.
+
+    EXIF orientation is applied first, so a rotated copy hashes like the original.
+    """
+    try:
+        with Image.open(image_stream) as img:
+            width, height = img.size
+            if img.getexif().get(_ORIENTATION_TAG, 1) in _ROTATED_ORIENTATIONS:
+                width, height = height, width # As displayed
+            img.draft('L', (DECODE_SIZE, DECODE_SIZE)) # Picks the smallest DCT scale still >= 64x64
+            gray = ImageOps.exif_transpose(img.convert('L'))
+            return ImageHashes(dhash(gray), phash(gray), width, height)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
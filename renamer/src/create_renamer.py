@@ -1,63 +1,153 @@
+import argparse
+import configparser
 import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+from pathlib import Path
 import piexif
 import datetime
 
-def rename_images_by_exif_date(target_directory, source_directory, output_filename="rename_commands.sh"):
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'shared' / 'src'))
+from parallel_walk import walk_files
+from jpeg_exif import read_exif_segment, DEFAULT_HEADER_BYTES
+from rename_journal import RenameJournal, apply_renames, undo_renames, JOURNAL_FILENAME
+from rename_state import RenameState, STATE_FILENAME
+from instrumentation import metrics, read_instrumentation_config, start_run
+
+CONFIG_FILE = 'config.ini'
+
+# EXIF date tags tried in order, as (IFD, tag)
+DATE_TAGS = (
+    ("0th", piexif.ImageIFD.DateTime),
+    ("Exif", piexif.ExifIFD.DateTimeOriginal),
+    ("Exif", piexif.ExifIFD.DateTimeDigitized),
+)
+
+def exif_filename_base(filepath, header_bytes=DEFAULT_HEADER_BYTES):
     """
-    Renames JPEG images in a source directory and its subdirectories based on EXIF date/time,
-    moving all renamed files to the target directory.
+    Returns (new filename base, warning) for one image, reading only its EXIF (APP1) segment.
+
+    The base is None if the file is skipped, and the warning says why. This runs in the
+    worker processes, so warnings are returned to be printed in order by the caller.
+    """
+    try:
+        with open(filepath, "rb") as f:
+            def read_prefix(length):
+                f.seek(0)
+                return f.read(length)
+            payload, data = read_exif_segment(read_prefix, header_bytes)
+        if payload is None:
+            if not data.startswith(b"\xff\xd8"):
+                raise piexif.InvalidImageDataError("Given file is neither JPEG nor TIFF.")
+            exif_dict = {"0th": {}, "Exif": {}} # A JPEG without EXIF data
+        else:
+            exif_dict = piexif.load(payload)
+        for ifd, tag in DATE_TAGS:
+            if tag in exif_dict[ifd]:
+                date_time_str = exif_dict[ifd][tag].decode("utf-8")
+                date_time_obj = datetime.datetime.strptime(date_time_str, "%Y:%m:%d %H:%M:%S")
+                return date_time_obj.strftime("%Y-%m-%d-%H-%M"), None
+        return None, f"Warning: No EXIF date/time found for {filepath}. Skipping."
+    except (piexif.InvalidImageDataError, KeyError, ValueError, OSError) as e: # OSError: e.g. deleted since the walk
+        return None, f"Warning: Error processing {filepath}: {e}. Skipping."
+
+def plan_renames(target_directory, source_directory, walk_workers=8, exif_workers=None, state=None, settle_seconds=0):
+    """
+    Works out the new name of every JPEG image under the source directory, based on EXIF date/time.
+
+    The target directory is listed once, and clashes are checked against that listing in memory.
+    Names are compared ignoring case, as on the default macOS and Windows filesystems.
+
+    With a RenameState, only files that haven't been processed before (at their current size
+    and mtime) are read. Counters and taken names come from the state instead of the target
+    listing, and the files are marked processed in it; the caller decides whether to commit.
 
     Args:
         target_directory (str): The directory where renamed files will be moved.
         source_directory (str): The directory containing the images to be renamed.
-        output_filename (str): The name of the output script file.
+        walk_workers (int): Number of directories listed in parallel (helps on network mounts).
+        exif_workers (int): Number of processes reading EXIF data (defaults to the number of CPUs; 1 reads in this process).
+        state (RenameState): State of earlier incremental runs, or None to process every file.
+        settle_seconds (float): Files modified more recently than this are left for a later run, as they may still be being copied.
+
+    Returns:
+        list: (source path, target path) pairs.
     """
 
-    rename_commands = []
+    renames = []
     file_counters = {}  # Dictionary to track file name counters
 
     files_to_process = []
-    for root, _, files in os.walk(source_directory):
-        for filename in files:
-            if filename.lower().endswith(".jpg") or filename.lower().endswith(".jpeg"):
-                files_to_process.append(os.path.join(root, filename))
-
-    for filepath in files_to_process:
-        try:
-            exif_dict = piexif.load(filepath)
-            if piexif.ImageIFD.DateTime in exif_dict["0th"]:
-                date_time_str = exif_dict["0th"][piexif.ImageIFD.DateTime].decode("utf-8")
-                date_time_obj = datetime.datetime.strptime(date_time_str, "%Y:%m:%d %H:%M:%S")
-                new_filename_base = date_time_obj.strftime("%Y-%m-%d-%H-%M")
-            elif piexif.ExifIFD.DateTimeOriginal in exif_dict["Exif"]:
-                date_time_str = exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal].decode("utf-8")
-                date_time_obj = datetime.datetime.strptime(date_time_str, "%Y:%m:%d %H:%M:%S")
-                new_filename_base = date_time_obj.strftime("%Y-%m-%d-%H-%M")
-            elif piexif.ExifIFD.DateTimeDigitized in exif_dict["Exif"]:
-                date_time_str = exif_dict["Exif"][piexif.ExifIFD.DateTimeDigitized].decode("utf-8")
-                date_time_obj = datetime.datetime.strptime(date_time_str, "%Y:%m:%d %H:%M:%S")
-                new_filename_base = date_time_obj.strftime("%Y-%m-%d-%H-%M")
-            else:
-                print(f"Warning: No EXIF date/time found for {filepath}. Skipping.")
+    settled_before_ns = time.time_ns() - int(settle_seconds * 1e9)
+    for entry in metrics.iterate('walk', walk_files(source_directory, walk_workers)):
+        metrics.count('files_found')
+        if entry.name.lower().endswith(".jpg") or entry.name.lower().endswith(".jpeg"):
+            if state and state.is_processed(entry.path, entry.size, entry.mtime_ns):
+                continue
+            if settle_seconds and entry.mtime_ns > settled_before_ns:
                 continue
-        except (piexif.InvalidImageDataError, KeyError, ValueError) as e:
-            print(f"Warning: Error processing {filepath}: {e}. Skipping.")
+            files_to_process.append(entry)
+
+    filepaths = [entry.path for entry in files_to_process]
+    exif_workers = exif_workers or os.cpu_count() or 1
+    metrics.start_progress("Reading EXIF data", len(filepaths))
+    with metrics.stage('read_exif'):
+        if exif_workers > 1 and len(filepaths) > 1:
+            with ProcessPoolExecutor(max_workers=exif_workers) as executor:
+                results = []
+                for result in executor.map(exif_filename_base, filepaths, chunksize=32):
+                    results.append(result)
+                    metrics.advance()
+        else:
+            results = []
+            for filepath in filepaths:
+                results.append(exif_filename_base(filepath))
+                metrics.advance()
+    metrics.count('exif_read', len(filepaths))
+
+    dated_files = []
+    for entry, (new_filename_base, warning) in zip(files_to_process, results):
+        if warning:
+            print(warning)
+            if state:
+                state.mark_processed(entry.path, entry.size, entry.mtime_ns) # Not read again unless it changes
             continue
+        dated_files.append((new_filename_base, entry))
+    # A stable sort keeps files with the same base in walk order, so counters never depend on timing
+    dated_files.sort(key=itemgetter(0))
+
+    if state:
+        existing_names = state.target_names
+        file_counters = state.counters
+    else:
+        existing_names = {name.casefold() for name in os.listdir(target_directory)} if os.path.isdir(target_directory) else set()
 
+    for new_filename_base, entry in dated_files:
+        filepath = entry.path
         new_filename_counter = file_counters.get(new_filename_base, 0)
         new_filename = f"{new_filename_base}-{new_filename_counter:02d}.JPG"
-        new_filepath = os.path.join(target_directory, new_filename)
 
-        while os.path.exists(new_filepath):
+        while new_filename.casefold() in existing_names:
             new_filename_counter += 1
             new_filename = f"{new_filename_base}-{new_filename_counter:02d}.JPG"
-            new_filepath = os.path.join(target_directory, new_filename)
 
         file_counters[new_filename_base] = new_filename_counter + 1
+        existing_names.add(new_filename.casefold())
+        if state:
+            state.mark_processed(entry.path, entry.size, entry.mtime_ns, new_filename)
+
+        renames.append((filepath, os.path.join(target_directory, new_filename)))
 
-        rename_commands.append(f'mv "{filepath}" "{new_filepath}"')
+    metrics.count('renames_planned', len(renames))
+    return renames
 
-    with open(output_filename, "w") as f:
+def write_rename_script(renames, output_filename="rename_commands.sh"):
+    """Writes the renames as a bash script of mv commands, to review and run later (the dry run)."""
+    rename_commands = [f'mv "{source}" "{target}"' for source, target in renames]
+
+    with metrics.stage('write_script'), open(output_filename, "w") as f:
         f.write("#!/bin/bash\n")
         f.write("set -e\n")
         f.write("set -u\n")
@@ -67,11 +157,159 @@ def rename_images_by_exif_date(target_directory, source_directory, output_filena
 
     print(f"Rename commands written to {output_filename}")
 
-if __name__ == "__main__":
-    target_dir = "/Users/john_skelton/Documents/202503 - India"  # Replace with the target directory
-    source_dir = "/Users/john_skelton/Documents/202503 - India/Johns Phone"  # Replace with the source directory
+def rename_images_by_exif_date(target_directory, source_directory, output_filename="rename_commands.sh", walk_workers=8,
+                               exif_workers=None):
+    """
+    Writes a script of mv commands that rename the JPEG images in a source directory and its
+    subdirectories based on EXIF date/time, moving them all to the target directory.
+
+    Args:
+        target_directory (str): The directory where renamed files will be moved.
+        source_directory (str): The directory containing the images to be renamed.
+        output_filename (str): The name of the output script file.
+        walk_workers (int): Number of directories listed in parallel (helps on network mounts).
+        exif_workers (int): Number of processes reading EXIF data (defaults to the number of CPUs; 1 reads in this process).
+    """
+    write_rename_script(plan_renames(target_directory, source_directory, walk_workers, exif_workers), output_filename)
+
+def execute_renames(target_directory, source_directory, journal_path=JOURNAL_FILENAME, walk_workers=8, exif_workers=None,
+                    state=None):
+    """
+    Renames the JPEG images straight away with os.rename, recording the plan and each batch of
+    renames in the journal so the run can be resumed or undone. With a RenameState, only new
+    files are renamed.
+    """
+    journal = RenameJournal(journal_path)
+    if _unfinished(journal):
+        return 0
+    return _rename_files(target_directory, source_directory, journal, walk_workers, exif_workers, state)
+
+def watch_renames(target_directory, source_directory, state, journal_path=JOURNAL_FILENAME, interval=5, settle_seconds=2,
+                  walk_workers=8, exif_workers=None):
+    """Polls the source directory every interval seconds, renaming new files as they arrive, until interrupted."""
+    journal = RenameJournal(journal_path)
+    if _unfinished(journal):
+        return
+    print(f"Watching {source_directory} for new images every {interval} seconds. Press Ctrl+C to stop.")
+    try:
+        while True:
+            _rename_files(target_directory, source_directory, journal, walk_workers, exif_workers, state, settle_seconds, quiet=True)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
 
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir) #create target dir if not exists
+def _rename_files(target_directory, source_directory, journal, walk_workers, exif_workers, state=None, settle_seconds=0, quiet=False):
+    renames = plan_renames(target_directory, source_directory, walk_workers, exif_workers, state, settle_seconds)
+    if not renames:
+        if state:
+            state.commit() # Remembers files that were skipped
+        if not quiet:
+            print("No files to rename.")
+        return 0
+    journal.record("begin", renames, source_directory=source_directory, target_directory=target_directory)
+    if state:
+        state.commit() # The new names are reserved before any file moves
+    moved, failed = apply_renames(renames, journal)
+    if state and failed:
+        for source, _ in failed:
+            state.forget(source) # Tried again next run, under a new name
+        state.commit()
+    print(f"Renamed {moved} of {len(renames)} files. Journal written to {journal.path}")
+    return moved
 
-    rename_images_by_exif_date(target_dir, source_dir)
\ No newline at end of file
+def resume_renames(journal_path=JOURNAL_FILENAME):
+    """Finishes the renames of the journal's last session after a crash or interruption."""
+    journal = RenameJournal(journal_path)
+    session = journal.last_session()
+    if session is None:
+        print(f"Nothing to resume: no journal at {journal_path}")
+        return 0
+    pending = _pending(session)
+    moved, _ = apply_renames(pending, journal)
+    print(f"Renamed {moved} of {len(pending)} remaining files.")
+    return moved
+
+def _pending(session):
+    return [(source, target) for source, target in session["renames"]
+            if source not in session["done"] and source not in session["failed"]]
+
+def _unfinished(journal):
+    """True (after saying so) if the journal's last session still has renames left."""
+    session = journal.last_session()
+    if session and _pending(session):
+        print(f"The last run in {journal.path} didn't finish ({len(_pending(session))} renames left). "
+              f"Use --resume to finish it or --undo to reverse it.")
+        return True
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description="Rename JPEG images by their EXIF date/time and move them to a target directory. "
+                                                 "By default a script of mv commands is written for review (a dry run).")
+    parser.add_argument("--target", default="/Users/john_skelton/Documents/202503 - India",
+                        help="Directory the renamed files are moved to")
+    parser.add_argument("--source", default="/Users/john_skelton/Documents/202503 - India/Johns Phone",
+                        help="Directory tree containing the images to rename")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--execute", action="store_true", help="Rename the files now instead of writing a script")
+    mode.add_argument("--resume", action="store_true", help="Finish the last --execute run from its journal")
+    mode.add_argument("--undo", action="store_true", help="Move the files renamed by the last --execute run back")
+    mode.add_argument("--watch", action="store_true", help="Keep renaming new files as they arrive (implies --execute and --state)")
+    parser.add_argument("--script", default="rename_commands.sh", help="Script written in a dry run (default: %(default)s)")
+    parser.add_argument("--journal", default=JOURNAL_FILENAME, help="Journal of renames for resume and undo (default: %(default)s)")
+    parser.add_argument("--state", default=None,
+                        help=f"State file of processed files, so only new files are renamed (default with --watch: {STATE_FILENAME})")
+    parser.add_argument("--interval", type=float, default=5, help="Seconds between polls with --watch (default: %(default)s)")
+    parser.add_argument("--settle", type=float, default=2,
+                        help="Seconds a file must be unmodified before --watch renames it (default: %(default)s)")
+    parser.add_argument("--walk-workers", type=int, default=8, help="Directories listed in parallel (default: %(default)s)")
+    parser.add_argument("--exif-workers", type=int, default=None, help="Processes reading EXIF data (default: the number of CPUs)")
+    args = parser.parse_args()
+
+    # Stage timers, progress line and metrics file, set up in an optional config.ini next to the script
+    config = configparser.ConfigParser()
+    config.read(Path(__file__).resolve().parent / CONFIG_FILE) # A missing file reads as empty
+    try:
+        start_run(read_instrumentation_config(config, 'rename_metrics.json'), 'renamer', report=print)
+    except ValueError as e:
+        print(f"Error: Invalid value in {CONFIG_FILE}: {e}")
+        sys.exit(1)
+
+    if args.resume:
+        resume_renames(args.journal)
+        return
+
+    if not os.path.exists(args.target):
+        os.makedirs(args.target) #create target dir if not exists
+
+    state_path = args.state or (STATE_FILENAME if args.watch else None)
+    try:
+        state = RenameState(state_path, args.target) if state_path else None
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    try:
+        if args.undo:
+            journal = RenameJournal(args.journal)
+            moved = undo_renames(journal)
+            print(f"Moved {moved} files back.")
+            if state and moved:
+                session = journal.last_session()
+                for source, target in session["renames"]:
+                    if source in session["undone"]:
+                        state.forget(source) # Back in the source directory, to be renamed again
+                        state.target_names.discard(os.path.basename(target).casefold())
+                state.commit()
+        elif args.watch:
+            watch_renames(args.target, args.source, state, args.journal, args.interval, args.settle, args.walk_workers, args.exif_workers)
+        elif args.execute:
+            execute_renames(args.target, args.source, args.journal, args.walk_workers, args.exif_workers, state)
+        else:
+            # A dry run plans against the state but never commits to it
+            write_rename_script(plan_renames(args.target, args.source, args.walk_workers, args.exif_workers, state), args.script)
+    finally:
+        if state:
+            state.close()
+
+if __name__ == "__main__":
+    main()
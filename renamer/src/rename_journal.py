@@ -0,0 +1,149 @@
+import errno
+import json
+import os
+import shutil
+import time
+from collections import defaultdict
+
+from instrumentation import metrics
+
+# Applying a rename plan in this process, with an append-only journal. The journal is a
+# JSON-lines file: each run starts a session with a "begin" line listing the plan, then
+# appends a line per batch of renames done (or failed), and per batch undone. After a
+# crash, resume replays the last session's plan, skipping what is already done; undo
+# moves the last session's files back, newest first.
+
+JOURNAL_FILENAME = "rename_journal.jsonl"
+
+
+class RenameJournal:
+    """The sessions of renames recorded in an append-only journal file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def last_session(self):
+        """
+        Returns the last session as a dict with "renames" (the planned (source, target) pairs)
+        and the sets "done", "failed" and "undone" of sources, or None if there is no session.
+        """
+        session = None
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # A line cut short by a crash
+                if entry["op"] == "begin":
+                    session = {"renames": [tuple(pair) for pair in entry["renames"]], "done": set(), "failed": set(), "undone": set()}
+                elif session is not None:
+                    session[entry["op"]].update(source for source, _ in entry["renames"])
+        return session
+
+    def record(self, op, renames, **details):
+        """Appends one line and makes sure it is on disk before returning."""
+        if not renames and op != "begin":
+            return
+        with open(self.path, "a+b") as f:
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n") # Ends a line cut short by a crash, which would otherwise swallow this one
+            f.write((json.dumps({"op": op, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), **details,
+                                "renames": [list(pair) for pair in renames]}) + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def move_file(source, target):
+    """Renames source to target, copying across filesystems like mv does."""
+    try:
+        os.rename(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(source, target)
+
+
+def _by_directory(renames):
+    """Groups (source, target) pairs by the directory of the source, keeping their order."""
+    batches = defaultdict(list)
+    for source, target in renames:
+        batches[os.path.dirname(source)].append((source, target))
+    return batches.values()
+
+
+def apply_renames(renames, journal):
+    """
+    Moves each source to its target, one source directory at a time, recording each batch in the journal.
+
+    A target that already exists is never overwritten. A pair whose source has gone but whose
+    target exists was moved before a crash, and is recorded as done. Returns (number moved,
+    failed (source, target) pairs).
+    """
+    moved = 0
+    all_failed = []
+    metrics.start_progress("Renaming files", len(renames))
+    for batch in _by_directory(renames):
+        done, failed = [], []
+        for source, target in batch:
+            metrics.advance()
+            if not os.path.lexists(source):
+                if os.path.lexists(target):
+                    done.append((source, target)) # Moved, but not recorded before a crash
+                else:
+                    print(f"Warning: {source} no longer exists. Skipping.")
+                    failed.append((source, target))
+                continue
+            if os.path.lexists(target):
+                print(f"Warning: {target} already exists. Skipping {source}.")
+                failed.append((source, target))
+                continue
+            try:
+                with metrics.stage('rename'):
+                    move_file(source, target)
+            except OSError as e:
+                print(f"Warning: Error moving {source} to {target}: {e}. Skipping.")
+                failed.append((source, target))
+                continue
+            done.append((source, target))
+            moved += 1
+        with metrics.stage('journal'):
+            journal.record("done", done)
+            journal.record("failed", failed)
+        all_failed.extend(failed)
+    metrics.count('files_moved', moved)
+    metrics.count('files_failed', len(all_failed))
+    return moved, all_failed
+
+
+def undo_renames(journal):
+    """Moves the files renamed in the journal's last session back, newest first. Returns the number moved."""
+    session = journal.last_session()
+    if session is None:
+        print(f"Nothing to undo: no journal at {journal.path}")
+        return 0
+    to_undo = [(source, target) for source, target in reversed(session["renames"])
+               if source in session["done"] and source not in session["undone"]]
+    moved = 0
+    for batch in _by_directory(to_undo):
+        undone = []
+        for source, target in batch:
+            if os.path.lexists(source) or not os.path.lexists(target):
+                if os.path.lexists(source) and not os.path.lexists(target):
+                    undone.append((source, target)) # Moved back, but not recorded before a crash
+                else:
+                    print(f"Warning: Can't move {target} back to {source}. Skipping.")
+                continue
+            try:
+                os.makedirs(os.path.dirname(source), exist_ok=True)
+                move_file(target, source)
+            except OSError as e:
+                print(f"Warning: Error moving {target} back to {source}: {e}. Skipping.")
+                continue
+            undone.append((source, target))
+            moved += 1
+        journal.record("undone", undone)
+    return moved
@@ -0,0 +1,93 @@
+import os
+import sqlite3
+
+# Persistent state for incremental runs of the renamer. It remembers which source files have
+# been processed (keyed by path, size and mtime, so a changed or replaced file is processed
+# again), the next counter for each filename base, and every name taken in the target
+# directory. The target is listed once, when the state is created; after that, clashes are
+# checked against the state rather than the disk.
+
+STATE_FILENAME = "rename_state.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS processed (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, new_name TEXT);
+CREATE TABLE IF NOT EXISTS counters (base TEXT PRIMARY KEY, next_counter INTEGER);
+CREATE TABLE IF NOT EXISTS target_names (name TEXT PRIMARY KEY);
+"""
+
+
+class _TargetNames:
+    """The names taken in the target directory, compared ignoring case, as a set-like view of the state."""
+
+    def __init__(self, db):
+        self._db = db
+
+    def __contains__(self, name):
+        return self._db.execute("SELECT 1 FROM target_names WHERE name = ?", (name,)).fetchone() is not None
+
+    def add(self, name):
+        self._db.execute("INSERT OR IGNORE INTO target_names (name) VALUES (?)", (name,))
+
+    def discard(self, name):
+        self._db.execute("DELETE FROM target_names WHERE name = ?", (name,))
+
+
+class _Counters:
+    """The next counter for each filename base, as a dict-like view of the state."""
+
+    def __init__(self, db):
+        self._db = db
+
+    def get(self, base, default=0):
+        row = self._db.execute("SELECT next_counter FROM counters WHERE base = ?", (base,)).fetchone()
+        return row[0] if row else default
+
+    def __setitem__(self, base, next_counter):
+        self._db.execute("INSERT OR REPLACE INTO counters (base, next_counter) VALUES (?, ?)", (base, next_counter))
+
+
+class RenameState:
+    """
+    SQLite state of an incremental rename from one source directory into one target directory.
+
+    Changes are only kept once commit() is called, so a dry run can plan against the state
+    without changing it. Not thread-safe: use it from the main process only.
+    """
+
+    def __init__(self, path, target_directory):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.executescript(_SCHEMA)
+        self.target_names = _TargetNames(self._db)
+        self.counters = _Counters(self._db)
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'target_directory'").fetchone()
+        if row is None:
+            # The only time the target is listed; from now on every name given out is recorded here
+            self._db.execute("INSERT INTO meta (key, value) VALUES ('target_directory', ?)", (os.path.abspath(target_directory),))
+            if os.path.isdir(target_directory):
+                self._db.executemany("INSERT OR IGNORE INTO target_names (name) VALUES (?)",
+                                     ((name.casefold(),) for name in os.listdir(target_directory)))
+            self._db.commit()
+        elif row[0] != os.path.abspath(target_directory):
+            self._db.close()
+            raise ValueError(f"State file {path} belongs to target directory {row[0]}, not {target_directory}.")
+
+    def is_processed(self, path, size, mtime_ns):
+        row = self._db.execute("SELECT size, mtime_ns FROM processed WHERE path = ?", (path,)).fetchone()
+        return row is not None and row[0] == size and row[1] == mtime_ns
+
+    def mark_processed(self, path, size, mtime_ns, new_name=None):
+        """Records a source file as handled; new_name is None if it was skipped (e.g. no EXIF date)."""
+        self._db.execute("INSERT OR REPLACE INTO processed (path, size, mtime_ns, new_name) VALUES (?, ?, ?, ?)",
+                         (path, size, mtime_ns, new_name))
+
+    def forget(self, path):
+        """Forgets a source file, so the next run processes it again."""
+        self._db.execute("DELETE FROM processed WHERE path = ?", (path,))
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.close() # Uncommitted changes are rolled back
@@ -0,0 +1,113 @@
+import io
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import piexif
+import pytest
+from PIL import Image
+
+SRC = Path(__file__).resolve().parents[1] / 'src'
+sys.path.insert(0, str(SRC))
+from create_renamer import plan_renames
+from rename_journal import RenameJournal, move_file
+
+
+def write_photo(path, date_time):
+    exif = piexif.dump({'Exif': {piexif.ExifIFD.DateTimeOriginal: date_time.encode('ascii')}})
+    out = io.BytesIO()
+    Image.new('RGB', (8, 8), 'red').save(out, 'JPEG', exif=exif)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(out.getvalue())
+
+
+def run_renamer(tmp_path, *args):
+    """Runs the renamer as a user would, from tmp_path so the metrics file lands there."""
+    result = subprocess.run([sys.executable, str(SRC / 'create_renamer.py'), '--source', str(tmp_path / 'source'),
+                             '--target', str(tmp_path / 'target'), '--journal', str(tmp_path / 'journal.jsonl'),
+                             '--exif-workers', '1', *args],
+                            cwd=tmp_path, capture_output=True, text=True, check=True)
+    return result.stdout
+
+
+@pytest.fixture
+def photos(tmp_path):
+    """Five photos in two source directories, returned as {path: contents}."""
+    write_photo(tmp_path / 'source' / 'a' / 'IMG_1.jpg', '2024:03:01 10:00:00')
+    write_photo(tmp_path / 'source' / 'a' / 'IMG_2.jpg', '2024:03:01 10:00:30') # Same minute as IMG_1
+    write_photo(tmp_path / 'source' / 'a' / 'IMG_3.jpg', '2024:03:02 09:15:00')
+    write_photo(tmp_path / 'source' / 'b' / 'IMG_4.jpg', '2024:03:03 18:45:00')
+    write_photo(tmp_path / 'source' / 'b' / 'IMG_5.jpg', '2024:03:04 07:30:00')
+    (tmp_path / 'target').mkdir()
+    return {path: path.read_bytes() for path in sorted((tmp_path / 'source').rglob('*.jpg'))}
+
+
+def interrupted_run(tmp_path):
+    """Starts a run the way --execute does, then stops as if it had crashed part way.
+
+    The first rename is journalled, the second is made but not journalled, and the
+    journal ends with a line cut short. Returns the planned (source, target) pairs.
+    """
+    renames = plan_renames(str(tmp_path / 'target'), str(tmp_path / 'source'), exif_workers=1)
+    journal = RenameJournal(str(tmp_path / 'journal.jsonl'))
+    journal.record('begin', renames, source_directory=str(tmp_path / 'source'), target_directory=str(tmp_path / 'target'))
+    move_file(*renames[0])
+    journal.record('done', renames[:1])
+    move_file(*renames[1])
+    with open(journal.path, 'a', encoding='utf-8') as f:
+        f.write('{"op": "do')
+    return renames
+
+
+def test_execute_and_undo(tmp_path, photos):
+    run_renamer(tmp_path, '--execute')
+
+    assert sorted(os.listdir(tmp_path / 'target')) == [
+        '2024-03-01-10-00-00.JPG', '2024-03-01-10-00-01.JPG', '2024-03-02-09-15-00.JPG',
+        '2024-03-03-18-45-00.JPG', '2024-03-04-07-30-00.JPG']
+    assert not list((tmp_path / 'source').rglob('*.jpg'))
+
+    output = run_renamer(tmp_path, '--undo')
+
+    assert 'Moved 5 files back.' in output
+    assert {path: path.read_bytes() for path in sorted((tmp_path / 'source').rglob('*.jpg'))} == photos
+    assert not os.listdir(tmp_path / 'target')
+
+
+def test_resume_finishes_an_interrupted_run(tmp_path, photos):
+    renames = interrupted_run(tmp_path)
+
+    # A new run refuses to start while the last one is unfinished
+    output = run_renamer(tmp_path, '--execute')
+    assert "didn't finish (4 renames left)" in output
+    assert len(os.listdir(tmp_path / 'target')) == 2
+
+    output = run_renamer(tmp_path, '--resume')
+
+    # The rename made before the crash is recognised, not reported as missing
+    assert 'Renamed 3 of 4 remaining files.' in output
+    assert 'Warning' not in output
+    for source, target in renames:
+        assert not os.path.exists(source)
+        assert Path(target).read_bytes() == photos[Path(source)]
+    session = RenameJournal(str(tmp_path / 'journal.jsonl')).last_session()
+    assert session['done'] == {source for source, _ in renames}
+    assert not session['failed']
+
+
+def test_undo_reverses_an_interrupted_run(tmp_path, photos):
+    interrupted_run(tmp_path)
+
+    output = run_renamer(tmp_path, '--undo')
+
+    # Only the journalled rename is undone; the unjournalled one is left where it is
+    assert 'Moved 1 files back.' in output
+    assert sorted(os.listdir(tmp_path / 'target')) == ['2024-03-01-10-00-01.JPG']
+
+    output = run_renamer(tmp_path, '--resume')
+    output += run_renamer(tmp_path, '--undo')
+
+    # Resuming finishes the run, after which everything can be moved back
+    assert {path: path.read_bytes() for path in sorted((tmp_path / 'source').rglob('*.jpg'))} == photos
+    assert not os.listdir(tmp_path / 'target')
@@ -0,0 +1,402 @@
+import atexit
+import cProfile
+import io
+import json
+import logging
+import math
+import os
+import platform
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional
+
+try:
+    import resource
+except ImportError: # Not on Windows; max RSS is then left out
+    resource = None
+
+# Run metrics shared by the tools: per-stage wall and CPU time, counters of bytes and
+# objects, S3 request latencies with percentiles, a progress line with an ETA, and a JSON
+# metrics file at the end of the run. cProfile and tracemalloc can be switched on from the
+# [Instrumentation] section of a tool's config.ini.
+#
+# Everything is recorded into the module's `metrics` object, which is safe to update from
+# any thread. Stages are named blocks of work. A stage's time is summed over all its calls
+# and threads, so stages run on a thread pool can add up to more than the run's wall time,
+# and stages may nest. CPU time is the calling thread's own.
+
+_rss_divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024 # ru_maxrss is bytes on macOS, KiB on Linux
+
+DEFAULT_PROGRESS_SECONDS = 30
+PROFILE_REPORT_LINES = 25 # Functions logged from the cProfile statistics
+
+# Latencies are counted in logarithmic buckets, each 2% wider than the last, so any
+# number of requests is summarized in fixed memory and the percentiles are within 2%
+_LATENCY_FLOOR = 1e-6 # Seconds; anything shorter goes in bucket 0
+_LATENCY_GROWTH = 1.02
+_LOG_LATENCY_GROWTH = math.log(_LATENCY_GROWTH)
+
+
+def read_instrumentation_config(config, default_metrics_file: str) -> dict:
+    """Reads the optional [Instrumentation] section of a tool's config.ini.
+
+    MetricsFile defaults to default_metrics_file; set to nothing, no metrics file is written.
+    """
+    if not config.has_section('Instrumentation'):
+        config.add_section('Instrumentation') # All instrumentation settings are optional
+    section = config['Instrumentation']
+    return {
+        'metrics_file': os.path.expanduser(section.get('MetricsFile', default_metrics_file)),
+        'progress_seconds': max(0.0, float(section.get('ProgressSeconds', DEFAULT_PROGRESS_SECONDS))), # 0 disables
+        'profile_file': os.path.expanduser(section.get('ProfileFile', '')), # Empty disables cProfile
+        'tracemalloc_top': max(0, int(section.get('TracemallocTop', 0))), # 0 disables tracemalloc
+    }
+
+
+class LatencyHistogram:
+    """Request latencies summarized as counts per logarithmic bucket."""
+
+    def __init__(self):
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds: float):
+        bucket = 0 if seconds <= _LATENCY_FLOOR else int(math.log(seconds / _LATENCY_FLOOR) / _LOG_LATENCY_GROWTH) + 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def percentile(self, fraction: float) -> float:
+        """The latency below which fraction of the requests fell (the upper edge of its bucket)."""
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.max_seconds, _LATENCY_FLOOR * _LATENCY_GROWTH ** bucket)
+        return self.max_seconds
+
+    def state(self) -> dict:
+        return {'buckets': dict(self.buckets), 'count': self.count, 'total_seconds': self.total_seconds,
+                'max_seconds': self.max_seconds}
+
+    def merge(self, state: dict):
+        for bucket, count in state['buckets'].items():
+            self.buckets[int(bucket)] += count
+        self.count += state['count']
+        self.total_seconds += state['total_seconds']
+        self.max_seconds = max(self.max_seconds, state['max_seconds'])
+
+    def summary(self) -> dict:
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count,
+                'mean_ms': round(1000 * self.total_seconds / self.count, 3),
+                'p50_ms': round(1000 * self.percentile(0.50), 3),
+                'p95_ms': round(1000 * self.percentile(0.95), 3),
+                'p99_ms': round(1000 * self.percentile(0.99), 3),
+                'max_ms': round(1000 * self.max_seconds, 3)}
+
+
+class Metrics:
+    """Stage times, counters, latencies and progress of one run. Safe to update from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Starts afresh, e.g. in a worker process that inherited its parent's metrics."""
+        with self._lock:
+            self.started = time.time()
+            self._started_wall = time.perf_counter()
+            self.stages = {} # name -> {'calls', 'wall_seconds', 'cpu_seconds'}
+            self.counters = defaultdict(int)
+            self.latencies = defaultdict(LatencyHistogram)
+            self.extra = {} # Anything else to write to the metrics file, e.g. from tracemalloc
+            self._progress_label = None
+            self._progress_total = None
+            self._progress_done = 0
+            self._progress_started = 0.0
+
+    def add_stage_time(self, name: str, wall_seconds: float, cpu_seconds: float, calls: int = 1):
+        with self._lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            stage['calls'] += calls
+            stage['wall_seconds'] += wall_seconds
+            stage['cpu_seconds'] += cpu_seconds
+
+    @contextmanager
+    def stage(self, name: str):
+        """Times the block as one call of the named stage."""
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def iterate(self, name: str, items: Iterable) -> Iterator:
+        """Passes items on, timing only the time spent producing them as the named stage.
+
+        For generators such as a listing, whose work happens as they are consumed.
+        """
+        wall_seconds = cpu_seconds = 0.0
+        iterator = iter(items)
+        try:
+            while True:
+                wall, cpu = time.perf_counter(), time.thread_time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    wall_seconds += time.perf_counter() - wall
+                    cpu_seconds += time.thread_time() - cpu
+                yield item
+        finally:
+            self.add_stage_time(name, wall_seconds, cpu_seconds)
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def observe(self, name: str, seconds: float):
+        """Records one latency, e.g. of an S3 request."""
+        with self._lock:
+            self.latencies[name].add(seconds)
+
+    def start_progress(self, label: str, total: Optional[int] = None):
+        """Starts a new phase for the progress line: label, and the number of items if known."""
+        with self._lock:
+            self._progress_label = label
+            self._progress_total = total
+            self._progress_done = 0
+            self._progress_started = time.perf_counter()
+
+    def advance(self, amount: int = 1):
+        """Counts items done in the current progress phase."""
+        with self._lock:
+            self._progress_done += amount
+
+    def progress_position(self) -> tuple:
+        """(label, items done) of the current progress phase."""
+        with self._lock:
+            return self._progress_label, self._progress_done
+
+    def progress_line(self) -> Optional[str]:
+        """E.g. 'Drawing images: 1200 of 5000 (24%), 35.2/s, ETA 1:48', or None before any phase starts."""
+        with self._lock:
+            label, total, done = self._progress_label, self._progress_total, self._progress_done
+            elapsed = time.perf_counter() - self._progress_started
+        if label is None:
+            return None
+        rate = done / elapsed if elapsed > 0 else 0.0
+        if not total:
+            return f"{label}: {done}, {rate:.1f}/s"
+        eta = format_duration((total - done) / rate) if rate > 0 else "unknown"
+        return f"{label}: {done} of {total} ({100 * done / total:.0f}%), {rate:.1f}/s, ETA {eta}"
+
+    def snapshot(self, reset: bool = False) -> dict:
+        """The stages, counters and latencies as plain data, e.g. to hand back from a worker process to merge."""
+        with self._lock:
+            snapshot = {'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                        'counters': dict(self.counters),
+                        'latencies': {name: histogram.state() for name, histogram in self.latencies.items()}}
+            if reset:
+                self.stages = {}
+                self.counters = defaultdict(int)
+                self.latencies = defaultdict(LatencyHistogram)
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        """Adds a snapshot from another process."""
+        for name, stage in snapshot['stages'].items():
+            self.add_stage_time(name, stage['wall_seconds'], stage['cpu_seconds'], stage['calls'])
+        with self._lock:
+            for name, amount in snapshot['counters'].items():
+                self.counters[name] += amount
+            for name, state in snapshot['latencies'].items():
+                self.latencies[name].merge(state)
+
+    def summary(self) -> dict:
+        """Everything recorded so far, as written to the metrics file."""
+        summary = {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'wall_seconds': round(time.perf_counter() - self._started_wall, 3),
+        }
+        if resource:
+            own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+            summary['cpu_seconds'] = round(own.ru_utime + own.ru_stime, 3)
+            summary['children_cpu_seconds'] = round(children.ru_utime + children.ru_stime, 3) # E.g. worker processes
+            summary['max_rss_mb'] = round(own.ru_maxrss / _rss_divisor, 1)
+        else:
+            summary['cpu_seconds'] = round(time.process_time(), 3)
+        with self._lock:
+            summary['stages'] = {name: {'calls': stage['calls'], 'wall_seconds': round(stage['wall_seconds'], 3),
+                                        'cpu_seconds': round(stage['cpu_seconds'], 3)}
+                                 for name, stage in self.stages.items()}
+            summary['counters'] = dict(sorted(self.counters.items()))
+            summary['latencies'] = {name: histogram.summary() for name, histogram in sorted(self.latencies.items())}
+            summary.update(self.extra)
+        summary['python'] = platform.python_version()
+        summary['machine'] = platform.platform()
+        return summary
+
+
+def format_duration(seconds: float) -> str:
+    """E.g. '45s', '12:05' or '6:02:11'."""
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}" if hours else f"{rest // 60}:{rest % 60:02d}"
+
+
+# The metrics every tool records into
+metrics = Metrics()
+
+
+def instrument_s3_client(s3_client, target: Metrics = metrics):
+    """Records the latency of every request a boto3 S3 client makes, per operation, and the bytes of its responses.
+
+    Latencies include botocore's retries. Call it once per client.
+    """
+    def before_call(model, context, **kwargs):
+        context['instrumentation'] = (model.name, time.perf_counter())
+
+    def after_call(context, http_response=None, parsed=None, exception=None, **kwargs):
+        started = context.pop('instrumentation', None)
+        if started is None:
+            return
+        operation, start = started
+        target.observe(f"s3.{operation}", time.perf_counter() - start)
+        target.count('s3_requests')
+        if exception is not None or (http_response is not None and http_response.status_code >= 300):
+            target.count('s3_errors')
+        elif parsed and operation == 'GetObject':
+            target.count('s3_bytes_downloaded', parsed.get('ContentLength', 0))
+
+    s3_client.meta.events.register('before-call.s3', before_call)
+    s3_client.meta.events.register('after-call.s3', after_call)
+    s3_client.meta.events.register('after-call-error.s3', after_call)
+    return s3_client
+
+
+class ProgressReporter:
+    """Reports metrics.progress_line() every interval seconds on a background thread."""
+
+    def __init__(self, target: Metrics, interval: float, report: Callable[[str], None]):
+        self._target = target
+        self._interval = interval
+        self._report = report
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='progress', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        last_position = None
+        while not self._stopped.wait(self._interval):
+            position = self._target.progress_position()
+            if position != last_position: # Nothing new while e.g. a save is running
+                line = self._target.progress_line()
+                if line:
+                    self._report(line)
+                last_position = position
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+class InstrumentedRun:
+    """The instrumentation of one tool run: see start_run."""
+
+    def __init__(self, settings: dict, tool: str, report: Callable[[str], None] = logging.info):
+        self.settings = settings
+        self.tool = tool
+        self.report = report
+        self._finished = False
+        if settings['tracemalloc_top']:
+            tracemalloc.start()
+        self._profiler = None
+        if settings['profile_file']:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._progress = ProgressReporter(metrics, settings['progress_seconds'], report) if settings['progress_seconds'] else None
+
+    def finish(self):
+        """Stops profiling and the progress line, reports the stages and writes the metrics file. Only acts once."""
+        if self._finished:
+            return
+        self._finished = True
+        if self._progress:
+            self._progress.stop()
+        if self._profiler:
+            self._profiler.disable()
+        if self.settings['tracemalloc_top']:
+            self._report_allocations() # Before the profile report allocates anything
+        if self._profiler:
+            self._report_profile()
+        self._report_stages()
+        if self.settings['metrics_file']:
+            summary = metrics.summary()
+            summary['tool'] = self.tool
+            try:
+                with open(self.settings['metrics_file'], 'w') as f:
+                    json.dump(summary, f, indent=1)
+                self.report(f"Metrics written to {self.settings['metrics_file']}")
+            except OSError as e:
+                self.report(f"Failed to write metrics file {self.settings['metrics_file']}: {e}")
+
+    def _report_profile(self):
+        # cProfile only sees the main thread; the stage times cover the worker threads
+        self._profiler.dump_stats(self.settings['profile_file'])
+        text = io.StringIO()
+        pstats.Stats(self._profiler, stream=text).sort_stats('cumulative').print_stats(PROFILE_REPORT_LINES)
+        self.report(f"cProfile statistics written to {self.settings['profile_file']} (open with python -m pstats). "
+                    f"Top {PROFILE_REPORT_LINES} by cumulative time:\n{text.getvalue().strip()}")
+
+    def _report_allocations(self):
+        _, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:self.settings['tracemalloc_top']]
+        tracemalloc.stop()
+        metrics.extra['tracemalloc'] = {
+            'peak_mb': round(peak / 1e6, 1),
+            'top': [{'location': str(statistic.traceback), 'size_kb': round(statistic.size / 1024, 1), 'count': statistic.count}
+                    for statistic in top],
+        }
+        self.report(f"tracemalloc: peak {peak / 1e6:.1f} MB traced; largest allocations still held:\n"
+                    + "\n".join(f"  {statistic}" for statistic in top))
+
+    def _report_stages(self):
+        summary = metrics.summary()
+        lines = [f"  {name}: {stage['wall_seconds']:.1f}s wall, {stage['cpu_seconds']:.1f}s CPU, "
+                 f"{stage['calls']} call{'s' if stage['calls'] != 1 else ''}"
+                 for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['wall_seconds'])]
+        lines += [f"  {name}: {latency['count']} requests, p50 {latency['p50_ms']:.1f} ms, p95 {latency['p95_ms']:.1f} ms, "
+                  f"max {latency['max_ms']:.1f} ms" for name, latency in summary['latencies'].items() if latency['count']]
+        counters = ", ".join(f"{name} {amount}" for name, amount in summary['counters'].items())
+        if counters:
+            lines.append(f"  {counters}")
+        heading = f"Run took {summary['wall_seconds']:.1f}s, {summary['cpu_seconds']:.1f}s CPU."
+        self.report(heading + " Stage times (summed over threads):\n" + "\n".join(lines) if lines else heading)
+
+
+def start_run(settings: dict, tool: str, report: Callable[[str], None] = logging.info) -> InstrumentedRun:
+    """Starts the instrumentation of a tool run with the settings from read_instrumentation_config.
+
+    The run finishes when the interpreter exits, however the tool ends (including exit()),
+    or earlier with finish(). report is how lines are reported, e.g. print for a tool
+    that doesn't log.
+    """
+    run = InstrumentedRun(settings, tool, report)
+    atexit.register(run.finish)
+    return run
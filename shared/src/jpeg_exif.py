@@ -0,0 +1,131 @@
+import struct
+from typing import Callable, Optional, Tuple
+
+# Header-only access to the EXIF (APP1) segment of a JPEG, so callers can read a few KB
+# from S3 or disk instead of the whole file.
+
+DEFAULT_HEADER_BYTES = 64 * 1024 # Enough for the EXIF segment of almost every camera
+MAX_HEADER_BYTES = 1024 * 1024 # Give up if the EXIF segment isn't within the first 1 MB
+
+EXIF_HEADER = b'Exif\x00\x00'
+
+# Markers without a length field
+_STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+_SOI, _EOI, _SOS, _APP1 = 0xD8, 0xD9, 0xDA, 0xE1
+
+# TIFF tags in IFD1 that locate the embedded JPEG thumbnail
+_TAG_THUMBNAIL_OFFSET = 0x0201
+_TAG_THUMBNAIL_LENGTH = 0x0202
+
+
+class TruncatedHeader(Exception):
+    """Raised when more leading bytes are needed to reach the end of the EXIF segment."""
+    def __init__(self, needed: int):
+        super().__init__(f"Need at least {needed} bytes of the JPEG header")
+        self.needed = needed
+
+
+def exif_segment_bounds(data: bytes) -> Optional[Tuple[int, int]]:
+    """Returns (start, end) of the EXIF APP1 payload within the leading bytes of a JPEG.
+
+    The payload starts with b'Exif\\0\\0'. Returns None if the data is not a JPEG or the
+    image data starts without an EXIF segment. Raises TruncatedHeader if data stops
+    before the answer is known.
+    """
+    if len(data) < 2:
+        raise TruncatedHeader(2)
+    if data[0] != 0xFF or data[1] != _SOI:
+        return None
+    pos = 2
+    while True:
+        # Skip fill bytes before the marker code
+        while pos + 1 < len(data) and data[pos] == 0xFF and data[pos + 1] == 0xFF:
+            pos += 1
+        if pos + 4 > len(data):
+            raise TruncatedHeader(pos + 4)
+        if data[pos] != 0xFF:
+            return None # Corrupt marker stream
+        marker = data[pos + 1]
+        if marker in _STANDALONE_MARKERS:
+            pos += 2
+            continue
+        if marker in (_SOS, _EOI):
+            return None
+        segment_length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        start, end = pos + 4, pos + 2 + segment_length
+        if marker == _APP1:
+            if start + len(EXIF_HEADER) > len(data):
+                raise TruncatedHeader(start + len(EXIF_HEADER))
+            if data[start:start + len(EXIF_HEADER)] == EXIF_HEADER: # APP1 is also used for XMP
+                return start, end
+        pos = end
+
+
+def read_exif_segment(read_prefix: Callable[[int], bytes],
+                      initial_bytes: int = DEFAULT_HEADER_BYTES,
+                      max_bytes: int = MAX_HEADER_BYTES) -> Tuple[Optional[bytes], bytes]:
+    """Reads just enough of a JPEG to extract its EXIF APP1 payload.
+
+    read_prefix(n) must return the first n bytes of the file (fewer if the file is shorter),
+    e.g. an S3 ranged GET or a bounded file read. The read is retried with a larger prefix
+    when the EXIF segment is truncated.
+
+    Returns (payload, data) where payload is the APP1 payload (starting b'Exif\\0\\0') or
+    None if there is none, and data is the largest prefix that was read.
+    """
+    size = initial_bytes
+    while True:
+        data = read_prefix(size)
+        try:
+            bounds = exif_segment_bounds(data)
+        except TruncatedHeader as e:
+            if len(data) < size or e.needed > max_bytes:
+                return None, data # Hit the end of the file, or the segment is too far in
+            size = min(max(e.needed, size * 2), max_bytes)
+            continue
+        if bounds is None:
+            return None, data
+        start, end = bounds
+        if end <= len(data):
+            return data[start:end], data
+        if len(data) < size or end > max_bytes:
+            return None, data
+        size = end
+
+
+def exif_thumbnail(payload: bytes) -> Optional[bytes]:
+    """Returns the embedded JPEG thumbnail from an EXIF APP1 payload, or None."""
+    tiff = payload[len(EXIF_HEADER):]
+    try:
+        if tiff[:2] == b'II':
+            endian = '<'
+        elif tiff[:2] == b'MM':
+            endian = '>'
+        else:
+            return None
+        ifd0_offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+        ifd0_entries = struct.unpack(endian + 'H', tiff[ifd0_offset:ifd0_offset + 2])[0]
+        next_ifd = ifd0_offset + 2 + ifd0_entries * 12
+        ifd1_offset = struct.unpack(endian + 'I', tiff[next_ifd:next_ifd + 4])[0]
+        if ifd1_offset == 0:
+            return None
+        ifd1_entries = struct.unpack(endian + 'H', tiff[ifd1_offset:ifd1_offset + 2])[0]
+        thumbnail_offset = thumbnail_length = None
+        for i in range(ifd1_entries):
+            entry = ifd1_offset + 2 + i * 12
+            tag, field_type, _ = struct.unpack(endian + 'HHI', tiff[entry:entry + 8])
+            # Both tags are LONG, but tolerate writers that use SHORT
+            value_format = endian + ('H' if field_type == 3 else 'I')
+            value = struct.unpack(value_format, tiff[entry + 8:entry + 8 + struct.calcsize(value_format)])[0]
+            if tag == _TAG_THUMBNAIL_OFFSET:
+                thumbnail_offset = value
+            elif tag == _TAG_THUMBNAIL_LENGTH:
+                thumbnail_length = value
+    except struct.error:
+        return None # Offsets point outside the segment
+    if not thumbnail_offset or not thumbnail_length:
+        return None
+    thumbnail = tiff[thumbnail_offset:thumbnail_offset + thumbnail_length]
+    if len(thumbnail) != thumbnail_length or not thumbnail.startswith(b'\xff\xd8'):
+        return None
+    return thumbnail
@@ -0,0 +1,36 @@
+import itertools
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Iterable, Iterator, Tuple, TypeVar
+
+# Running work on a pool while consuming the results in their original order, e.g. image
+# downloads that must reach the PDF in the order they are drawn. Only a window of calls is
+# submitted ahead of the consumer, so neither the inputs nor the results are all held in
+# memory at once.
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def map_in_order(executor: Executor, fn: Callable[[T], R], items: Iterable[T], window: int) -> Iterator[Tuple[T, R]]:
+    """Runs fn(item) on an executor and yields (item, result) in the order of items.
+
+    At most window calls are in flight or waiting to be consumed, so memory use stays
+    bounded however many items there are, and items is only read as far ahead as needed.
+    Shuts the executor down when done.
+    """
+    items = iter(items)
+    pending = deque()
+    try:
+        for item in itertools.islice(items, window):
+            pending.append((item, executor.submit(fn, item)))
+        while pending:
+            item, future = pending.popleft()
+            result = future.result()
+            # Top the window up before handing the result over, so the work carries on
+            # while the caller uses it.
+            for next_item in itertools.islice(items, 1):
+                pending.append((next_item, executor.submit(fn, next_item)))
+            yield item, result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
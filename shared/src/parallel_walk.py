@@ -0,0 +1,115 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Iterator, List, NamedTuple, Optional
+
+# Directory walking for network mounts (NFS/SMB), where every directory listing and every
+# stat is a round trip. Directories are listed ahead of the walk on a thread pool, so many
+# round trips are in flight at once, while the results still come back in the same order
+# as a sequential walk: depth first, with entries sorted by name.
+
+DEFAULT_WORKERS = 8
+
+
+class WalkEntry(NamedTuple):
+    """A file found by the walk, with the stat results taken while listing its directory."""
+    path: str
+    name: str
+    size: int
+    mtime_ns: int
+
+
+class DirectoryListing(NamedTuple):
+    path: str
+    mtime_ns: int
+    files: Optional[List[WalkEntry]] # Sorted by name; None if a custom list_directory chose not to list them
+    sub_directories: List[str] # Sorted by name
+
+
+def list_directory(path: str) -> Optional[DirectoryListing]:
+    """Lists one directory with os.scandir, stat-ing its files. Returns None if it can't be read.
+
+    Like os.walk, symlinks to files are followed but symlinked directories are not walked.
+    A broken symlink is listed with the stat of the link itself. DirEntry caches its stat
+    results, and on Windows they come free with the listing.
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+        with os.scandir(path) as scanned:
+            entries = sorted(scanned, key=lambda entry: entry.name)
+    except OSError as e:
+        logging.warning(f"Failed to list directory {path}: {e}")
+        return None
+    files = []
+    sub_directories = []
+    for entry in entries:
+        try:
+            if entry.is_dir(): # Usually answered from the listing itself, without a stat
+                if not entry.is_symlink():
+                    sub_directories.append(entry.path)
+                continue
+            stat = entry.stat() if not entry.is_symlink() or os.path.exists(entry.path) else entry.stat(follow_symlinks=False)
+        except OSError as e:
+            logging.warning(f"Failed to stat {entry.path}: {e}")
+            continue
+        files.append(WalkEntry(entry.path, entry.name, stat.st_size, stat.st_mtime_ns))
+    return DirectoryListing(path, mtime_ns, files, sub_directories)
+
+
+def walk_directories(root: str, workers: int = DEFAULT_WORKERS,
+                     list_function: Callable[[str], Optional[DirectoryListing]] = list_directory,
+                     fan_out: Optional[int] = None) -> Iterator[DirectoryListing]:
+    """Yields a DirectoryListing for root and every directory below it, depth first.
+
+    Listings run on a pool of workers threads. While waiting for the next directory, the
+    walk lists ahead: first the directories already waiting on the stack, then the
+    sub-directories of listings that have come back early, so round trips overlap even
+    in deep trees. At most fan_out directories (default four per worker) are listed
+    ahead, which bounds memory however large the tree is. Directories that can't be
+    listed are logged and skipped.
+    """
+    fan_out = fan_out or 4 * workers
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='walk') as executor:
+        pending = [root] # Stack of directories still to yield; the next one is at the end
+        listings = {} # path -> future, for directories listed ahead
+        expanded = set() # Paths in listings whose sub-directories have been listed ahead too
+
+        def list_ahead(path):
+            if len(listings) < fan_out and path not in listings:
+                listings[path] = executor.submit(list_function, path)
+
+        def list_ahead_of_walk():
+            for path in reversed(pending):
+                if len(listings) >= fan_out:
+                    return
+                list_ahead(path)
+            for path, future in list(listings.items()):
+                if len(listings) >= fan_out:
+                    return
+                if path in expanded or not future.done() or future.exception():
+                    continue
+                expanded.add(path)
+                listing = future.result()
+                for sub_directory in listing.sub_directories if listing else []:
+                    list_ahead(sub_directory)
+
+        while pending:
+            path = pending.pop()
+            # The window may be full of directories further down the stack
+            future = listings.pop(path, None) or executor.submit(list_function, path)
+            expanded.discard(path)
+            while not future.done():
+                list_ahead_of_walk()
+                running = [other for other in listings.values() if not other.done()]
+                wait([future, *running], return_when=FIRST_COMPLETED) # Until there may be more to list ahead
+            listing = future.result()
+            if listing is None:
+                continue
+            pending.extend(reversed(listing.sub_directories))
+            yield listing
+
+
+def walk_files(root: str, workers: int = DEFAULT_WORKERS, fan_out: Optional[int] = None) -> Iterator[WalkEntry]:
+    """Yields every file below root, with its size and mtime, in the order of walk_directories."""
+    for listing in walk_directories(root, workers, fan_out=fan_out):
+        yield from listing.files
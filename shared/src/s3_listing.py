@@ -0,0 +1,217 @@
+import csv
+import gzip
+import heapq
+import json
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+from urllib.parse import unquote_plus
+
+try:
+    import pyarrow.parquet as parquet
+except ImportError:
+    parquet = None # Only needed for Parquet inventories, checked when one is read
+
+# Fast listing of large S3 prefixes. A single list_objects_v2 paginator returns 1000 keys
+# per round trip, one after another. Here the prefix is first split into sub-prefixes with
+# Delimiter='/', the sub-prefixes are listed concurrently, and the results are merged back
+# into the same lexicographic order a single listing would give. S3 Inventory reports that
+# have been downloaded to local disk can be read instead of calling the API at all.
+
+DEFAULT_PARTITIONS_PER_WORKER = 4 # Keeps the workers busy when sub-prefixes differ in size
+DEFAULT_MAX_DEPTH = 3 # Levels of sub-prefixes explored to find enough partitions
+QUEUED_PAGES = 4 # Pages buffered per partition that is listed ahead of the one being read
+
+_DONE = object()
+
+# Parquet inventories name their columns in snake_case, CSV manifests in the API's names
+PARQUET_FIELDS = {
+    'bucket': 'Bucket',
+    'key': 'Key',
+    'version_id': 'VersionId',
+    'is_latest': 'IsLatest',
+    'is_delete_marker': 'IsDeleteMarker',
+    'size': 'Size',
+    'last_modified_date': 'LastModifiedDate',
+    'e_tag': 'ETag',
+    'storage_class': 'StorageClass',
+}
+
+
+def list_prefix_level(s3_client, bucket_name: str, prefix: str) -> Tuple[List[Dict], List[str]]:
+    """Lists one level of a prefix with Delimiter='/'. Returns (objects, sub_prefixes)."""
+    objects, sub_prefixes = [], []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        objects.extend(page.get('Contents', []))
+        sub_prefixes.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+    return objects, sub_prefixes
+
+
+def discover_partitions(s3_client, bucket_name: str, prefix: str, executor, target_partitions: int,
+                        max_depth: int = DEFAULT_MAX_DEPTH) -> Tuple[List[Dict], List[str]]:
+    """Splits prefix into sub-prefixes that can be listed independently.
+
+    Levels are explored with Delimiter='/' (concurrently within a level) until there are
+    at least target_partitions sub-prefixes or max_depth levels have been explored.
+    Returns (objects found directly at the explored levels, sorted partition prefixes).
+    Together they cover every key under prefix exactly once.
+    """
+    direct_objects = []
+    partitions = [prefix]
+    for _ in range(max_depth):
+        if len(partitions) >= target_partitions:
+            break
+        sub_partitions = []
+        for objects, sub_prefixes in executor.map(lambda p: list_prefix_level(s3_client, bucket_name, p), partitions):
+            direct_objects.extend(objects)
+            sub_partitions.extend(sub_prefixes)
+        partitions = sorted(sub_partitions)
+        if not partitions:
+            break
+    direct_objects.sort(key=lambda obj: obj['Key'])
+    return direct_objects, partitions
+
+
+def _list_partition(s3_client, bucket_name: str, partition: str, pages: queue.Queue, stop: threading.Event):
+    """Lists a partition in a worker thread, passing pages of objects to the consumer."""
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False # The consumer has gone away
+
+    try:
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=partition):
+            if not put(page.get('Contents', [])):
+                return
+        put(_DONE)
+    except Exception as e:
+        put(e)
+
+
+def _iter_partitions(s3_client, bucket_name: str, partitions: List[str], executor, workers: int) -> Iterator[Dict]:
+    """Yields the objects of each partition in turn, while up to workers partitions are listed ahead."""
+    stop = threading.Event()
+    remaining = iter(partitions)
+    active = [] # Queues of the partitions being listed, in order
+
+    def start_next():
+        partition = next(remaining, None)
+        if partition is not None:
+            pages = queue.Queue(maxsize=QUEUED_PAGES)
+            executor.submit(_list_partition, s3_client, bucket_name, partition, pages, stop)
+            active.append(pages)
+
+    try:
+        for _ in range(workers):
+            start_next()
+        while active:
+            pages = active.pop(0)
+            while True:
+                page = pages.get()
+                if page is _DONE:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield from page
+            start_next()
+    finally:
+        stop.set() # Unblocks any producers if the caller stops early
+
+
+def list_objects(s3_client, bucket_name: str, prefix: str, workers: int = 1,
+                 partitions_per_worker: int = DEFAULT_PARTITIONS_PER_WORKER,
+                 max_depth: int = DEFAULT_MAX_DEPTH) -> Iterator[Dict]:
+    """Yields every object under prefix in lexicographic key order, like one list_objects_v2 listing.
+
+    With workers > 1 the prefix is partitioned into sub-prefixes (see discover_partitions)
+    that are listed concurrently. Memory is bounded by the pages buffered per partition,
+    not by the size of the listing.
+    """
+    if workers <= 1:
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            yield from page.get('Contents', [])
+        return
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='s3-list') as executor:
+        direct_objects, partitions = discover_partitions(s3_client, bucket_name, prefix, executor,
+                                                         workers * partitions_per_worker, max_depth)
+        logging.info(f"Listing s3://{bucket_name}/{prefix} as {len(partitions)} sub-prefixes with {workers} workers...")
+        # Partitions are disjoint, ordered key ranges; the directly listed keys fall in between
+        yield from heapq.merge(direct_objects,
+                               _iter_partitions(s3_client, bucket_name, partitions, executor, workers),
+                               key=lambda obj: obj['Key'])
+
+
+def _inventory_data_path(manifest_path: str, data_key: str) -> str:
+    """Finds a data file named in an inventory manifest, next to the downloaded manifest."""
+    manifest_directory = os.path.dirname(os.path.abspath(manifest_path))
+    name = os.path.basename(data_key)
+    # Inventories are delivered as <config>/<date>/manifest.json with data in <config>/data/
+    for candidate in (os.path.join(manifest_directory, '..', 'data', name),
+                      os.path.join(manifest_directory, 'data', name),
+                      os.path.join(manifest_directory, name)):
+        if os.path.exists(candidate):
+            return os.path.normpath(candidate)
+    raise FileNotFoundError(f"Inventory data file {name} not found near {manifest_path}")
+
+
+def _inventory_rows(manifest_path: str, manifest: Dict) -> Iterator[Dict]:
+    """Yields the rows of an inventory's data files as dicts keyed by the CSV schema's field names (Key, Size, ...)."""
+    file_format = manifest.get('fileFormat', 'CSV').upper()
+    # Only a CSV manifest's fileSchema is a list of field names; a Parquet one is a message schema
+    fields = [field.strip() for field in manifest.get('fileSchema', '').split(',')] if file_format == 'CSV' else []
+    for data_file in manifest['files']:
+        path = _inventory_data_path(manifest_path, data_file['key'])
+        if file_format == 'CSV':
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt', encoding='utf-8', newline='') as f:
+                for values in csv.reader(f):
+                    row = dict(zip(fields, values))
+                    row['Key'] = unquote_plus(row['Key']) # Keys in CSV inventories are URL-encoded
+                    yield row
+        elif file_format == 'PARQUET':
+            if parquet is None:
+                raise ImportError("Reading a Parquet inventory needs the pyarrow package (pip install pyarrow).")
+            for batch in parquet.ParquetFile(path).iter_batches():
+                for row in batch.to_pylist():
+                    yield {PARQUET_FIELDS.get(name, name): value for name, value in row.items()}
+        else:
+            raise ValueError(f"Unsupported inventory format {file_format} in {manifest_path} (use CSV or Parquet).")
+
+
+def read_inventory(manifest_path: str, prefix: str = '') -> List[Dict]:
+    """Reads the objects under prefix from a downloaded S3 Inventory report, without calling S3.
+
+    manifest_path is the report's manifest.json. Returns list_objects_v2-style dicts (Key,
+    Size, ETag, LastModified) sorted by key. For versioned inventories only the current,
+    non-deleted versions are returned.
+    """
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    objects = []
+    for row in _inventory_rows(manifest_path, manifest):
+        key = row['Key']
+        if not key.startswith(prefix):
+            continue
+        if str(row.get('IsLatest', 'true')).lower() == 'false' or str(row.get('IsDeleteMarker', 'false')).lower() == 'true':
+            continue
+        obj = {'Key': key, 'Size': int(row.get('Size') or 0)}
+        if row.get('ETag'):
+            obj['ETag'] = f'"{row["ETag"]}"' # Quoted, as list_objects_v2 returns it
+        if row.get('LastModifiedDate'):
+            obj['LastModified'] = row['LastModifiedDate']
+        objects.append(obj)
+    objects.sort(key=lambda obj: obj['Key'])
+    logging.info(f"Read {len(objects)} objects under '{prefix}' from inventory {manifest_path}"
+                 f" (bucket {manifest.get('sourceBucket', 'unknown')}).")
+    return objects
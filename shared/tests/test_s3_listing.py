@@ -0,0 +1,97 @@
+import csv
+import gzip
+import json
+import os
+import sys
+from pathlib import Path
+
+import boto3
+import pytest
+from moto import mock_aws
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+from s3_listing import list_objects, read_inventory
+
+BUCKET = 'inventory-test'
+
+
+def write_manifest(directory, file_format, schema, data_name):
+    """Writes a manifest.json laid out as S3 delivers it: <config>/<date>/manifest.json, data in <config>/data/."""
+    manifest_directory = directory / '2024-01-01T00-00Z'
+    manifest_directory.mkdir(parents=True)
+    manifest_path = manifest_directory / 'manifest.json'
+    manifest_path.write_text(json.dumps({
+        'sourceBucket': BUCKET,
+        'fileFormat': file_format,
+        'fileSchema': schema,
+        'files': [{'key': f'{BUCKET}/config/data/{data_name}'}],
+    }))
+    return str(manifest_path)
+
+
+def test_read_csv_inventory(tmp_path):
+    (tmp_path / 'data').mkdir()
+    with gzip.open(tmp_path / 'data' / 'part-0.csv.gz', 'wt', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([BUCKET, 'photos/b.jpg', 'v2', 'true', 'false', '200', '2024-01-01T00:00:00.000Z', 'bbb'])
+        writer.writerow([BUCKET, 'photos/a+b%21.jpg', 'v1', 'true', 'false', '100', '2024-01-01T00:00:00.000Z', 'aaa'])
+        writer.writerow([BUCKET, 'photos/old.jpg', 'v0', 'false', 'false', '50', '2023-01-01T00:00:00.000Z', 'ooo'])
+        writer.writerow([BUCKET, 'photos/deleted.jpg', 'v3', 'true', 'true', '', '2024-01-01T00:00:00.000Z', ''])
+        writer.writerow([BUCKET, 'other/c.jpg', 'v4', 'true', 'false', '300', '2024-01-01T00:00:00.000Z', 'ccc'])
+    manifest = write_manifest(tmp_path, 'CSV', 'Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size, LastModifiedDate, ETag',
+                              'part-0.csv.gz')
+
+    objects = read_inventory(manifest, 'photos/')
+
+    assert [(obj['Key'], obj['Size'], obj['ETag']) for obj in objects] == [
+        ('photos/a b!.jpg', 100, '"aaa"'), # Keys are URL-decoded
+        ('photos/b.jpg', 200, '"bbb"'),
+    ]
+
+
+def test_read_parquet_inventory(tmp_path):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as parquet
+    (tmp_path / 'data').mkdir()
+    table = pyarrow.table({
+        'bucket': [BUCKET] * 4,
+        'key': ['photos/b.jpg', 'photos/a b.jpg', 'photos/old.jpg', 'other/c.jpg'],
+        'is_latest': [True, True, False, True],
+        'is_delete_marker': [False, False, False, False],
+        'size': [200, 100, 50, 300],
+        'e_tag': ['bbb', 'aaa', 'ooo', 'ccc'],
+    })
+    parquet.write_table(table, tmp_path / 'data' / 'part-0.parquet')
+    schema = ('message s3.inventory { required binary bucket (UTF8); required binary key (UTF8); '
+              'optional boolean is_latest; optional boolean is_delete_marker; optional int64 size; optional binary e_tag (UTF8);}')
+    manifest = write_manifest(tmp_path, 'Parquet', schema, 'part-0.parquet')
+
+    objects = read_inventory(manifest, 'photos/')
+
+    assert [(obj['Key'], obj['Size'], obj['ETag']) for obj in objects] == [
+        ('photos/a b.jpg', 100, '"aaa"'), # Parquet keys are not URL-encoded
+        ('photos/b.jpg', 200, '"bbb"'),
+    ]
+
+
+@pytest.fixture
+def s3_client():
+    os.environ.pop('AWS_ENDPOINT_URL', None) # Always the in-process mock, never a server
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def test_parallel_listing_matches_serial(s3_client):
+    keys = [f'photos/{year}/{month:02d}/IMG_{number:04d}.jpg'
+            for year in (2021, 2022, 2023) for month in range(1, 13) for number in range(5)]
+    keys += ['photos/top.jpg', 'photos/2022/loose.jpg', 'photos/2022-extra/x.jpg', 'outside.jpg']
+    for key in keys:
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body=b'x')
+
+    serial = [obj['Key'] for obj in list_objects(s3_client, BUCKET, 'photos/', workers=1)]
+    assert serial == sorted(key for key in keys if key.startswith('photos/'))
+    for workers in (2, 4, 8):
+        parallel = [obj['Key'] for obj in list_objects(s3_client, BUCKET, 'photos/', workers=workers, partitions_per_worker=2)]
+        assert parallel == serial